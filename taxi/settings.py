@@ -23,12 +23,14 @@ THIRD_PARTY_APPS = [
 ]
 
 LOCAL_APPS = [
-    'trip',
+    'trip.apps.TripConfig',
 ]
 
 INSTALLED_APPS = DJANGO_APPS + THIRD_PARTY_APPS + LOCAL_APPS
 
 MIDDLEWARE = [
+    'trip.metrics.MetricsMiddleware',
+    'trip.routers.ReadYourWritesMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +69,35 @@ DATABASES = {
     }
 }
 
+# Reads go to a random one of DATABASE_REPLICAS and writes to 'default'. A user
+# who wrote anything reads from 'default' for READ_YOUR_WRITES_WINDOW seconds,
+# which should cover the replicas' lag. Those writes are tracked in the
+# READ_YOUR_WRITES_CACHE cache, which must be shared by every process; check
+# trip.E001 refuses a per-process one. Set DATABASE_REPLICA to the path of a
+# second SQLite file to try it locally, adding 'trip.E001' to
+# SILENCED_SYSTEM_CHECKS when a single process serves everything.
+if os.getenv('DATABASE_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.getenv('DATABASE_REPLICA'),
+        'TEST': {'MIRROR': 'default'},
+    }
+DATABASE_ROUTERS = ['trip.routers.ReplicaRouter']
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+READ_YOUR_WRITES_WINDOW = 5
+READ_YOUR_WRITES_CACHE = 'default'
+
+# Trip update replay, metrics and login throttling are kept here. Point this at
+# a cache shared by every worker (e.g. memcached) when running several processes.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -100,8 +131,47 @@ STATICFILES_DIRS = (
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.TokenAuthentication',
-    )
+        'trip.authentication.CachedTokenAuthentication',
+    ),
+    # Counted in the default cache. 'sign_up' and 'log_in_address' are per client
+    # address (AddressRateThrottle); 'log_in' is per submitted username and client
+    # address (UsernameRateThrottle).
+    'DEFAULT_THROTTLE_RATES': {
+        'sign_up': '10/min',
+        'log_in': '10/min',
+        'log_in_address': '30/min',
+    },
+}
+
+# Passwords are checked by PooledModelBackend, which also reads the user's token
+# in the same query.
+AUTHENTICATION_BACKENDS = [
+    'trip.authentication.PooledModelBackend',
+]
+
+# Passwords are hashed and checked in this many worker processes rather than on
+# request threads. The processes are started fresh (forkserver, or spawn), not
+# forked from the threaded server. Once `max_pending` hashes are running or
+# waiting, further sign-ups and logins get a 503 at once, as does any hash that
+# takes longer than `timeout` seconds. The processes run `niceness` steps below
+# the server's, so request handling comes first when CPU is short. With 0
+# processes, hashing runs on the request thread, bounded the same way.
+PASSWORD_POOL = {
+    'processes': 2,
+    'max_pending': 16,
+    'timeout': 5.0,
+    'niceness': 10,
+}
+
+# Token -> user and role lookups are cached in-process, and entries (and
+# invalidations) are shared between processes through `shared_cache` in CACHES.
+# That cache has to be one every worker shares for a log out to revoke a token
+# everywhere at once; system check trip.W001 warns when it is not, and may be
+# silenced in SILENCED_SYSTEM_CHECKS when a single process serves all requests.
+AUTH_TOKEN_CACHE = {
+    'max_size': 10000,
+    'ttl': 300,
+    'shared_cache': 'default',
 }
 
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
@@ -115,3 +185,100 @@ CHANNEL_LAYERS = {
         'ROUTING': 'taxi.routing.channel_routing',
     },
 }
+
+# New trip requests are offered to the closest drivers within this radius (km).
+DISPATCH_CELL_SIZE = 0.05
+DISPATCH_RADIUS = 5.0
+DISPATCH_MAX_DRIVERS = 10
+
+# 'broadcast' alerts nearby drivers of each new request and the first to claim
+# it wins. 'batch' leaves requests to the `run_dispatcher` command, which every
+# DISPATCH_WINDOW seconds pairs open requests with free drivers (online and
+# available, with a position newer than DISPATCH_LOCATION_MAX_AGE seconds),
+# nearest pick-up first among each trip's DISPATCH_CANDIDATES closest drivers,
+# and offers each trip to its driver alone for DISPATCH_OFFER_TIMEOUT seconds.
+# Requests with no driver in range go to any free driver left over. The
+# command reads presence from the channel layer, so it needs asgi_redis.
+DISPATCH_MODE = 'broadcast'
+DISPATCH_WINDOW = 2.0
+DISPATCH_CANDIDATES = 10
+DISPATCH_OFFER_TIMEOUT = 15.0
+DISPATCH_LOCATION_MAX_AGE = 30
+
+# Connected drivers count as online for this many seconds after their last
+# heartbeat (a connect or any message; the web client sends a 'heartbeat' every
+# 20 seconds), and as available while they are also not on a trip. New trip
+# alerts go only to online, available drivers.
+PRESENCE_TTL = 60
+
+# Driver location pings are coalesced in memory and written in bulk, every
+# LOCATION_FLUSH_INTERVAL seconds or once LOCATION_FLUSH_SIZE drivers are
+# pending. A crashed worker loses the latest unwritten position of each of
+# those drivers, more of them if writes were failing before the crash.
+LOCATION_FLUSH_INTERVAL = 2.0
+LOCATION_FLUSH_SIZE = 500
+
+# The last `size` updates broadcast for each trip are kept for `timeout`
+# seconds so reconnecting clients can catch up on what they missed.
+TRIP_EVENT_LOG = {
+    'size': 50,
+    'timeout': 3600,
+}
+
+# New trips get coordinates for their addresses, plus a distance, duration and
+# fare estimate, from the geocoding provider class at this dotted path (None
+# turns this off). 'trip.geocoding.LocalProvider' makes up deterministic
+# coordinates for development and tests. Answers are kept in an in-process LRU
+# of `cache_size` entries and in the database, so each address and route is
+# only ever asked for once. Addresses and routes the provider has no answer
+# for are only remembered, in-process, for `miss_ttl` seconds.
+GEOCODING = {
+    'provider': None,
+    'cache_size': 10000,
+    'miss_ttl': 300,
+}
+TRIP_FARE = {
+    'base': '2.50',
+    'per_km': '1.25',
+    'per_minute': '0.30',
+}
+
+# Serialized trips and their rendered JSON, shared by REST responses and socket
+# broadcasts. Each trip keeps one entry, for its latest version; the least
+# recently used are dropped past `max_size` trips or `max_bytes` of JSON. The
+# cache is per process, and a user's new name or groups only reach the other
+# processes' entries once those expire after `ttl` seconds.
+TRIP_PAYLOAD_CACHE = {
+    'max_size': 10000,
+    'max_bytes': 32 * 1024 * 1024,
+    'ttl': 300,
+}
+
+# Dotted path to a callable taking an unsaved trip and returning its 32
+# character natural key. 'trip.keys.md5_nk' restores the original keys.
+TRIP_NK_GENERATOR = 'trip.keys.time_ordered_nk'
+
+# Move trips into the archive table as soon as a driver completes them,
+# instead of leaving that to the `archive_trips` management command.
+TRIP_ARCHIVE_ON_COMPLETE = False
+
+# Latency, query count, fan-out, socket and error metrics, served in the
+# Prometheus text format at /api/metrics/ to staff users and to scrapers that
+# send `Authorization: Bearer <METRICS_TOKEN>`. Each process publishes its
+# numbers to the cache every METRICS_PUBLISH_INTERVAL seconds and the endpoint
+# adds them up. When disabled, the hooks cost a settings lookup.
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '') == '1'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_PUBLISH_INTERVAL = 10
+
+# Token buckets for incoming socket messages, kept per user and per socket:
+# each refills at `rate` messages a second and holds at most `burst`.
+# Over-limit location pings and heartbeats are dropped, since the next one
+# supersedes them; anything else gets an error reply. With asgi_redis the
+# buckets live in the channel layer's Redis, on the shard of the user's bucket,
+# and are shared by all workers.
+SOCKET_RATE_LIMITS = {
+    'location': {'rate': 2.0, 'burst': 10},
+    'heartbeat': {'rate': 0.5, 'burst': 5},
+    'message': {'rate': 1.0, 'burst': 10},
+}
@@ -1,6 +1,6 @@
 from django.conf.urls import include, url
 from django.views.generic import TemplateView
-from trip.apis import SignUpView, LogInView, LogOutView
+from trip.apis import AvailableDriversView, SignUpView, LogInView, LogOutView, MetricsView
 
 urlpatterns = [
     url(r'^$', TemplateView.as_view(template_name='index.html')),
@@ -8,4 +8,6 @@ urlpatterns = [
     url(r'^api/sign_up/$', SignUpView.as_view(), name='sign_up'),
     url(r'^api/log_in/$', LogInView.as_view(), name='log_in'),
     url(r'^api/log_out/$', LogOutView.as_view(), name='log_out'),
+    url(r'^api/drivers/available/$', AvailableDriversView.as_view(), name='available_drivers'),
+    url(r'^api/metrics/$', MetricsView.as_view(), name='metrics'),
 ]
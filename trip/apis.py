@@ -1,19 +1,43 @@
+from django.conf import settings
 from django.contrib.auth import login, logout
-from django.contrib.auth.forms import AuthenticationForm, UserCreationForm
+from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.models import Group
-from django.db.models import Q
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q, prefetch_related_objects
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.crypto import constant_time_compare
+from django.views import View
 from rest_framework import permissions, status, views, viewsets
 from rest_framework.authtoken.models import Token
+from rest_framework.renderers import BrowsableAPIRenderer
 from rest_framework.response import Response
-from .models import Trip
-from .serializers import PublicUserSerializer, PrivateUserSerializer, TripSerializer
+from .authentication import ensure_token, get_roles
+from .conditional import conditional_response, list_validators, set_validators, trip_validators
+from .exports import export_trips, filter_trips, ndjson
+from .forms import PooledUserCreationForm
+from .metrics import registry
+from .models import ArchivedTrip, Trip
+from .pagination import KeysetPagination
+from .passwords import password_pool
+from .presence import available_count
+from .renderers import TripJSONRenderer, trip_payloads
+from .serializers import (
+    PublicUserSerializer, PrivateUserSerializer, TripExportSerializer, TripSerializer, TripStatsSerializer
+)
+from .stats import driver_completed, hour_of, hourly_stats
+from .throttling import AddressRateThrottle, UsernameRateThrottle
 
 
 class SignUpView(views.APIView):
+    # New usernames are free to pick, so only the address is counted.
+    throttle_classes = (AddressRateThrottle,)
+    address_throttle_scope = 'sign_up'
+
     def post(self, *args, **kwargs):
+        password_pool.check_capacity()
         group = self.request.data.get('group', 'rider')
         user_group, _ = Group.objects.get_or_create(name=group)
-        form = UserCreationForm(data=self.request.data)
+        form = PooledUserCreationForm(data=self.request.data)
         if form.is_valid():
             user = form.save()
             user.groups.add(user_group)
@@ -24,12 +48,19 @@ class SignUpView(views.APIView):
 
 
 class LogInView(views.APIView):
+    throttle_classes = (AddressRateThrottle, UsernameRateThrottle)
+    address_throttle_scope = 'log_in_address'
+    throttle_scope = 'log_in'
+
     def post(self, *args, **kwargs):
+        # Passwords are checked by PooledModelBackend in `password_pool`; while
+        # it is full, answer 503 before running any queries.
+        password_pool.check_capacity()
         form = AuthenticationForm(data=self.request.data)
         if form.is_valid():
             user = form.get_user()
             login(self.request, user)
-            Token.objects.get_or_create(user=user)
+            ensure_token(user)
             return Response(PrivateUserSerializer(user).data)
         else:
             return Response(form.errors, status=status.HTTP_400_BAD_REQUEST)
@@ -44,18 +75,173 @@ class LogOutView(views.APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class AvailableDriversView(views.APIView):
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, *args, **kwargs):
+        return Response({'available': available_count()})
+
+
+class TripStatsView(views.APIView):
+    """
+    Trips requested, started, in progress and completed per hour between
+    `start` and `end`, with the average wait from request to start, plus the
+    requesting driver's completions. Answered from the `TripStats` buckets,
+    so the cost depends on the range asked for, not on how many trips exist.
+    """
+
+    permission_classes = (permissions.IsAuthenticated,)
+
+    def get(self, request, *args, **kwargs):
+        serializer = TripStatsSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        start, end = serializer.validated_data['start'], serializer.validated_data['end']
+        buckets = hourly_stats(start, end)
+        statuses = [status for status, _ in Trip.TRIP_STATUSES]
+        hours = []
+        for hour in sorted({hour for hour, _ in buckets}):
+            _, waits, waited = buckets.get((hour, Trip.STARTED), (0, 0, 0.0))
+            hours.append({
+                'hour': hour,
+                'counts': {status: buckets.get((hour, status), (0,))[0] for status in statuses},
+                'wait': _wait(waits, waited),
+            })
+        starts = [bucket for (_, status), bucket in buckets.items() if status == Trip.STARTED]
+        data = {
+            'start': hour_of(start),
+            'end': end,
+            'counts': {
+                status: sum(bucket[0] for (_, other), bucket in buckets.items() if other == status)
+                for status in statuses
+            },
+            'wait': _wait(sum(bucket[1] for bucket in starts), sum(bucket[2] for bucket in starts)),
+            'hours': hours,
+        }
+        if 'driver' in get_roles(request.user):
+            data['driver'] = {'completed': driver_completed(request.user, start, end)}
+        return Response(data)
+
+
+def _wait(count, seconds):
+    return {'count': count, 'average': seconds / count if count else None}
+
+
+class MetricsView(View):
+    """Served to staff users, and to scrapers sending `Authorization: Bearer <METRICS_TOKEN>`."""
+
+    def get(self, request, *args, **kwargs):
+        if not settings.METRICS_ENABLED:
+            raise Http404
+        if not (request.user.is_staff or _has_metrics_token(request)):
+            raise PermissionDenied
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _has_metrics_token(request):
+    token = settings.METRICS_TOKEN
+    return bool(token) and constant_time_compare(request.META.get('HTTP_AUTHORIZATION', ''), f'Bearer {token}')
+
+
 class TripView(viewsets.ReadOnlyModelViewSet):
     lookup_field = 'nk'
     lookup_url_kwarg = 'trip_nk'
+    pagination_class = KeysetPagination
     permission_classes = (permissions.IsAuthenticated,)
     queryset = Trip.objects.all()
+    renderer_classes = (TripJSONRenderer, BrowsableAPIRenderer)
     serializer_class = TripSerializer
 
+    def list(self, request, *args, **kwargs):
+        querysets = self.get_list_querysets()
+        # Polling clients usually get a 304 from one aggregate query over the
+        # rows the page would be read from, before any trips are loaded.
+        etag, last_modified = list_validators(
+            self.paginator.page_querysets(querysets, request), request.user.id, *sorted(request.query_params.items())
+        )
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+        page = self.paginate_queryset([queryset.select_related('driver', 'rider') for queryset in querysets])
+        # Trips whose current version is cached need neither their users' groups nor serializing.
+        rendered = [trip_payloads.get(trip.nk, trip.version) for trip in page]
+        missing = [trip for trip, cached in zip(page, rendered) if cached is None]
+        prefetch_related_objects(missing, 'driver__groups', 'rider__groups')
+        response = self.get_paginated_response([
+            (cached or trip_payloads.put(trip)).data for trip, cached in zip(page, rendered)
+        ])
+        return set_validators(response, etag, last_modified)
+
+    def retrieve(self, request, *args, **kwargs):
+        nk = self.kwargs[self.lookup_url_kwarg]
+        etag, last_modified, version = trip_validators([
+            self.get_queryset().prefetch_related(None).filter(nk=nk),
+            self.get_archived_queryset().filter(nk=nk),
+        ])
+        response = conditional_response(request, etag, last_modified)
+        if response is not None:
+            return response
+        # The version lookup has already found the trip among the user's, so a cached copy can be served as is.
+        rendered = trip_payloads.get(nk, version) if version is not None else None
+        if rendered is None:
+            try:
+                trip = self.get_object()
+            except Http404:
+                trip = self.get_archived_object()
+            rendered = trip_payloads.put(trip)
+        return set_validators(Response(rendered.data), etag, last_modified)
+
+    def export(self, request, *args, **kwargs):
+        # Streamed as newline-delimited JSON, one trip per line, a chunk of rows at a time.
+        serializer = TripExportSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        querysets = [filter_trips(queryset, **serializer.validated_data) for queryset in self.get_history_querysets()]
+        response = StreamingHttpResponse(ndjson(export_trips(querysets)), content_type='application/x-ndjson')
+        response['Content-Disposition'] = 'attachment; filename="trips.ndjson"'
+        return response
+
+    def get_archived_object(self):
+        queryset = self.get_archived_queryset().select_related('driver', 'rider').prefetch_related(
+            'driver__groups', 'rider__groups'
+        )
+        try:
+            return queryset.get(nk=self.kwargs[self.lookup_url_kwarg])
+        except ArchivedTrip.DoesNotExist:
+            raise Http404
+
+    def get_user_groups(self):
+        return get_roles(self.request.user)
+
+    def get_list_querysets(self):
+        # Drivers also see every open request, so they can pick one up.
+        if 'driver' in self.get_user_groups():
+            return [Trip.objects.requested()] + self.get_history_querysets()
+        return self.get_history_querysets()
+
+    def get_history_querysets(self):
+        """The live and archived trips the user drove or rode in."""
+        user = self.request.user
+        user_groups = self.get_user_groups()
+        if 'driver' in user_groups:
+            return [Trip.objects.filter(driver=user), self.get_archived_queryset()]
+        if 'rider' in user_groups:
+            return [Trip.objects.filter(rider=user), self.get_archived_queryset()]
+        return []
+
+    def get_archived_queryset(self):
+        user = self.request.user
+        user_groups = self.get_user_groups()
+        if 'driver' in user_groups:
+            return ArchivedTrip.objects.filter(driver=user)
+        if 'rider' in user_groups:
+            return ArchivedTrip.objects.filter(rider=user)
+        return ArchivedTrip.objects.none()
+
     def get_queryset(self):
         user = self.request.user
-        user_groups = [group.name for group in user.groups.all()]
+        user_groups = self.get_user_groups()
+        queryset = Trip.objects.select_related('driver', 'rider').prefetch_related('driver__groups', 'rider__groups')
         if 'driver' in user_groups:
-            return Trip.objects.filter(Q(status=Trip.REQUESTED) | Q(driver=user))
+            return queryset.filter(Q(status=Trip.REQUESTED) | Q(driver=user))
         if 'rider' in user_groups:
-            return Trip.objects.filter(rider=user)
-        return Trip.objects.none()
+            return queryset.filter(rider=user)
+        return queryset.none()
@@ -0,0 +1,46 @@
+from django.db import IntegrityError, connections, router, transaction
+from .models import ArchivedTrip, Trip
+
+ARCHIVE_BATCH_SIZE = 5000
+ARCHIVED_FIELDS = [field.attname for field in ArchivedTrip._meta.concrete_fields]
+
+
+def archive_trips(queryset=None, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Move completed trips from `queryset` (all trips by default) into the
+    archive, one transaction per batch of ids. Rows are copied with
+    INSERT ... SELECT, so they never pass through Python, skipping any that
+    another archiver already copied. Returns the number of trips moved.
+    """
+    queryset = (Trip.objects.all() if queryset is None else queryset).filter(status=Trip.COMPLETED).order_by()
+    using = router.db_for_write(Trip)
+    connection = connections[using]
+    columns = ', '.join(
+        connection.ops.quote_name(ArchivedTrip._meta.get_field(name).column) for name in ARCHIVED_FIELDS
+    )
+    archived, retried = 0, False
+    while True:
+        try:
+            with transaction.atomic(using=using):
+                ids = list(queryset.using(using).order_by('id').values_list('id', flat=True)[:batch_size])
+                if not ids:
+                    return archived
+                span = {'id__gte': ids[0], 'id__lte': ids[-1]}
+                archived_ids = ArchivedTrip.objects.using(using).filter(**span).values('id')
+                copied = queryset.using(using).filter(**span).exclude(id__in=archived_ids)
+                select, params = copied.values(*ARCHIVED_FIELDS).query.sql_with_params()
+                with connection.cursor() as cursor:
+                    cursor.execute(f'INSERT INTO {ArchivedTrip._meta.db_table} ({columns}) {select}', params)
+                # Only rows now in the archive are deleted, so a trip completed
+                # since the copy stays put for the next run. Completed is final,
+                # and deleting through the ORM sends the delete signals, which
+                # drop the trips from the payload cache.
+                _, deleted = Trip.objects.using(using).filter(id__in=archived_ids, **span).delete()
+        except IntegrityError:
+            # Another archiver copied some of these rows between the check and
+            # the insert; the next pass leaves them out. Twice in a row is not that.
+            if retried:
+                raise
+            retried = True
+            continue
+        archived, retried = archived + deleted.get(Trip._meta.label, 0), False
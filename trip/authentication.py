@@ -0,0 +1,142 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.backends import ModelBackend
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from .cache import LRUCache
+from .passwords import password_needs_update, password_pool
+
+GENERATION_KEY = 'auth-token-generation'
+
+
+def get_roles(user):
+    """The names of the user's groups, read once per user instance."""
+    roles = getattr(user, '_roles', None)
+    if roles is None:
+        roles = user._roles = frozenset(user.groups.values_list('name', flat=True))
+    return roles
+
+
+class TokenCache:
+    """
+    Maps token keys to `(token, generation)`, where `token.user` carries its
+    roles. Lookups go to an in-process LRU first, then to an optional shared
+    Django cache.
+
+    With a shared cache, every invalidation bumps a generation counter stored
+    there; local entries from an older generation are ignored, so other
+    processes stop trusting their copies immediately at the cost of one cache
+    read per request.
+    """
+
+    def __init__(self, max_size=10000, ttl=300, shared_cache=None):
+        self.ttl = ttl
+        self.local = LRUCache(max_size=max_size, ttl=ttl)
+        self.shared_cache = shared_cache
+
+    @property
+    def shared(self):
+        return caches[self.shared_cache] if self.shared_cache else None
+
+    def generation(self):
+        return self.shared.get_or_set(GENERATION_KEY, 0, timeout=None) if self.shared else 0
+
+    def get(self, key):
+        generation = self.generation()
+        entry = self.local.get(key)
+        if entry is not None and entry[1] == generation:
+            return entry[0]
+        token = self.shared.get(f'auth-token:{key}') if self.shared else None
+        if token is not None:
+            self.local.set(key, (token, generation))
+        return token
+
+    def set(self, key, token):
+        self.local.set(key, (token, self.generation()))
+        if self.shared:
+            self.shared.set(f'auth-token:{key}', token, timeout=self.ttl)
+
+    def invalidate(self, *keys):
+        for key in keys:
+            self.local.delete(key)
+        if self.shared:
+            self.shared.delete_many([f'auth-token:{key}' for key in keys])
+            self._bump_generation()
+
+    def clear(self):
+        self.local.clear()
+        if self.shared:
+            self._bump_generation()
+
+    def _bump_generation(self):
+        try:
+            self.shared.incr(GENERATION_KEY)
+        except ValueError:
+            self.shared.set(GENERATION_KEY, 1, timeout=None)
+
+
+token_cache = TokenCache(**settings.AUTH_TOKEN_CACHE)
+
+
+def invalidate_users(user_ids):
+    keys = list(Token.objects.filter(user_id__in=user_ids).values_list('key', flat=True))
+    if keys:
+        token_cache.invalidate(*keys)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Token authentication that serves repeat requests from `token_cache`, so a
+    cache hit costs no queries for the token, the user or the user's roles.
+    """
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            get_roles(user)
+            token_cache.set(key, token)
+        return token.user, token
+
+
+class PooledModelBackend(ModelBackend):
+    """
+    ModelBackend that checks passwords in `password_pool`, off the request
+    thread, and loads the user's token along with the user so a login needn't
+    look it up again. Raises `PasswordPoolBusy` when the pool is full.
+    """
+
+    def authenticate(self, request, username=None, password=None, **kwargs):
+        UserModel = get_user_model()
+        if username is None:
+            username = kwargs.get(UserModel.USERNAME_FIELD)
+        if username is None or password is None:
+            return None
+        try:
+            user = UserModel._default_manager.select_related('auth_token').get(**{UserModel.USERNAME_FIELD: username})
+        except UserModel.DoesNotExist:
+            # Hash anyway, so an unknown username takes as long to reject as a wrong password.
+            password_pool.make_password(password)
+            return None
+        if not password_pool.check_password(password, user.password) or not self.user_can_authenticate(user):
+            return None
+        if password_needs_update(user.password):
+            user.password = password_pool.make_password(password)
+            user.save(update_fields=['password'])
+        return user
+
+
+def ensure_token(user):
+    """The user's token, created on first login. No query when PooledModelBackend loaded the user."""
+    try:
+        return user.auth_token
+    except Token.DoesNotExist:
+        pass
+    try:
+        with transaction.atomic():
+            return Token.objects.create(user=user)
+    except IntegrityError:
+        # A concurrent login created it first.
+        return Token.objects.get(user=user)
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class LRUCache:
+    """
+    Thread-safe, bounded least-recently-used mapping. Entries older than `ttl`
+    seconds are treated as missing; `ttl=None` keeps them until evicted. With
+    `max_weight`, entries are also evicted while their total `weigh(value)`
+    is over it.
+    """
+
+    def __init__(self, max_size=1024, ttl=None, clock=time.monotonic, max_weight=None, weigh=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.weight = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or self.clock() - entry[1] < self.ttl):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def peek(self, key, default=None):
+        """Like `get`, without counting the lookup or refreshing the entry."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or self.clock() - entry[1] < self.ttl):
+                return entry[0]
+            return default
+
+    def items(self):
+        """A snapshot of the cached `(key, value)` pairs, least recently used first."""
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.entries.items()]
+
+    def set(self, key, value):
+        weight = self.weigh(value) if self.weigh is not None else 0
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (value, self.clock(), weight)
+            self.weight += weight
+            while len(self.entries) > self.max_size or (
+                self.max_weight is not None and self.weight > self.max_weight and self.entries
+            ):
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.weight -= evicted
+
+    def delete(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
@@ -0,0 +1,46 @@
+from django.conf import settings
+from django.core.checks import Error, Warning, register
+
+# Backends whose entries only the process that wrote them can see.
+PER_PROCESS_CACHES = [
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+]
+
+
+@register()
+def check_read_your_writes_cache(app_configs, **kwargs):
+    """
+    With replicas, a write pins its user's reads to the primary through
+    READ_YOUR_WRITES_CACHE; any process may serve their next request, so
+    that cache has to be one they all share.
+    """
+    backend = settings.CACHES.get(settings.READ_YOUR_WRITES_CACHE, {}).get('BACKEND')
+    if settings.DATABASE_REPLICAS and backend in PER_PROCESS_CACHES:
+        return [Error(
+            f'READ_YOUR_WRITES_CACHE {settings.READ_YOUR_WRITES_CACHE!r} is private to each process.',
+            hint='Point it at a cache every worker shares, such as memcached, or silence this check '
+                 'when a single process serves all requests and sockets.',
+            id='trip.E001',
+        )]
+    return []
+
+
+@register()
+def check_auth_token_cache(app_configs, **kwargs):
+    """
+    Cached tokens are only dropped everywhere on log out or group changes
+    when AUTH_TOKEN_CACHE shares them through a cache every process sees;
+    otherwise other processes accept a revoked token until it expires.
+    """
+    shared_cache = settings.AUTH_TOKEN_CACHE.get('shared_cache')
+    backend = settings.CACHES.get(shared_cache, {}).get('BACKEND') if shared_cache else None
+    if backend is None or backend in PER_PROCESS_CACHES:
+        return [Warning(
+            f'AUTH_TOKEN_CACHE shared cache {shared_cache!r} is private to each process, so logging out only '
+            f'revokes a token in the process that handled it.',
+            hint='Point it at a cache every worker shares, such as memcached, or silence this check '
+                 'when a single process serves all requests.',
+            id='trip.W001',
+        )]
+    return []
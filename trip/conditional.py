@@ -0,0 +1,96 @@
+import calendar
+import hashlib
+from django.db import connections, router
+from django.db.models.query import EmptyQuerySet
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import http_date, quote_etag
+from .models import Trip
+
+
+def trip_validators(querysets):
+    """
+    ETag and Last-Modified for a single trip found in any of `querysets`, from
+    its version and `updated` alone, followed by the version itself. Returns
+    `(None, None, None)` when it is missing.
+
+    Renaming the trip's driver or rider, or changing their groups, does not
+    change the trip's version, so clients holding an ETag keep their copy of
+    those nested users until the trip itself next changes.
+    """
+    combined = _combine(querysets)
+    rows = list(combined[:1]) if combined is not None else []
+    if not rows:
+        return None, None, None
+    nk, version, updated = rows[0]
+    return f'W/"{nk}-{version}"', _timestamp(updated), version
+
+
+def list_validators(pages, *keys):
+    """
+    ETag and Last-Modified for a page of trips, from one aggregate query over
+    `pages`, the slice of each queryset that the page is read from, so the
+    cost follows the page size rather than the user's trip history. A trip
+    updated, added to or dropped from the slices changes the newest `updated`,
+    the row count or the sums of versions and ids. `keys` (the cursor, the
+    page size, ...) tell apart different pages of the same rows. Nested users
+    are left out, as for `trip_validators`.
+    """
+    pages = [page for page in pages if not isinstance(page, EmptyQuerySet)]
+    if not pages:
+        return None, None
+    selects, params = [], []
+    for index, page in enumerate(pages):
+        select, page_params = page.values_list('id', 'version', 'updated').query.sql_with_params()
+        # Wrapped, since a LIMIT can't sit directly inside a compound SELECT on every backend.
+        selects.append(f'SELECT * FROM ({select}) page{index}')
+        params.extend(page_params)
+    with connections[router.db_for_read(Trip)].cursor() as cursor:
+        cursor.execute(
+            f'SELECT MAX(updated), COUNT(*), SUM(version), SUM(id) FROM ({" UNION ALL ".join(selects)}) trips', params
+        )
+        updated, count, versions, ids = cursor.fetchone()
+    updated = _as_datetime(updated)
+    fingerprint = ':'.join(str(key) for key in [updated and updated.isoformat(), count, versions, ids, *keys])
+    etag = f'W/"{hashlib.md5(fingerprint.encode("utf-8")).hexdigest()}"'
+    return etag, _timestamp(updated)
+
+
+def conditional_response(request, etag, last_modified):
+    """A 304 response when the client's copy is still current, otherwise None."""
+    if etag is None:
+        return None
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    return set_validators(response, etag, last_modified) if response is not None else None
+
+
+def set_validators(response, etag, last_modified):
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def _combine(querysets):
+    querysets = [
+        queryset.order_by().values_list('nk', 'version', 'updated')
+        for queryset in querysets if not isinstance(queryset, EmptyQuerySet)
+    ]
+    if not querysets:
+        return None
+    return querysets[0].union(*querysets[1:], all=True) if len(querysets) > 1 else querysets[0]
+
+
+def _as_datetime(value):
+    # Raw aggregates skip the backend's converters; SQLite returns text.
+    if isinstance(value, str):
+        value = parse_datetime(value)
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, timezone.utc)
+    return value
+
+
+def _timestamp(value):
+    return calendar.timegm(value.utctimetuple()) if value is not None else None
@@ -1,73 +1,313 @@
-from channels import Group
+import logging
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.utils.functional import cached_property
+from channels import Channel, Group
 from channels.generic.websockets import JsonWebsocketConsumer
+from .archive import archive_trips
+from .dispatch import decline, driver_group
+from .events import trip_events
+from .geo import DriverIndex
+from .locations import LocationBuffer
+from .metrics import count_error, observe_fanout, observe_group_fanout, socket_closed, socket_opened, track
 from .models import Trip
-from .serializers import TripSerializer
+from .payloads import DEFAULT_FORMAT, Format, encode, msgpack, trip_delta
+from .presence import (
+    available_channels, available_drivers, driver_connected, driver_disconnected, driver_heartbeat,
+    set_driver_available
+)
+from .renderers import encode_rendered, trip_payloads
+from .routers import read_your_writes
+from .serializers import (
+    LocationSerializer, OfferSerializer, ResumeSerializer, TripSerializer, TripStatusSerializer
+)
+from .stats import record_status
+from .subscriptions import format_closed, format_opened, formats_in_use, group_add_many, group_discard_many
+from .throttling import take_token
+
+logger = logging.getLogger(__name__)
+driver_index = DriverIndex(cell_size=settings.DISPATCH_CELL_SIZE)
+location_buffer = LocationBuffer(
+    flush_interval=settings.LOCATION_FLUSH_INTERVAL,
+    flush_size=settings.LOCATION_FLUSH_SIZE
+)
 
 
 class TripConsumer(JsonWebsocketConsumer):
     http_user_and_session = True
+    role = None
+
+    @property
+    def format(self):
+        """The update format the socket asked for in its connect query string."""
+        if self.message.channel.name == 'websocket.connect':
+            return Format.from_query_string(self.message.content.get('query_string', ''))
+        return Format(*self.message.channel_session.get('format', DEFAULT_FORMAT))
+
+    def dispatch(self, message, **kwargs):
+        with track(type(self).__name__, message.channel.name.replace('websocket.', '')):
+            # The channel session decorators set `message.user` on the way in.
+            with read_your_writes(lambda: getattr(message, 'user', None)):
+                return super().dispatch(message, **kwargs)
 
     def user_trips(self):
         raise NotImplementedError()
 
+    @cached_property
+    def user_trip_nks(self):
+        # Read fresh on every connect, from an index on the user's trips; a
+        # per-process cache would miss trips created or claimed through other workers.
+        return list(self.user_trips().values_list('nk', flat=True))
+
     def connect(self, message, **kwargs):
         self.message.reply_channel.send({'accept': True})
+        socket_opened(self.role)
+        if self.format != DEFAULT_FORMAT:
+            self.message.channel_session['format'] = list(self.format)
+        format_opened(self.format)
         if self.message.user.is_authenticated:
-            trip_nks = [trip.nk for trip in self.user_trips()]
-            self.message.channel_session['trip_nks'] = trip_nks
-            for trip_nk in trip_nks:
-                Group(trip_nk).add(self.message.reply_channel)
+            self.subscribe(self.user_trip_nks, replace=True)
 
     def disconnect(self, message, **kwargs):
-        for trip_nk in message.channel_session.get('trip_nks', []):
-            Group(trip_nk).discard(message.reply_channel)
+        socket_closed(self.role)
+        format_closed(self.format)
+        trip_groups = [self.format.group(trip_nk) for trip_nk in message.channel_session.get('trip_nks', [])]
+        group_discard_many(trip_groups, message.reply_channel.name)
+
+    def raw_receive(self, message, **kwargs):
+        if 'bytes' in message and msgpack is not None:
+            content = msgpack.unpackb(message['bytes'], raw=False)
+        elif 'text' in message:
+            content = self.decode_json(message['text'])
+        else:
+            return super().raw_receive(message, **kwargs)
+        if self.allow(content):
+            self.receive(content, **kwargs)
+
+    def allow(self, content):
+        """Spend a token for this message from the user's and the socket's buckets."""
+        kind = content.get('type') if content.get('type') in ('location', 'heartbeat') else 'message'
+        keys = [f'channel:{self.message.reply_channel.name}']
+        if self.message.user.is_authenticated:
+            # The user's bucket goes first, since the Redis limiter shards on it.
+            keys.insert(0, f'user:{self.message.user.id}')
+        retry_after = take_token(kind, keys)
+        if retry_after is None:
+            return True
+        count_error(type(self).__name__, 'RateLimited')
+        if kind == 'message':
+            self.send({'type': 'error', 'detail': 'Too many messages.', 'retry_after': round(retry_after, 1)})
+        return False
+
+    def send(self, content, close=False):
+        message = encode(content, self.format.encoding)
+        if close:
+            message['close'] = close
+        self.message.reply_channel.send(message)
+
+    def subscribe(self, trip_nks, replace=False):
+        """
+        Join the groups for `trip_nks` that this socket is not in yet. With
+        `replace`, also leave groups for trips that are no longer listed.
+        """
+        channel, format = self.message.reply_channel.name, self.format
+        current = self.message.channel_session.get('trip_nks', [])
+        added = [trip_nk for trip_nk in trip_nks if trip_nk not in current]
+        if replace:
+            removed = [trip_nk for trip_nk in current if trip_nk not in trip_nks]
+            group_discard_many([format.group(trip_nk) for trip_nk in removed], channel)
+            subscribed = list(trip_nks)
+        else:
+            subscribed = current + added
+        group_add_many([format.group(trip_nk) for trip_nk in added], channel)
+        if subscribed != current:
+            self.message.channel_session['trip_nks'] = subscribed
+
+    def broadcast(self, trip):
+        """
+        Send the trip to everyone following it and keep the update for replay.
+        Delta subscribers get only the fields changed since the previous
+        version, or the whole trip when that version is no longer buffered.
+        Returns the trip's `RenderedTrip`.
+        """
+        rendered = trip_payloads.render(trip)
+        previous = trip_events.get(trip.nk, trip.version - 1)
+        trip_events.append(trip.nk, trip.version, rendered.data)
+        # Formats no socket has open have nobody to send to.
+        formats = formats_in_use()
+        for format in formats:
+            if format.delta and previous is not None:
+                message = encode(trip_delta(previous, rendered.data), format.encoding)
+            else:
+                message = encode_rendered(rendered, format.encoding)
+            Group(format.group(trip.nk)).send(message)
+        observe_group_fanout('trip', [format.group(trip.nk) for format in formats])
+        return rendered
+
+    def resume(self, content):
+        """
+        Replay the updates a reconnecting client missed. The client sends the
+        last version it saw for each trip; trips whose updates are no longer
+        buffered are sent once in their current state.
+        """
+        serializer = ResumeSerializer(data=content)
+        serializer.is_valid(raise_exception=True)
+        subscribed = self.message.channel_session.get('trip_nks', [])
+        versions = {nk: version for nk, version in serializer.validated_data['trips'].items() if nk in subscribed}
+        stale = []
+        for nk, version in versions.items():
+            events = trip_events.since(nk, version)
+            if events is None:
+                stale.append(nk)
+                continue
+            for event in events:
+                self.send(event)
+        if stale:
+            trips = Trip.objects.filter(nk__in=stale).select_related('driver', 'rider').prefetch_related(
+                'driver__groups', 'rider__groups'
+            )
+            for trip in trips:
+                if trip.version > versions[trip.nk]:
+                    self.message.reply_channel.send(encode_rendered(trip_payloads.render(trip), self.format.encoding))
 
 
 class DriverConsumer(TripConsumer):
-    groups = ['drivers']
+    role = 'driver'
+
+    def connection_groups(self, **kwargs):
+        # Offers are never deltas; they only vary by encoding.
+        if self.message.user.is_authenticated:
+            return [self.format.group(driver_group(self.message.user.id), delta=False)]
+        return []
+
+    @property
+    def channel(self):
+        return self.message.reply_channel.name, self.format.encoding
 
     def user_trips(self):
         return self.message.user.trips_as_driver.exclude(status=Trip.COMPLETED)
 
     def connect(self, message, **kwargs):
         super().connect(message, **kwargs)
-        Group('drivers').add(self.message.reply_channel)
+        if message.user.is_authenticated:
+            driver_connected(message.user.id, self.channel, available=not self.user_trip_nks)
+
+    def disconnect(self, message, **kwargs):
+        super().disconnect(message, **kwargs)
+        if message.user.is_authenticated:
+            driver_index.remove(message.user.id, channel=self.channel)
+            driver_disconnected(message.user.id, self.channel)
 
     def receive(self, content, **kwargs):
-        """Drivers should send trip status updates."""
+        """
+        Drivers should send their location, heartbeats, trip status updates or
+        declined offers. Any of them keeps the driver online.
+        """
+        driver_heartbeat(self.message.user.id)
+        if content.get('type') == 'heartbeat':
+            return
+        if content.get('type') == 'resume':
+            self.resume(content)
+        elif content.get('type') == 'location':
+            self.update_location(content)
+        elif content.get('type') == 'decline':
+            self.decline_offer(content)
+        else:
+            self.update_trip(content)
 
-        # Update an existing trip from the incoming data.
-        trip = Trip.objects.get(nk=content.get('nk'))
-        serializer = TripSerializer(data=content)
+    def update_location(self, content):
+        serializer = LocationSerializer(data=content)
         serializer.is_valid(raise_exception=True)
-        trip = serializer.update(trip, serializer.validated_data)
+        latitude = serializer.validated_data['latitude']
+        longitude = serializer.validated_data['longitude']
+        driver_index.update(self.message.user.id, latitude, longitude, self.channel)
+        location_buffer.add(self.message.user.id, latitude, longitude)
+
+    def decline_offer(self, content):
+        serializer = OfferSerializer(data=content)
+        serializer.is_valid(raise_exception=True)
+        decline(serializer.validated_data['nk'], self.message.user)
+
+    def update_trip(self, content):
+        # Move an existing trip to its next status, unless another driver got there first.
+        serializer = TripStatusSerializer(data=content)
+        serializer.is_valid(raise_exception=True)
+        nk, status = serializer.validated_data['nk'], serializer.validated_data['status']
+        offered = settings.DISPATCH_MODE == 'batch'
+        # The stats count the change exactly when it is made.
+        with transaction.atomic():
+            moved = Trip.objects.transition(nk, status, driver=self.message.user, offered=offered)
+            if moved:
+                trip = Trip.objects.select_related('driver', 'rider').get(nk=nk)
+                record_status(trip)
+        if not moved:
+            self.send({'type': 'error', 'nk': nk, 'detail': f'Trip cannot be moved to {status}.'})
+            count_error(type(self).__name__, 'TransitionRejected')
+            return
 
         # Subscribe driver to messages regarding the existing trip.
         # Driver will receive updates about existing trip.
-        self.message.channel_session['trip_nks'].append(trip.nk)
-        Group(trip.nk).add(self.message.reply_channel)
-        trips_data = TripSerializer(trip).data
-        self.group_send(name=trip.nk, content=trips_data)
+        self.subscribe([trip.nk])
+        self.broadcast(trip)
+        if trip.status == Trip.STARTED:
+            set_driver_available(self.message.user.id, False)
+        elif trip.status == Trip.COMPLETED:
+            # Registers this socket again too, in case the driver expired during a long trip.
+            driver_connected(self.message.user.id, self.channel, available=True)
+        if trip.status == Trip.COMPLETED and settings.TRIP_ARCHIVE_ON_COMPLETE:
+            try:
+                archive_trips(Trip.objects.filter(id=trip.id))
+            except DatabaseError:
+                # The update has gone out already; the next `archive_trips` run moves the trip.
+                logger.exception('Could not archive trip %s on completion.', trip.nk)
 
 
 class RiderConsumer(TripConsumer):
+    role = 'rider'
+
     def user_trips(self):
         return self.message.user.trips_as_rider.exclude(status=Trip.COMPLETED)
 
     def receive(self, content, **kwargs):
         """Riders should only ever send a request to create a new Trip."""
+        if content.get('type') == 'resume':
+            self.resume(content)
+            return
 
         # Create a new trip from the incoming data.
         serializer = TripSerializer(data=content)
         serializer.is_valid(raise_exception=True)
-        trip = serializer.create(serializer.validated_data)
+        trip = serializer.save(rider=self.message.user)
 
         # Subscribe rider to messages regarding the newly created trip.
         # Rider will receive updates from driver.
-        self.message.channel_session['trip_nks'].append(trip.nk)
-        Group(trip.nk).add(self.message.reply_channel)
-        trips_data = TripSerializer(trip).data
-        self.group_send(name=trip.nk, content=trips_data)
+        self.subscribe([trip.nk])
+        rendered = self.broadcast(trip)
+
+        # Alert nearby drivers that a new trip has been requested, unless the
+        # batch dispatcher is going to offer it to one of them.
+        if settings.DISPATCH_MODE != 'batch':
+            self.alert_drivers(trip, rendered)
 
-        # Alert all drivers that a new trip has been requested.
-        self.group_send(name='drivers', content=trips_data)
+    def alert_drivers(self, trip, rendered):
+        # Only drivers online and not on a trip are alerted. Trips without
+        # pick-up coordinates cannot be matched, and trips with no available
+        # driver nearby would go unseen, so all of them hear about those.
+        messages = {}
+        channels, kind = [], 'nearby'
+        if trip.pick_up_latitude is not None and trip.pick_up_longitude is not None:
+            drivers = driver_index.nearby(
+                trip.pick_up_latitude,
+                trip.pick_up_longitude,
+                radius=settings.DISPATCH_RADIUS,
+                limit=settings.DISPATCH_MAX_DRIVERS
+            )
+            available = available_drivers([driver_id for _, driver_id, _ in drivers])
+            channels = [channel for _, driver_id, channel in drivers if driver_id in available]
+        if not channels:
+            channels, kind = available_channels(), 'drivers'
+        for channel, encoding in channels:
+            if encoding not in messages:
+                messages[encoding] = encode_rendered(rendered, encoding)
+            Channel(channel).send(messages[encoding])
+        observe_fanout(kind, len(channels))
@@ -0,0 +1,177 @@
+import datetime
+from collections import defaultdict
+from channels import Group
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, DateTimeField, IntegerField, Q, Value, When
+from django.utils import timezone
+from .geo import KM_PER_DEGREE, DriverIndex
+from .models import DriverLocation, Trip
+from .payloads import FORMATS, encode
+from .presence import available_drivers
+from .serializers import serialize_trip
+from .subscriptions import formats_in_use
+
+UPDATE_BATCH_SIZE = 100
+# The dispatcher builds its own driver index every tick, with cells about a
+# kilometer across so that a nearest-drivers search stays local.
+MATCH_CELL_SIZE = 0.01
+
+
+def driver_group(driver_id):
+    """The group holding all of one driver's sockets, for messages meant only for them."""
+    return f'driver-{driver_id}'
+
+
+def match(trips, index, radius, candidates=10, excluded=None):
+    """
+    Pair `(trip_id, latitude, longitude)` trips with drivers in `index`,
+    shortest pick-up first. Each trip considers its `candidates` nearest
+    drivers within `radius` km, minus `excluded[trip_id]`, so the cost of a
+    tick grows with the number of trips rather than trips times drivers.
+    Returns `(trip_id, driver_id, distance)` tuples.
+    """
+    excluded = excluded or {}
+    edges = []
+    for trip_id, latitude, longitude in trips:
+        passed = excluded.get(trip_id, ())
+        nearby = _nearest(index, latitude, longitude, radius, candidates + len(passed))
+        edges.extend((distance, trip_id, driver_id) for distance, driver_id, _ in nearby if driver_id not in passed)
+    edges.sort()
+    matched_trips, matched_drivers, assignments = set(), set(), []
+    for distance, trip_id, driver_id in edges:
+        if trip_id in matched_trips or driver_id in matched_drivers:
+            continue
+        matched_trips.add(trip_id)
+        matched_drivers.add(driver_id)
+        assignments.append((trip_id, driver_id, distance))
+    return assignments
+
+
+def has_pick_up(latitude, longitude):
+    return latitude is not None and longitude is not None
+
+
+def _nearest(index, latitude, longitude, radius, limit):
+    # Most pick-ups have enough drivers close by; widen the search only when they don't.
+    search = min(radius, index.cell_size * KM_PER_DEGREE)
+    while True:
+        nearby = index.nearby(latitude, longitude, radius=search, limit=limit)
+        if len(nearby) >= limit or search >= radius:
+            return nearby
+        search = min(radius, search * 2)
+
+
+class BatchDispatcher:
+    """
+    Offers open trip requests to drivers in batches instead of letting the
+    first driver to answer a broadcast take them. Every tick gathers the
+    requested trips without a live offer and the drivers who are online and
+    available, neither on a trip nor holding an offer, pairs them with
+    `match` by their last reported positions, stores the offers on the trips
+    and sends each one to its driver alone. As with broadcast alerts, trips
+    without pick-up coordinates or with nobody in range go to any driver left
+    over. Only the offered driver can claim the trip until the offer expires;
+    a lapsed or declined offer goes to someone else next tick.
+    """
+
+    def __init__(self, radius=None, candidates=None, offer_timeout=None, location_max_age=None):
+        self.radius = radius or settings.DISPATCH_RADIUS
+        self.candidates = candidates or settings.DISPATCH_CANDIDATES
+        self.offer_timeout = offer_timeout or settings.DISPATCH_OFFER_TIMEOUT
+        self.location_max_age = location_max_age or settings.DISPATCH_LOCATION_MAX_AGE
+        # Drivers who let an offer for each trip lapse or declined it.
+        self.passed = defaultdict(set)
+
+    def tick(self, now=None):
+        """Make one round of offers; returns the `(trip_id, driver_id, distance)` pairs offered."""
+        now = now or timezone.now()
+        trips = self.open_trips(now)
+        drivers = self.free_drivers(now)
+        index = self.driver_index(drivers, now)
+        located = [trip[:3] for trip in trips if has_pick_up(*trip[1:3])]
+        assignments = match(located, index, radius=self.radius, candidates=self.candidates, excluded=self.passed)
+        assignments += self.fall_back(trips, index, drivers - {driver_id for _, driver_id, _ in assignments})
+        if assignments:
+            self.offer(assignments, now + datetime.timedelta(seconds=self.offer_timeout))
+        open_ids = {trip_id for trip_id, _, _, _ in trips}
+        for trip_id in list(self.passed):
+            if trip_id not in open_ids:
+                del self.passed[trip_id]
+        return assignments
+
+    def open_trips(self, now):
+        # Oldest first, so the fallback serves the longest waiting riders first.
+        trips = list(Trip.objects.requested().filter(
+            Q(offer_expires__isnull=True) | Q(offer_expires__lte=now)
+        ).order_by('id').values_list('id', 'pick_up_latitude', 'pick_up_longitude', 'offered_to_id'))
+        for trip_id, _, _, offered_to_id in trips:
+            if offered_to_id is not None:
+                self.passed[trip_id].add(offered_to_id)
+        return trips
+
+    def free_drivers(self, now):
+        """Ids of the drivers online and available, less any holding a live offer."""
+        offered = Trip.objects.requested().filter(offer_expires__gt=now).values_list('offered_to_id', flat=True)
+        return available_drivers() - set(offered)
+
+    def driver_index(self, drivers, now):
+        index = DriverIndex(cell_size=MATCH_CELL_SIZE)
+        locations = DriverLocation.objects.filter(
+            updated__gte=now - datetime.timedelta(seconds=self.location_max_age)
+        ).values_list('driver_id', 'latitude', 'longitude')
+        for driver_id, latitude, longitude in locations:
+            if driver_id in drivers:
+                index.update(driver_id, latitude, longitude, None)
+        return index
+
+    def fall_back(self, trips, index, drivers):
+        """
+        Pair trips that `match` cannot place, those without pick-up
+        coordinates or with no driver in range, with any of `drivers`.
+        Returns `(trip_id, driver_id, None)` tuples.
+        """
+        spare, assignments = sorted(drivers), []
+        for trip_id, latitude, longitude, _ in trips:
+            if not spare:
+                break
+            if has_pick_up(latitude, longitude) and index.nearby(latitude, longitude, radius=self.radius, limit=1):
+                continue
+            passed = self.passed.get(trip_id, ())
+            driver_id = next((driver_id for driver_id in spare if driver_id not in passed), None)
+            if driver_id is not None:
+                spare.remove(driver_id)
+                assignments.append((trip_id, driver_id, None))
+        return assignments
+
+    def offer(self, assignments, expires):
+        offers = {trip_id: driver_id for trip_id, driver_id, _ in assignments}
+        trip_ids = sorted(offers)
+        # Offers are never deltas, so only the encodings some socket has open matter.
+        encodings = {format.encoding for format in formats_in_use()}
+        formats = [format for format in FORMATS if not format.delta and format.encoding in encodings]
+        for start in range(0, len(trip_ids), UPDATE_BATCH_SIZE):
+            batch = trip_ids[start:start + UPDATE_BATCH_SIZE]
+            with transaction.atomic():
+                # Trips claimed or cancelled since they were read get no offer.
+                Trip.objects.requested().filter(id__in=batch).update(
+                    offered_to=Case(
+                        *[When(id=trip_id, then=Value(offers[trip_id])) for trip_id in batch],
+                        output_field=IntegerField()
+                    ),
+                    offer_expires=Value(expires, output_field=DateTimeField()),
+                )
+                trips = list(Trip.objects.requested().filter(id__in=batch, offer_expires=expires).select_related(
+                    'driver', 'rider'
+                ).prefetch_related('driver__groups', 'rider__groups'))
+            for trip in trips:
+                content = {'type': 'offer', 'expires_in': self.offer_timeout, 'trip': serialize_trip(trip)}
+                for format in formats:
+                    Group(format.group(driver_group(trip.offered_to_id))).send(encode(content, format.encoding))
+
+
+def decline(nk, driver):
+    """End `driver`'s offer for trip `nk` now, so the next tick offers it to someone else."""
+    return Trip.objects.requested().filter(
+        nk=nk, offered_to=driver, offer_expires__gt=timezone.now()
+    ).update(offer_expires=timezone.now()) == 1
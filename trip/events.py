@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.cache import cache
+
+
+class TripEventLog:
+    """
+    Bounded replay buffer of the payloads broadcast for each trip, keyed by
+    the trip's version. Reconnecting clients ask for everything after the
+    last version they saw instead of reloading the trip over REST.
+    """
+
+    def __init__(self, size=50, timeout=3600):
+        self.size = size
+        self.timeout = timeout
+
+    def key(self, nk):
+        return f'trip-events:{nk}'
+
+    def append(self, nk, version, payload):
+        events = [event for event in cache.get(self.key(nk), []) if event[0] != version]
+        events.append((version, payload))
+        events.sort(key=lambda event: event[0])
+        cache.set(self.key(nk), events[-self.size:], self.timeout)
+
+    def get(self, nk, version):
+        for event_version, payload in cache.get(self.key(nk), []):
+            if event_version == version:
+                return payload
+        return None
+
+    def since(self, nk, version):
+        """
+        Payloads newer than `version`, oldest first, or None when the buffer
+        no longer holds an unbroken run of them.
+        """
+        events = cache.get(self.key(nk))
+        if not events or events[-1][0] < version:
+            return None
+        events = [event for event in events if event[0] > version]
+        expected = version + 1
+        for event_version, _ in events:
+            if event_version != expected:
+                return None
+            expected += 1
+        return [payload for _, payload in events]
+
+
+trip_events = TripEventLog(**settings.TRIP_EVENT_LOG)
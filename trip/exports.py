@@ -0,0 +1,148 @@
+import heapq
+import json
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models import Case, DateTimeField, Value, When, prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+from .models import ArchivedTrip, Trip
+from .pagination import after
+from .serializers import serialize_trip
+from .stats import count_trips
+
+EXPORT_CHUNK_SIZE = 1000
+# Keeps the nk and username IN lists under SQLite's 999 parameter limit.
+IMPORT_BATCH_SIZE = 400
+UPDATE_BATCH_SIZE = 100
+IMPORTED_FIELDS = (
+    'nk', 'pick_up_address', 'drop_off_address', 'pick_up_latitude', 'pick_up_longitude', 'drop_off_latitude',
+    'drop_off_longitude', 'distance', 'duration', 'fare', 'status', 'version',
+)
+
+
+def filter_trips(queryset, start=None, end=None):
+    if start is not None:
+        queryset = queryset.filter(created__gte=start)
+    if end is not None:
+        queryset = queryset.filter(created__lt=end)
+    return queryset
+
+
+def iter_trips(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Every trip in `queryset` in `(created, id)` order, read one keyset page
+    of `chunk_size` rows at a time. Memory stays flat however many rows
+    match, including on backends that can't stream from a server-side cursor.
+    """
+    queryset = queryset.select_related('driver', 'rider').order_by('created', 'id')
+    page = list(queryset[:chunk_size])
+    while page:
+        prefetch_related_objects(page, 'driver__groups', 'rider__groups')
+        yield from page
+        if len(page) < chunk_size:
+            return
+        page = list(after(queryset, page[-1].created, page[-1].id)[:chunk_size])
+
+
+def export_trips(querysets, chunk_size=EXPORT_CHUNK_SIZE):
+    """Trips from all of `querysets` as one `(created, id)` ordered stream, each trip once."""
+    last_id = None
+    streams = [iter_trips(queryset, chunk_size) for queryset in querysets]
+    for trip in heapq.merge(*streams, key=lambda trip: (trip.created, trip.id)):
+        # A trip archived mid-export can turn up in both tables, side by side.
+        if trip.id != last_id:
+            yield trip
+        last_id = trip.id
+
+
+def ndjson(trips):
+    for trip in trips:
+        yield json.dumps(serialize_trip(trip)) + '\n'
+
+
+def import_trips(lines, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Load NDJSON trips, as written by `ndjson`, with a few statements per
+    `batch_size` rows. Trips whose nk already exists, or came earlier in the
+    input, are skipped; drivers and riders are matched by username and
+    created when missing. The hourly stats count the created trips as
+    `rebuild_stats` would. Returns the numbers of trips created and skipped.
+    """
+    imported, skipped, batch = 0, 0, []
+    for line in lines:
+        if line.strip():
+            batch.append(json.loads(line))
+        if len(batch) == batch_size:
+            created = _import_batch(batch)
+            imported, skipped, batch = imported + created, skipped + len(batch) - created, []
+    if batch:
+        created = _import_batch(batch)
+        imported, skipped = imported + created, skipped + len(batch) - created
+    return imported, skipped
+
+
+def _import_batch(rows):
+    # The first copy of an nk repeated within the batch wins.
+    unique = {}
+    for row in rows:
+        unique.setdefault(row['nk'], row)
+    rows = list(unique.values())
+    with transaction.atomic():
+        nks = [row['nk'] for row in rows]
+        existing = set(Trip.objects.filter(nk__in=nks).values_list('nk', flat=True))
+        existing.update(ArchivedTrip.objects.filter(nk__in=nks).values_list('nk', flat=True))
+        rows = [row for row in rows if row['nk'] not in existing]
+        user_ids = _user_ids([row[role] for row in rows for role in ('driver', 'rider') if row.get(role)])
+        Trip.objects.bulk_create([
+            Trip(
+                driver_id=user_ids.get((row.get('driver') or {}).get('username')),
+                rider_id=user_ids.get((row.get('rider') or {}).get('username')),
+                **{name: row.get(name) for name in IMPORTED_FIELDS}
+            )
+            for row in rows
+        ], batch_size=UPDATE_BATCH_SIZE)
+        # bulk_create stamps `created` and `updated` with the current time;
+        # put the exported timestamps back.
+        for start in range(0, len(rows), UPDATE_BATCH_SIZE):
+            batch = rows[start:start + UPDATE_BATCH_SIZE]
+            Trip.objects.filter(nk__in=[row['nk'] for row in batch]).update(
+                created=_case(batch, 'created'),
+                updated=_case(batch, 'updated'),
+            )
+        count_trips(Trip.objects.filter(nk__in=[row['nk'] for row in rows]).values_list(
+            'created', 'updated', 'status', 'driver_id'
+        ))
+    return len(rows)
+
+
+def _user_ids(users):
+    """Map usernames to ids, creating users that don't exist yet with their groups."""
+    User = get_user_model()
+    users = {user['username']: user for user in users}
+    user_ids = dict(User.objects.filter(username__in=list(users)).values_list('username', 'id'))
+    missing = [username for username in users if username not in user_ids]
+    if not missing:
+        return user_ids
+    User.objects.bulk_create([User(username=username, password=make_password(None)) for username in missing])
+    created = dict(User.objects.filter(username__in=missing).values_list('username', 'id'))
+    user_ids.update(created)
+    group_names = {name for username in missing for name in users[username].get('groups', [])}
+    for name in group_names - set(Group.objects.filter(name__in=group_names).values_list('name', flat=True)):
+        Group.objects.create(name=name)
+    group_ids = dict(Group.objects.filter(name__in=group_names).values_list('name', 'id'))
+    User.groups.through.objects.bulk_create([
+        User.groups.through(user_id=created[username], group_id=group_ids[name])
+        for username in missing for name in users[username].get('groups', [])
+    ])
+    return user_ids
+
+
+def _case(rows, name):
+    return Case(
+        *[
+            When(nk=row['nk'], then=Value(parse_datetime(row[name]), output_field=DateTimeField()))
+            for row in rows
+        ],
+        output_field=DateTimeField()
+    )
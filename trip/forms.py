@@ -0,0 +1,14 @@
+from django.contrib.auth.forms import UserCreationForm
+from .passwords import password_pool
+
+
+class PooledUserCreationForm(UserCreationForm):
+    """UserCreationForm that hashes the new password in `password_pool`."""
+
+    def save(self, commit=True):
+        # Skip UserCreationForm.save, which would hash on this thread.
+        user = super(UserCreationForm, self).save(commit=False)
+        user.password = password_pool.make_password(self.cleaned_data['password1'])
+        if commit:
+            user.save()
+        return user
@@ -0,0 +1,95 @@
+import math
+import threading
+from collections import defaultdict
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great-circle distance between two points, in kilometers."""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2 +
+         math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class DriverIndex:
+    """
+    In-process spatial index of driver positions, bucketed into square grid
+    cells of `cell_size` degrees. Moving a driver only touches the cell it left
+    and the cell it entered, and a radius query only visits the cells that
+    overlap the search circle. Safe to share between worker threads.
+    """
+
+    def __init__(self, cell_size=0.05):
+        self.cell_size = cell_size
+        self.cells = defaultdict(dict)
+        self.drivers = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.drivers)
+
+    def __contains__(self, driver_id):
+        return driver_id in self.drivers
+
+    def clear(self):
+        with self.lock:
+            self.cells.clear()
+            self.drivers.clear()
+
+    def cell(self, latitude, longitude):
+        return int(math.floor(latitude / self.cell_size)), int(math.floor(longitude / self.cell_size))
+
+    def update(self, driver_id, latitude, longitude, channel):
+        cell = self.cell(latitude, longitude)
+        with self.lock:
+            previous = self.drivers.get(driver_id)
+            if previous is not None and previous[0] != cell:
+                self._discard(previous[0], driver_id)
+            self.cells[cell][driver_id] = (latitude, longitude, channel)
+            self.drivers[driver_id] = (cell, latitude, longitude, channel)
+
+    def remove(self, driver_id, channel=None):
+        """Forget a driver; if `channel` is given, only when it is still the driver's channel."""
+        with self.lock:
+            previous = self.drivers.get(driver_id)
+            if previous is None or (channel is not None and previous[3] != channel):
+                return
+            del self.drivers[driver_id]
+            self._discard(previous[0], driver_id)
+
+    def position(self, driver_id):
+        previous = self.drivers.get(driver_id)
+        return None if previous is None else previous[1:3]
+
+    def nearby(self, latitude, longitude, radius, limit=None):
+        """
+        Return `(distance, driver_id, channel)` tuples for drivers within
+        `radius` kilometers, nearest first, truncated to `limit` entries.
+        """
+        lat_span = radius / KM_PER_DEGREE
+        lon_span = radius / (KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+        min_row, min_col = self.cell(latitude - lat_span, longitude - lon_span)
+        max_row, max_col = self.cell(latitude + lat_span, longitude + lon_span)
+        found = []
+        with self.lock:
+            for row in range(min_row, max_row + 1):
+                for col in range(min_col, max_col + 1):
+                    bucket = self.cells.get((row, col))
+                    if not bucket:
+                        continue
+                    for driver_id, (lat, lon, channel) in bucket.items():
+                        distance = haversine(latitude, longitude, lat, lon)
+                        if distance <= radius:
+                            found.append((distance, driver_id, channel))
+        found.sort(key=lambda item: item[0])
+        return found if limit is None else found[:limit]
+
+    def _discard(self, cell, driver_id):
+        bucket = self.cells.get(cell)
+        if bucket is not None:
+            bucket.pop(driver_id, None)
+            if not bucket:
+                del self.cells[cell]
@@ -0,0 +1,187 @@
+import hashlib
+import re
+from collections import namedtuple
+from decimal import ROUND_HALF_UP, Decimal
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_string
+from .cache import LRUCache
+from .geo import haversine
+from .models import Address, Route
+
+Location = namedtuple('Location', ['latitude', 'longitude'])
+Estimate = namedtuple('Estimate', ['distance', 'duration'])
+
+
+def normalize_address(address):
+    """Lower case, without punctuation or repeated spaces, so spellings of one address share a cache entry."""
+    return ' '.join(re.sub(r'[^\w\s]', ' ', address.lower()).split())
+
+
+class Provider:
+    """
+    Geocoding and routing service. Either method may return None when the
+    service has no answer.
+    """
+
+    def geocode(self, address):
+        """The `Location` of `address`."""
+        raise NotImplementedError()
+
+    def route(self, origin, destination):
+        """The driving `Estimate` in kilometers and seconds between two `Location`s."""
+        raise NotImplementedError()
+
+
+class LocalProvider(Provider):
+    """
+    Deterministic stand-in for tests and development. Each address lands at a
+    point inside `bounds` picked by a hash of its text, and each route is the
+    straight-line distance stretched by `detour` at a steady `speed` (km/h).
+    """
+
+    def __init__(self, bounds=((40.55, 40.90), (-74.10, -73.70)), detour=1.3, speed=30.0):
+        self.bounds = bounds
+        self.detour = detour
+        self.speed = speed
+
+    def geocode(self, address):
+        digest = hashlib.sha1(address.encode('utf-8')).digest()
+        (south, north), (west, east) = self.bounds
+        return Location(
+            south + (north - south) * int.from_bytes(digest[:8], 'big') / 2 ** 64,
+            west + (east - west) * int.from_bytes(digest[8:16], 'big') / 2 ** 64,
+        )
+
+    def route(self, origin, destination):
+        distance = haversine(*origin, *destination) * self.detour
+        return Estimate(distance, round(distance / self.speed * 3600))
+
+
+class Geocoder:
+    """
+    Puts `provider` behind two caches: an in-process LRU, then the `Address`
+    and `Route` tables shared by every process. The provider is only asked
+    about addresses and routes neither cache knows. Addresses and routes it
+    has no answer for are remembered for `miss_ttl` seconds only, in the LRU
+    alone, so the provider is asked again once it may have recovered.
+    """
+
+    def __init__(self, provider=None, cache_size=10000, miss_ttl=300):
+        self._provider = provider
+        self.addresses = LRUCache(max_size=cache_size)
+        self.routes = LRUCache(max_size=cache_size)
+        self.misses = LRUCache(max_size=cache_size, ttl=miss_ttl)
+        self.provider_calls = 0
+
+    @property
+    def provider(self):
+        if isinstance(self._provider, str):
+            self._provider = import_string(self._provider)()
+        return self._provider
+
+    @property
+    def enabled(self):
+        return self._provider is not None
+
+    def locate(self, *addresses):
+        """Map each normalized address to its `Location`, or to None when it can't be placed."""
+        locations = {}
+        for address in addresses:
+            location = self.addresses.get(address)
+            if location is not None or address in self.misses:
+                locations[address] = location
+        missing = [address for address in addresses if address not in locations]
+        if missing:
+            for address in Address.objects.filter(normalized__in=missing):
+                locations[address.normalized] = Location(address.latitude, address.longitude)
+            for address in missing:
+                if address not in locations:
+                    locations[address] = self._geocode(address)
+                if locations[address] is None:
+                    self.misses.set(address, True)
+                else:
+                    self.addresses.set(address, locations[address])
+        return locations
+
+    def estimate(self, origin, destination, locations):
+        """The `Estimate` between two normalized addresses, or None when either can't be placed."""
+        if locations[origin] is None or locations[destination] is None:
+            return None
+        estimate = self.routes.get((origin, destination))
+        if estimate is None and (origin, destination) not in self.misses:
+            route = Route.objects.filter(origin=origin, destination=destination).first()
+            if route is not None:
+                estimate = Estimate(route.distance, route.duration)
+            else:
+                estimate = self._route(origin, destination, locations)
+            if estimate is not None:
+                self.routes.set((origin, destination), estimate)
+            else:
+                self.misses.set((origin, destination), True)
+        return estimate
+
+    def trip_fields(self, pick_up_address, drop_off_address, **data):
+        """
+        Coordinates and estimates for a new trip, leaving out coordinates that
+        `data` already has. Nothing is looked up while no provider is set.
+        """
+        if not self.enabled:
+            return {}
+        pick_up, drop_off = normalize_address(pick_up_address), normalize_address(drop_off_address)
+        locations = self.locate(pick_up, drop_off)
+        fields = {}
+        for prefix, address in [('pick_up', pick_up), ('drop_off', drop_off)]:
+            location = locations[address]
+            if location is not None and data.get(f'{prefix}_latitude') is None:
+                fields[f'{prefix}_latitude'], fields[f'{prefix}_longitude'] = location
+        estimate = self.estimate(pick_up, drop_off, locations)
+        if estimate is not None:
+            fields.update(distance=estimate.distance, duration=estimate.duration, fare=fare(estimate))
+        return fields
+
+    def clear(self):
+        self.addresses.clear()
+        self.routes.clear()
+        self.misses.clear()
+
+    def _geocode(self, address):
+        self.provider_calls += 1
+        location = self.provider.geocode(address)
+        if location is not None:
+            location = Location(*location)
+            _create_once(Address, normalized=address, latitude=location.latitude, longitude=location.longitude)
+        return location
+
+    def _route(self, origin, destination, locations):
+        self.provider_calls += 1
+        estimate = self.provider.route(locations[origin], locations[destination])
+        if estimate is not None:
+            estimate = Estimate(*estimate)
+            _create_once(
+                Route, origin=origin, destination=destination, distance=estimate.distance, duration=estimate.duration
+            )
+        return estimate
+
+
+def _create_once(model, **fields):
+    # Another process may have stored the same answer first; either copy will do.
+    try:
+        with transaction.atomic():
+            model.objects.create(**fields)
+    except IntegrityError:
+        pass
+
+
+def fare(estimate):
+    """Base fare plus per-kilometer and per-minute rates from TRIP_FARE, to the cent."""
+    rates = {name: Decimal(rate) for name, rate in settings.TRIP_FARE.items()}
+    amount = (
+        rates['base'] +
+        rates['per_km'] * Decimal(str(estimate.distance)) +
+        rates['per_minute'] * Decimal(estimate.duration) / 60
+    )
+    return amount.quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
+geocoder = Geocoder(**settings.GEOCODING)
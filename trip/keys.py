@@ -0,0 +1,58 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+RANDOM_BITS = 80
+RANDOM_MAX = (1 << RANDOM_BITS) - 1
+
+
+class TimeOrderedKeys:
+    """
+    ULID-like 128-bit keys: 48 bits of milliseconds since the epoch followed
+    by 80 random bits, as 32 hex characters. Keys sort in creation order, so
+    inserts append to the right edge of the `nk` index instead of splitting
+    pages all over it. Within one millisecond the random part is incremented
+    rather than redrawn, so a process never repeats or reorders its own keys.
+    """
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.last_ms = -1
+        self.last_random = 0
+
+    def __call__(self, trip=None):
+        return self.key(int(self.clock() * 1000))
+
+    def key(self, ms):
+        with self.lock:
+            if ms <= self.last_ms:
+                ms, random = self.last_ms, self.last_random + 1
+                if random > RANDOM_MAX:
+                    ms, random = ms + 1, self.random()
+            else:
+                random = self.random()
+            self.last_ms, self.last_random = ms, random
+        return f'{ms:012x}{random:020x}'
+
+    def random(self):
+        # Leave headroom so increments within a millisecond rarely carry over.
+        return int.from_bytes(os.urandom(10), 'big') >> 1
+
+
+time_ordered_nk = TimeOrderedKeys()
+
+
+def md5_nk(trip):
+    """The original keys: random-looking, so inserts scatter across the index."""
+    secure_hash = hashlib.md5()
+    secure_hash.update(f'{datetime.datetime.now()}:{trip.pick_up_address}:{trip.drop_off_address}'.encode('utf-8'))
+    return secure_hash.hexdigest()
+
+
+def generate_nk(trip):
+    return import_string(settings.TRIP_NK_GENERATOR)(trip)
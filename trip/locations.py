@@ -0,0 +1,137 @@
+import atexit
+import logging
+import threading
+import time
+from django.db import DatabaseError, IntegrityError, close_old_connections, transaction
+from django.db.models import Case, FloatField, DateTimeField, Value, When
+from django.utils import timezone
+from .models import DriverLocation
+
+logger = logging.getLogger(__name__)
+# Keeps each UPDATE ... CASE statement under SQLite's bound-parameter limit.
+UPDATE_BATCH_SIZE = 100
+
+
+class LocationBuffer:
+    """
+    Write-behind buffer for driver location pings.
+
+    Only the latest position per driver is kept; older pings are overwritten in
+    memory and never reach the database. Pending positions are written in bulk
+    once `flush_size` drivers are pending or `flush_interval` seconds have
+    passed. A crashed worker loses the latest position of every driver it has
+    not written yet: normally fewer than `flush_size`, none older than
+    `flush_interval` seconds when the background flusher runs, but while
+    writes fail each batch goes back into the buffer and the loss grows with it.
+
+    One flush runs at a time, so an older batch never lands after a newer one;
+    a ping that finds a flush under way leaves its position for the next.
+    """
+
+    def __init__(self, flush_interval=2.0, flush_size=500, background=True, clock=time.monotonic):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.background = background
+        self.clock = clock
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = clock()
+        self.thread = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, driver_id, latitude, longitude):
+        if self.background and self.thread is None:
+            self.start()
+        with self.lock:
+            self.pending[driver_id] = (latitude, longitude, timezone.now())
+            due = len(self.pending) >= self.flush_size or self.clock() - self.last_flush >= self.flush_interval
+        if due:
+            self.flush(block=False)
+
+    def flush(self, block=True):
+        if not self.flush_lock.acquire(blocking=block):
+            return 0
+        try:
+            with self.lock:
+                pending, self.pending = self.pending, {}
+                self.last_flush = self.clock()
+            if not pending:
+                return 0
+            try:
+                write_locations(pending)
+            except DatabaseError:
+                logger.exception('Could not write %s driver locations; keeping them for the next flush.', len(pending))
+                with self.lock:
+                    # Pings that arrived in the meantime are newer.
+                    self.pending = {**pending, **self.pending}
+                return 0
+            return len(pending)
+        finally:
+            self.flush_lock.release()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='location-flusher', daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if self.clock() - self.last_flush >= self.flush_interval:
+                # No request cycle ends on this thread to close a stale or broken connection.
+                close_old_connections()
+                try:
+                    self.flush()
+                finally:
+                    close_old_connections()
+
+
+def write_locations(positions):
+    """
+    Upsert `{driver_id: (latitude, longitude, updated)}` with a handful of
+    statements. Rows already holding a newer position, as written by another
+    worker the driver's pings went to, are left alone.
+    """
+    with transaction.atomic():
+        existing = set(DriverLocation.objects.filter(
+            driver_id__in=list(positions)
+        ).values_list('driver_id', flat=True))
+        driver_ids = sorted(existing)
+        for start in range(0, len(driver_ids), UPDATE_BATCH_SIZE):
+            batch = driver_ids[start:start + UPDATE_BATCH_SIZE]
+            DriverLocation.objects.filter(
+                driver_id__in=batch, updated__lt=_case(batch, positions, 2, DateTimeField())
+            ).update(
+                latitude=_case(batch, positions, 0, FloatField()),
+                longitude=_case(batch, positions, 1, FloatField()),
+                updated=_case(batch, positions, 2, DateTimeField()),
+            )
+        created = [
+            DriverLocation(driver_id=driver_id, latitude=latitude, longitude=longitude, updated=updated)
+            for driver_id, (latitude, longitude, updated) in positions.items() if driver_id not in existing
+        ]
+        if created:
+            try:
+                with transaction.atomic():
+                    DriverLocation.objects.bulk_create(created, batch_size=UPDATE_BATCH_SIZE)
+            except IntegrityError:
+                # Another worker inserted some of these drivers first.
+                for location in created:
+                    position = {'latitude': location.latitude, 'longitude': location.longitude}
+                    _, inserted = DriverLocation.objects.get_or_create(
+                        driver_id=location.driver_id, defaults={**position, 'updated': location.updated}
+                    )
+                    if not inserted:
+                        DriverLocation.objects.filter(
+                            driver_id=location.driver_id, updated__lt=location.updated
+                        ).update(**position, updated=location.updated)
+
+
+def _case(driver_ids, positions, index, output_field):
+    return Case(
+        *[When(driver_id=driver_id, then=Value(positions[driver_id][index])) for driver_id in driver_ids],
+        output_field=output_field
+    )
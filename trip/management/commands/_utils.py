@@ -0,0 +1,47 @@
+from collections import deque
+from contextlib import contextmanager
+from asgiref.inmemory import ChannelLayer as InMemoryChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from channels.asgi import ChannelLayerWrapper
+from django.db import connection
+
+
+@contextmanager
+def test_database(name=None):
+    """
+    Run a benchmark against a throwaway test database instead of the configured
+    one. Pass a file `name` when several threads share it; each thread has its
+    own connection, and SQLite's in-memory test database is not shared.
+    """
+    old_name, old_test_name = connection.settings_dict['NAME'], connection.settings_dict['TEST']['NAME']
+    if name is not None:
+        connection.settings_dict['TEST']['NAME'] = name
+    connection.creation.create_test_db(verbosity=0, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        connection.settings_dict['TEST']['NAME'] = old_test_name
+
+
+@contextmanager
+def captured_queries():
+    """Like CaptureQueriesContext, without the 9000-query cap on the log."""
+    old_log, old_force_debug_cursor = connection.queries_log, connection.force_debug_cursor
+    connection.queries_log, connection.force_debug_cursor = deque(), True
+    try:
+        yield connection.queries_log
+    finally:
+        connection.queries_log, connection.force_debug_cursor = old_log, old_force_debug_cursor
+
+
+@contextmanager
+def in_memory_channel_layer(**kwargs):
+    """Swap the default channel layer for an in-memory one, as ChannelTestCase does."""
+    old_layer = channel_layers[DEFAULT_CHANNEL_LAYER]
+    layer = ChannelLayerWrapper(InMemoryChannelLayer(**kwargs), DEFAULT_CHANNEL_LAYER, old_layer.routing[:])
+    channel_layers.set(DEFAULT_CHANNEL_LAYER, layer)
+    try:
+        yield layer
+    finally:
+        channel_layers.set(DEFAULT_CHANNEL_LAYER, old_layer)
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from trip.archive import ARCHIVE_BATCH_SIZE, archive_trips
+
+
+class Command(BaseCommand):
+    help = 'Move completed trips out of the active trip table and into the archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        archived = archive_trips(batch_size=options['batch_size'])
+        self.stdout.write(f'Archived {archived} trips.')
@@ -0,0 +1,98 @@
+import datetime
+import random
+import statistics
+import time
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from rest_framework.test import APIRequestFactory, force_authenticate
+from trip.apis import TripView
+from trip.archive import archive_trips
+from trip.models import Trip
+from ._utils import test_database
+
+
+class Command(BaseCommand):
+    help = 'Measure connect-time and trip list query latency with completed trips kept live and then archived.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--archived', type=int, default=10000000, help='Completed trips to load.')
+        parser.add_argument('--riders', type=int, default=10000)
+        parser.add_argument('--drivers', type=int, default=1000)
+        parser.add_argument('--samples', type=int, default=200)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with test_database():
+            self.run(**options)
+
+    def run(self, archived, riders, drivers, samples, batch_size, seed, **options):
+        rng = random.Random(seed)
+        rider_group, driver_group = Group.objects.create(name='rider'), Group.objects.create(name='driver')
+        get_user_model().objects.bulk_create(
+            [get_user_model()(username=f'rider{index}@example.com') for index in range(riders)] +
+            [get_user_model()(username=f'driver{index}@example.com') for index in range(drivers)]
+        )
+        riders = list(get_user_model().objects.filter(username__startswith='rider'))
+        drivers = list(get_user_model().objects.filter(username__startswith='driver'))
+        rider_group.user_set.add(*riders)
+        driver_group.user_set.add(*drivers)
+
+        start = timezone.now() - datetime.timedelta(seconds=archived)
+        for offset in range(0, archived, batch_size):
+            Trip.objects.bulk_create([
+                Trip(
+                    nk=f'{index:032x}', created=start + datetime.timedelta(seconds=index), pick_up_address='A',
+                    drop_off_address='B', status=Trip.COMPLETED, rider=riders[index % len(riders)],
+                    driver=drivers[index % len(drivers)]
+                )
+                for index in range(offset, min(offset + batch_size, archived))
+            ])
+        # One live trip per rider, half of them already claimed.
+        Trip.objects.bulk_create([
+            Trip(
+                nk=f'{archived + index:032x}', pick_up_address='A', drop_off_address='B', rider=rider,
+                status=Trip.STARTED if index % 2 else Trip.REQUESTED,
+                driver=drivers[index % len(drivers)] if index % 2 else None
+            )
+            for index, rider in enumerate(riders)
+        ])
+        self.stdout.write(f'{archived} completed trips, {len(riders)} riders, {len(drivers)} drivers')
+
+        sample_riders = rng.sample(riders, min(samples, len(riders)))
+        sample_drivers = [rng.choice(drivers) for _ in range(samples)]
+        self.report('completed trips live', sample_riders, sample_drivers)
+        began = time.perf_counter()
+        moved = archive_trips(batch_size=batch_size)
+        elapsed = time.perf_counter() - began
+        self.stdout.write(f'archived {moved} trips in {elapsed:.1f}s ({moved / elapsed:.0f} trips/sec)')
+        self.report('completed trips archived', sample_riders, sample_drivers)
+
+    def report(self, label, riders, drivers):
+        list_view = TripView.as_view({'get': 'list'})
+        factory = APIRequestFactory()
+
+        def trip_list(user):
+            request = factory.get('/api/trip/')
+            force_authenticate(request, user=user)
+            list_view(request).render()
+
+        self.stdout.write(label)
+        for name, users, query in [
+            ('rider connect', riders, lambda user: list(
+                user.trips_as_rider.exclude(status=Trip.COMPLETED).values_list('nk', flat=True)
+            )),
+            ('driver connect', drivers, lambda user: list(
+                user.trips_as_driver.exclude(status=Trip.COMPLETED).values_list('nk', flat=True)
+            )),
+            ('rider list', riders, trip_list),
+            ('driver list', drivers, trip_list),
+        ]:
+            timings = []
+            for user in users:
+                began = time.perf_counter()
+                query(user)
+                timings.append(time.perf_counter() - began)
+            self.stdout.write(f'  {name:<15} median {statistics.median(timings) * 1000:8.2f} ms')
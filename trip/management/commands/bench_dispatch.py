@@ -0,0 +1,61 @@
+import random
+import time
+from asgiref.inmemory import ChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from trip.geo import DriverIndex
+
+# Roughly the size of a large city.
+BOUNDS = ((40.55, 40.90), (-74.10, -73.70))
+
+
+class Command(BaseCommand):
+    help = 'Compare the cost of alerting every driver against alerting only nearby drivers.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=10000)
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        num_requests = options['requests']
+        layer = ChannelLayer(capacity=num_requests + 1)
+        index = DriverIndex(cell_size=settings.DISPATCH_CELL_SIZE)
+
+        for driver_id in range(options['drivers']):
+            channel = f'websocket.send.driver{driver_id}'
+            layer.group_add('drivers', channel)
+            index.update(driver_id, rng.uniform(*BOUNDS[0]), rng.uniform(*BOUNDS[1]), channel)
+
+        pick_ups = [(rng.uniform(*BOUNDS[0]), rng.uniform(*BOUNDS[1])) for _ in range(num_requests)]
+        message = {'text': '{"status": "REQUESTED"}'}
+
+        start = time.perf_counter()
+        for _ in pick_ups:
+            layer.send_group('drivers', message)
+        broadcast = time.perf_counter() - start
+        layer.flush()
+
+        sends = 0
+        start = time.perf_counter()
+        for latitude, longitude in pick_ups:
+            drivers = index.nearby(
+                latitude, longitude,
+                radius=settings.DISPATCH_RADIUS,
+                limit=settings.DISPATCH_MAX_DRIVERS
+            )
+            for _, _, channel in drivers:
+                layer.send(channel, message)
+            sends += len(drivers)
+        nearby = time.perf_counter() - start
+
+        self.stdout.write(f'{options["drivers"]} drivers, {num_requests} trip requests')
+        self.stdout.write(
+            f'broadcast: {options["drivers"]:.1f} sends/request, '
+            f'{broadcast / num_requests * 1000:.3f} ms/request'
+        )
+        self.stdout.write(
+            f'nearby:    {sends / num_requests:.1f} sends/request, '
+            f'{nearby / num_requests * 1000:.3f} ms/request'
+        )
@@ -0,0 +1,184 @@
+import random
+import time
+from collections import defaultdict
+from unittest import mock
+from channels.test import HttpClient
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+from trip.consumers import driver_index
+from trip.locations import LocationBuffer
+from trip.models import Trip
+from trip.presence import presence
+from trip.serializers import PublicUserSerializer
+from ._utils import captured_queries, in_memory_channel_layer, test_database
+from .bench_dispatch import BOUNDS
+
+# The database queries each step runs. Socket steps include the channel and
+# HTTP session reads and writes. The test suite checks the same numbers, and
+# this benchmark fails when a step goes over them. Trip requests and accepts
+# include the trip stats upsert.
+QUERY_BUDGETS = {
+    'driver connect': 12,
+    'rider connect': 12,
+    'trip request': 12,
+    'trip accept': 14,
+    'trip list': 5,
+    'trip retrieve': 1,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Simulate riders and drivers over the socket routes and the REST API, reporting throughput and p50/p99 '
+        'latency per step. Fails if any step runs more queries than QUERY_BUDGETS allows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--riders', type=int, default=100)
+        parser.add_argument('--drivers', type=int, default=200)
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        # Rate limits would throttle the simulated clients, and drivers that
+        # stay silent past the presence TTL on a long run would stop getting
+        # alerts. The location buffer flushes inline so no background thread
+        # touches the test database.
+        limits = {kind: {'rate': 1e9, 'burst': 1e9} for kind in ('location', 'heartbeat', 'message')}
+        with test_database(), in_memory_channel_layer(capacity=10000), \
+                override_settings(SOCKET_RATE_LIMITS=limits), mock.patch.object(presence, 'ttl', float('inf')), \
+                mock.patch('trip.consumers.location_buffer', LocationBuffer(background=False)):
+            try:
+                self.run(**options)
+            finally:
+                driver_index.clear()
+                presence.clear()
+
+    def run(self, riders, drivers, requests, seed, **options):
+        rng = random.Random(seed)
+        self.timings, self.queries = defaultdict(list), defaultdict(list)
+        riders, drivers = self.create_users('rider', riders), self.create_users('driver', drivers)
+
+        # Drivers spread over a grid across the city, so every pick-up has a few of them close by.
+        columns = max(1, int(len(drivers) ** 0.5))
+        rows = (len(drivers) + columns - 1) // columns
+        positions = [
+            (
+                BOUNDS[0][0] + (BOUNDS[0][1] - BOUNDS[0][0]) * (index // columns + 0.5) / rows,
+                BOUNDS[1][0] + (BOUNDS[1][1] - BOUNDS[1][0]) * (index % columns + 0.5) / columns,
+            )
+            for index in range(len(drivers))
+        ]
+        driver_clients = [self.connect(driver, '/driver/') for driver in drivers]
+        for client, (latitude, longitude) in zip(driver_clients, positions):
+            self.send(client, '/driver/', {'type': 'location', 'latitude': latitude, 'longitude': longitude})
+        rider_clients = [self.connect(rider, '/rider/') for rider in riders]
+        self.stdout.write(f'{len(riders)} riders, {len(drivers)} drivers, {requests} trip requests')
+
+        missed = 0
+        for index in range(requests):
+            rider, rider_client = riders[index % len(riders)], rider_clients[index % len(riders)]
+            driver_number = rng.randrange(len(drivers))
+            driver_client = driver_clients[driver_number]
+            latitude, longitude = positions[driver_number]
+
+            # Trip request until the driver at the pick-up hears about it.
+            request = {
+                'pick_up_address': 'A', 'drop_off_address': 'B', 'rider': PublicUserSerializer(rider).data,
+                'pick_up_latitude': latitude + 0.0001, 'pick_up_longitude': longitude,
+            }
+            start = time.perf_counter()
+            with captured_queries() as queries:
+                self.send(rider_client, '/rider/', request)
+            alert = driver_client.receive()
+            self.record('trip request', start, queries)
+            if alert is None or 'nk' not in alert:
+                missed += 1
+                continue
+            self.drain(rider_client)
+
+            # Acceptance until the rider hears about it.
+            start = time.perf_counter()
+            with captured_queries() as queries:
+                self.send(driver_client, '/driver/', {'nk': alert['nk'], 'status': Trip.STARTED})
+            update = rider_client.receive()
+            self.record('trip accept', start, queries)
+            if update is None or update.get('status') != Trip.STARTED:
+                missed += 1
+
+            for status in [Trip.IN_PROGRESS, Trip.COMPLETED]:
+                self.send(driver_client, '/driver/', {'nk': alert['nk'], 'status': status})
+            for client in [rider_client] + driver_clients:
+                self.drain(client)
+
+        api = APIClient()
+        tokens = dict(Token.objects.values_list('user_id', 'key'))
+        for rider in riders:
+            api.credentials(HTTP_AUTHORIZATION=f'Token {tokens[rider.id]}')
+            response = self.step('trip list', api.get, reverse('trip:trip_list'))
+            for trip in response.data['results'][:1]:
+                self.step('trip retrieve', api.get, reverse('trip:trip_detail', kwargs={'trip_nk': trip['nk']}))
+
+        self.report(missed)
+
+    def create_users(self, group, count):
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'{group}{index}@example.com') for index in range(count)])
+        users = list(User.objects.filter(username__startswith=group).order_by('id'))
+        Group.objects.create(name=group).user_set.add(*users)
+        Token.objects.bulk_create([Token(user=user, key=f'{group}{user.id:036x}') for user in users])
+        return users
+
+    def connect(self, user, path):
+        client = HttpClient()
+        client.force_login(user)
+        self.step(f'{path.strip("/")} connect', client.send_and_consume, 'websocket.connect', path=path)
+        return client
+
+    def send(self, client, path, content):
+        client.send_and_consume('websocket.receive', path=path, content={'text': content})
+
+    def drain(self, client):
+        while client.receive() is not None:
+            pass
+
+    def step(self, name, function, *args, **kwargs):
+        start = time.perf_counter()
+        with captured_queries() as queries:
+            result = function(*args, **kwargs)
+        self.record(name, start, queries)
+        return result
+
+    def record(self, name, start, queries):
+        self.timings[name].append(time.perf_counter() - start)
+        self.queries[name].append(len(queries))
+
+    def report(self, missed):
+        over = []
+        self.stdout.write(
+            f'{"step":<16}{"count":>7}{"ops/sec":>10}{"p50 ms":>9}{"p99 ms":>9}{"queries":>9}{"budget":>8}'
+        )
+        for name, budget in QUERY_BUDGETS.items():
+            timings, queries = sorted(self.timings[name]), max(self.queries[name], default=0)
+            if not timings:
+                continue
+            self.stdout.write(
+                f'{name:<16}{len(timings):>7}{len(timings) / sum(timings):>10.0f}'
+                f'{_percentile(timings, 50) * 1000:>9.2f}{_percentile(timings, 99) * 1000:>9.2f}'
+                f'{queries:>9}{budget:>8}'
+            )
+            if queries > budget:
+                over.append(f'{name} ran {queries} queries, over its budget of {budget}')
+        if missed:
+            self.stdout.write(f'{missed} requests were not alerted to or accepted by the nearest driver')
+        if over:
+            raise CommandError('; '.join(over))
+
+
+def _percentile(values, percent):
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
@@ -0,0 +1,62 @@
+import random
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from trip.locations import LocationBuffer
+from trip.models import DriverLocation
+from ._utils import captured_queries, test_database
+
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Command(BaseCommand):
+    help = 'Compare database writes for per-ping location saves against the write-behind buffer.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=1000)
+        parser.add_argument('--hz', type=float, default=2.0)
+        parser.add_argument('--seconds', type=int, default=10)
+        parser.add_argument('--flush-interval', type=float, default=2.0)
+        parser.add_argument('--flush-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        with test_database():
+            self.run(**options)
+
+    def run(self, drivers, hz, seconds, flush_interval, flush_size, **options):
+        get_user_model().objects.bulk_create([
+            get_user_model()(username=f'driver{index}@example.com') for index in range(drivers)
+        ])
+        driver_ids = list(get_user_model().objects.values_list('id', flat=True))
+        ticks = int(seconds * hz)
+        pings = [
+            (driver_id, 40.7 + random.random() / 10, -74.0 + random.random() / 10)
+            for _ in range(ticks) for driver_id in driver_ids
+        ]
+
+        with captured_queries() as direct:
+            for driver_id, latitude, longitude in pings:
+                DriverLocation.objects.update_or_create(driver_id=driver_id, defaults={
+                    'latitude': latitude, 'longitude': longitude, 'updated': timezone.now()
+                })
+        DriverLocation.objects.all().delete()
+
+        clock = SimulatedClock()
+        buffer = LocationBuffer(flush_interval=flush_interval, flush_size=flush_size, background=False, clock=clock)
+        with captured_queries() as buffered:
+            for index, (driver_id, latitude, longitude) in enumerate(pings):
+                clock.now = index // len(driver_ids) / hz
+                buffer.add(driver_id, latitude, longitude)
+            buffer.flush()
+
+        self.stdout.write(f'{len(driver_ids)} drivers at {hz} Hz for {seconds}s: {len(pings)} pings')
+        self.stdout.write(f'per-ping writes: {len(direct)} queries')
+        self.stdout.write(
+            f'write-behind:    {len(buffered)} queries ({len(direct) / max(len(buffered), 1):.0f}x fewer)'
+        )
@@ -0,0 +1,134 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.authtoken.models import Token
+from rest_framework.reverse import reverse
+from rest_framework.test import APIClient
+from trip.models import Trip
+from trip.passwords import password_pool
+from trip.throttling import AddressRateThrottle, UsernameRateThrottle
+from ._utils import test_database
+from .bench_dispatch_flow import _percentile
+
+PASSWORD = 'pAssw0rd!'
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure trip list latency on a fixed pool of request threads, idle and during a login flood, with '
+        'passwords hashed on the request threads and in the password pool.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server-threads', type=int, default=8, help='Request threads, as in a threaded server.')
+        parser.add_argument('--flood', type=int, default=32, help='Logins kept in flight during a flood.')
+        parser.add_argument('--probes', type=int, default=100, help='Trip list requests timed per phase.')
+        parser.add_argument('--interval', type=float, default=20.0, help='Milliseconds between trip list requests.')
+        parser.add_argument('--processes', type=int, default=2)
+        parser.add_argument('--max-pending', type=int, default=4)
+
+    def handle(self, *args, **options):
+        # Request threads share one database file. Throttling, which counts
+        # every request from the one test address, would turn most of the
+        # flood away before it hashed anything.
+        directory = tempfile.mkdtemp()
+        try:
+            with test_database(os.path.join(directory, 'bench.sqlite3')), \
+                    mock.patch.object(AddressRateThrottle, 'THROTTLE_RATES', {'log_in_address': '1000000/s'}), \
+                    mock.patch.object(UsernameRateThrottle, 'THROTTLE_RATES', {'log_in': '1000000/s'}):
+                self.run(**options)
+        finally:
+            password_pool.reset()
+            shutil.rmtree(directory)
+
+    def run(self, server_threads, flood, probes, interval, processes, max_pending, **options):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        User = get_user_model()
+        encoded = make_password(PASSWORD)
+        User.objects.bulk_create([
+            User(username=f'user{index}@example.com', password=encoded) for index in range(flood * 4)
+        ])
+        rider = User.objects.create(username='rider@example.com')
+        token = Token.objects.create(user=rider)
+        Trip.objects.bulk_create([
+            Trip(nk=f'{index:032x}', pick_up_address='A', drop_off_address='B', rider=rider) for index in range(20)
+        ])
+        self.usernames = list(User.objects.exclude(pk=rider.pk).values_list('username', flat=True))
+        self.token = token.key
+
+        self.stdout.write(
+            f'{server_threads} request threads, {flood} logins in flight, password pool of {processes} processes '
+            f'holding at most {max_pending}'
+        )
+        self.stdout.write(f'{"phase":<24}{"p50 ms":>9}{"p99 ms":>9}{"logins/s":>10}{"503s":>7}')
+        for phase, flooding, pool in [
+            ('idle', False, {'processes': processes, 'max_pending': max_pending}),
+            ('flood, inline hashing', True, {'processes': 0, 'max_pending': 10 ** 6}),
+            ('flood, password pool', True, {'processes': processes, 'max_pending': max_pending}),
+        ]:
+            with mock.patch.multiple(password_pool, **pool):
+                latencies, logins, elapsed = self.phase(server_threads, flood if flooding else 0, probes, interval)
+            password_pool.reset()
+            self.stdout.write(
+                f'{phase:<24}{_percentile(latencies, 50) * 1000:>9.1f}{_percentile(latencies, 99) * 1000:>9.1f}'
+                f'{logins[200] / elapsed:>10.0f}{logins[503]:>7}'
+            )
+
+    def phase(self, server_threads, flood, probes, interval):
+        """Time `probes` trip list requests while `flood` logins are kept in flight on the same threads."""
+        server = ThreadPoolExecutor(server_threads)
+        logins, lock, stopping = Counter(), threading.Lock(), threading.Event()
+        in_flight = threading.BoundedSemaphore(max(flood, 1))
+
+        def log_in(index):
+            try:
+                response = APIClient().post(reverse('log_in'), data={
+                    'username': self.usernames[index % len(self.usernames)], 'password': PASSWORD,
+                })
+                with lock:
+                    logins[response.status_code] += 1
+            finally:
+                in_flight.release()
+
+        def feed():
+            index = 0
+            while not stopping.is_set():
+                if in_flight.acquire(timeout=0.1):
+                    server.submit(log_in, index)
+                    index += 1
+
+        def list_trips(queued):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+            client.get(reverse('trip:trip_list'))
+            return time.perf_counter() - queued
+
+        feeder = threading.Thread(target=feed)
+        if flood:
+            feeder.start()
+            # Let the flood fill the request threads first.
+            time.sleep(0.5)
+        with lock:
+            logins.clear()
+        start = time.perf_counter()
+        futures = []
+        for _ in range(probes):
+            futures.append(server.submit(list_trips, time.perf_counter()))
+            time.sleep(interval / 1000)
+        latencies = sorted(future.result() for future in futures)
+        elapsed = time.perf_counter() - start
+        stopping.set()
+        if flood:
+            feeder.join()
+        server.shutdown()
+        return latencies, logins, elapsed
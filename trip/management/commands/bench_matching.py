@@ -0,0 +1,58 @@
+import random
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from trip.dispatch import MATCH_CELL_SIZE, match
+from trip.geo import DriverIndex
+from .bench_dispatch import BOUNDS
+
+
+class Command(BaseCommand):
+    help = 'Measure batch matching solve time against batch size, and its pick-up distances against first-come claims.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--drivers', type=int, default=10000)
+        parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 500, 1000, 2000, 5000])
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        positions = {
+            driver_id: (rng.uniform(*BOUNDS[0]), rng.uniform(*BOUNDS[1])) for driver_id in range(options['drivers'])
+        }
+        self.stdout.write(f'{options["drivers"]} drivers, {settings.DISPATCH_CANDIDATES} candidates per trip')
+        self.stdout.write('trips   solve ms   matched   batch km/trip   first-come km/trip')
+        for size in options['batch_sizes']:
+            trips = [(trip_id, rng.uniform(*BOUNDS[0]), rng.uniform(*BOUNDS[1])) for trip_id in range(size)]
+
+            index = self.index(positions, MATCH_CELL_SIZE)
+            start = time.perf_counter()
+            batch = match(trips, index, radius=settings.DISPATCH_RADIUS, candidates=settings.DISPATCH_CANDIDATES)
+            solve = time.perf_counter() - start
+
+            # First-come: each request, in arrival order, goes to a random one
+            # of the drivers it alerted, who is then off the road.
+            index, first_come = self.index(positions, settings.DISPATCH_CELL_SIZE), []
+            for trip_id, latitude, longitude in trips:
+                nearby = index.nearby(
+                    latitude, longitude, radius=settings.DISPATCH_RADIUS, limit=settings.DISPATCH_MAX_DRIVERS
+                )
+                if nearby:
+                    distance, driver_id, _ = rng.choice(nearby)
+                    index.remove(driver_id)
+                    first_come.append(distance)
+
+            self.stdout.write(
+                f'{size:5d}   {solve * 1000:8.1f}   {len(batch):7d}   '
+                f'{_mean([distance for _, _, distance in batch]):13.3f}   {_mean(first_come):18.3f}'
+            )
+
+    def index(self, positions, cell_size):
+        index = DriverIndex(cell_size=cell_size)
+        for driver_id, (latitude, longitude) in positions.items():
+            index.update(driver_id, latitude, longitude, None)
+        return index
+
+
+def _mean(values):
+    return sum(values) / len(values) if values else 0.0
@@ -0,0 +1,75 @@
+import time
+from channels import Group
+from channels.message import Message
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from trip.consumers import RiderConsumer
+from trip.models import Trip
+from ._utils import captured_queries, in_memory_channel_layer, test_database
+
+
+class Command(BaseCommand):
+    help = 'Reconnect many simulated rider sockets and compare subscription cost before and after batching.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=10000)
+        parser.add_argument('--trips', type=int, default=3, help='Active trips per rider.')
+
+    def handle(self, *args, **options):
+        with test_database(), in_memory_channel_layer() as layer:
+            self.run(layer, options['clients'], options['trips'])
+
+    def run(self, layer, num_clients, trips_per_client):
+        get_user_model().objects.bulk_create([
+            get_user_model()(username=f'rider{index}@example.com') for index in range(num_clients)
+        ])
+        riders = list(get_user_model().objects.all())
+        Trip.objects.bulk_create([
+            Trip(nk=f'{rider.id:024x}{index:08x}', pick_up_address='A', drop_off_address='B', rider=rider)
+            for rider in riders for index in range(trips_per_client)
+        ])
+
+        def per_trip(rider, reply_channel, session):
+            # The original connect: load whole trips and add one group at a time.
+            trip_nks = [trip.nk for trip in rider.trips_as_rider.exclude(status=Trip.COMPLETED)]
+            session['trip_nks'] = trip_nks
+            for trip_nk in trip_nks:
+                Group(trip_nk).add(reply_channel)
+
+        def batched(rider, reply_channel, session):
+            message = Message({'reply_channel': reply_channel, 'path': '/rider/'}, 'websocket.connect', layer)
+            message.user, message.channel_session = rider, session
+            # Skip the consumer's dispatching constructor; only the subscription logic is measured.
+            consumer = RiderConsumer.__new__(RiderConsumer)
+            consumer.message = message
+            consumer.subscribe(consumer.user_trip_nks, replace=True)
+
+        group_calls = self.count_group_calls(layer)
+        self.stdout.write(f'{num_clients} clients with {trips_per_client} active trips each')
+        for label, connect in [('per-trip', per_trip), ('batched', batched)]:
+            layer.flush()
+            group_calls[0] = 0
+            with captured_queries() as queries:
+                start = time.perf_counter()
+                for rider in riders:
+                    connect(rider, f'websocket.send!{rider.id}', {})
+                elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f'{label:<14} {num_clients / elapsed:>9.0f} reconnects/sec, '
+                f'{len(queries)} queries, {group_calls[0]} group operations'
+            )
+        self.stdout.write(
+            'With asgi_redis, the batched group operations go out as one pipeline per shard per reconnect.'
+        )
+
+    def count_group_calls(self, layer):
+        backend = layer.channel_layer
+        calls = [0]
+        group_add = type(backend).group_add
+
+        def counted(self, group, channel):
+            calls[0] += 1
+            return group_add(self, group, channel)
+
+        backend.group_add = counted.__get__(backend)
+        return calls
@@ -0,0 +1,42 @@
+import time
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from trip.models import Trip
+from trip.serializers import TripSerializer, serialize_trip
+from ._utils import test_database
+
+
+class Command(BaseCommand):
+    help = 'Measure trip serialization throughput of TripSerializer against serialize_trip.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trips', type=int, default=2000)
+        parser.add_argument('--rounds', type=int, default=5)
+
+    def handle(self, *args, **options):
+        with test_database():
+            self.run(options['trips'], options['rounds'])
+
+    def run(self, num_trips, rounds):
+        rider = get_user_model().objects.create_user(username='rider@example.com')
+        driver = get_user_model().objects.create_user(username='driver@example.com')
+        rider.groups.add(Group.objects.create(name='rider'))
+        driver.groups.add(Group.objects.create(name='driver'))
+        Trip.objects.bulk_create([
+            Trip(nk=f'{index:032x}', pick_up_address='A', drop_off_address='B', rider=rider, driver=driver)
+            for index in range(num_trips)
+        ])
+        trips = list(Trip.objects.select_related('driver', 'rider').prefetch_related('driver__groups', 'rider__groups'))
+
+        for label, serialize in [
+            ('TripSerializer', lambda: TripSerializer(trips, many=True).data),
+            ('serialize_trip', lambda: [serialize_trip(trip) for trip in trips]),
+        ]:
+            best = min(self.time(serialize) for _ in range(rounds))
+            self.stdout.write(f'{label:<15} {num_trips / best:>10.0f} trips/sec')
+
+    def time(self, function):
+        start = time.perf_counter()
+        function()
+        return time.perf_counter() - start
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+from unittest import mock
+from channels.test import HttpClient
+from channels.worker import Worker
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.backends import utils
+from django.test.utils import override_settings
+from trip.models import Trip
+from trip.presence import presence
+from trip.serializers import PublicUserSerializer
+from trip.workers import ConcurrentWorker
+from ._utils import in_memory_channel_layer, test_database
+
+
+class Command(BaseCommand):
+    help = (
+        'Queue socket messages from many riders and drain them with the stock worker and with ConcurrentWorker '
+        'at several pool sizes, reporting messages per second and checking each rider\'s trips kept their order.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--riders', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=4, help='Trip requests per rider.')
+        parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+        parser.add_argument(
+            '--query-latency', type=float, default=0.0,
+            help='Milliseconds added to every query, standing in for a database across the network.',
+        )
+
+    def handle(self, *args, **options):
+        # Threads need one database file between them, and SQLite serializes
+        # their writes, so the added latency is what the pool overlaps.
+        limits = {kind: {'rate': 1e9, 'burst': 1e9} for kind in ('location', 'message')}
+        directory = tempfile.mkdtemp()
+        latency = options['query_latency'] / 1000
+        try:
+            with test_database(os.path.join(directory, 'bench.sqlite3')), \
+                    in_memory_channel_layer(capacity=100000) as layer, \
+                    override_settings(SOCKET_RATE_LIMITS=limits), slow_queries(latency):
+                self.run(layer, options['riders'], options['requests'], options['threads'])
+        finally:
+            presence.clear()
+            shutil.rmtree(directory)
+
+    def run(self, layer, num_riders, num_requests, pool_sizes):
+        # Readers don't wait on a writer under WAL; it stays set on the file for every thread's connection.
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        User = get_user_model()
+        User.objects.bulk_create([User(username=f'rider{index}@example.com') for index in range(num_riders)])
+        riders = list(User.objects.order_by('id'))
+        Group.objects.create(name='rider').user_set.add(*riders)
+        self.stdout.write(f'{num_riders} riders sending {num_requests} trip requests each')
+        self.stdout.write(f'{"worker":<22}{"messages":>9}{"msgs/sec":>10}{"processes":>11}')
+
+        baseline = None
+        for label, make_worker in [('stock Worker', lambda: Worker(layer, signal_handlers=False))] + [
+            (f'ConcurrentWorker x{threads}', lambda threads=threads: ConcurrentWorker(
+                layer, signal_handlers=False, threads=threads,
+            ))
+            for threads in pool_sizes
+        ]:
+            Trip.objects.all().delete()
+            clients = self.enqueue(riders, num_requests)
+            messages = len(clients) * num_requests
+            elapsed = self.drain(layer, make_worker())
+            rate = messages / elapsed
+            baseline = baseline or rate
+            self.stdout.write(f'{label:<22}{messages:>9}{rate:>10.0f}{rate / baseline:>11.1f}')
+            self.check_order(riders, num_requests)
+            layer.flush()
+        self.stdout.write('"processes" is how many stock single-threaded workers the same rate would take.')
+
+    def enqueue(self, riders, num_requests):
+        """Connect each rider, then queue `num_requests` trip requests per rider without running them."""
+        clients = []
+        for rider in riders:
+            # Channels does not order a socket's connect before its receives on
+            # its own, so connects run here and only the requests are timed.
+            client = HttpClient()
+            client.force_login(rider)
+            client.send_and_consume('websocket.connect', path='/rider/')
+            rider_data = PublicUserSerializer(rider).data
+            for index in range(num_requests):
+                client.send('websocket.receive', path='/rider/', text={
+                    'pick_up_address': f'{index}', 'drop_off_address': 'B', 'rider': rider_data,
+                })
+            clients.append(client)
+        return clients
+
+    def drain(self, layer, worker):
+        """Run `worker` until the socket channels are empty and it holds nothing, and return the seconds taken."""
+        thread = threading.Thread(target=worker.run)
+        start = time.perf_counter()
+        thread.start()
+        while layer.channel_layer._channels.get('websocket.receive') or getattr(worker, 'pending', 0):
+            time.sleep(0.001)
+        worker.termed = True
+        thread.join()
+        elapsed = time.perf_counter() - start
+        connections.close_all()
+        return elapsed
+
+    def check_order(self, riders, num_requests):
+        # Each rider's requests must have been saved in the order they were sent.
+        expected = [str(index) for index in range(num_requests)]
+        trips = {}
+        for rider_id, address in Trip.objects.order_by('id').values_list('rider_id', 'pick_up_address'):
+            trips.setdefault(rider_id, []).append(address)
+        for rider in riders:
+            if trips.get(rider.id) != expected:
+                raise CommandError(f'Trips of rider {rider.id} were {trips.get(rider.id)}, expected {expected}.')
+
+
+def slow_queries(latency):
+    """Sleep for `latency` seconds before every query."""
+    execute, executemany = utils.CursorWrapper.execute, utils.CursorWrapper.executemany
+
+    def slow(method):
+        def wrapper(self, *args, **kwargs):
+            if latency:
+                time.sleep(latency)
+            return method(self, *args, **kwargs)
+        return wrapper
+
+    return mock.patch.multiple(utils.CursorWrapper, execute=slow(execute), executemany=slow(executemany))
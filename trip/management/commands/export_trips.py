@@ -0,0 +1,42 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from trip.exports import EXPORT_CHUNK_SIZE, export_trips, filter_trips, ndjson
+from trip.models import ArchivedTrip, Trip
+from trip.serializers import TripExportSerializer
+
+
+class Command(BaseCommand):
+    help = 'Write live and archived trips as newline-delimited JSON, oldest first.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default='-', help='File to write, or - for stdout.')
+        parser.add_argument('--user', help='Only trips this username rode in or drove.')
+        parser.add_argument('--start', help='Only trips created at or after this ISO 8601 time.')
+        parser.add_argument('--end', help='Only trips created before this ISO 8601 time.')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        serializer = TripExportSerializer(data={
+            name: options[name] for name in ('start', 'end') if options[name] is not None
+        })
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+        querysets = [Trip.objects.all(), ArchivedTrip.objects.all()]
+        if options['user'] is not None:
+            try:
+                user = get_user_model().objects.get(username=options['user'])
+            except get_user_model().DoesNotExist:
+                raise CommandError(f"User {options['user']} does not exist.")
+            querysets = [queryset.filter(Q(rider=user) | Q(driver=user)) for queryset in querysets]
+        querysets = [filter_trips(queryset, **serializer.validated_data) for queryset in querysets]
+        lines = ndjson(export_trips(querysets, chunk_size=options['chunk_size']))
+        if options['output'] == '-':
+            self.write(lines, self.stdout)
+        else:
+            with open(options['output'], 'w') as output:
+                self.write(lines, output)
+
+    def write(self, lines, output):
+        for line in lines:
+            output.write(line)
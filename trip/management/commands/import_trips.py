@@ -0,0 +1,19 @@
+import sys
+from django.core.management.base import BaseCommand
+from trip.exports import IMPORT_BATCH_SIZE, import_trips
+
+
+class Command(BaseCommand):
+    help = 'Load trips from newline-delimited JSON, as written by export_trips, in bulk and count them in the stats.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='File to read, or - for stdin.')
+        parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        if options['input'] == '-':
+            imported, skipped = import_trips(sys.stdin, batch_size=options['batch_size'])
+        else:
+            with open(options['input']) as lines:
+                imported, skipped = import_trips(lines, batch_size=options['batch_size'])
+        self.stdout.write(f'Imported {imported} trips, skipped {skipped} already present or repeated.')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from trip.stats import rebuild_stats
+
+
+class Command(BaseCommand):
+    help = 'Recount the hourly trip stats from the trip and archive tables, replacing what is there.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        counted = rebuild_stats(batch_size=options['batch_size'])
+        self.stdout.write(f'Counted {counted} trips.')
@@ -0,0 +1,54 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+from trip.events import trip_events
+from trip.keys import TimeOrderedKeys
+from trip.models import ArchivedTrip, Trip
+
+
+def is_time_ordered(trip):
+    return trip.nk[:12] == f'{int(trip.created.timestamp() * 1000):012x}'
+
+
+class Command(BaseCommand):
+    help = (
+        'Replace the natural keys of completed and archived trips with time-ordered keys derived from their '
+        'creation time. Live trips keep their keys, since sockets follow them by nk; run this again once they '
+        'complete. Links to the old keys stop working.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        keys, rekeyed = TimeOrderedKeys(), 0
+        for queryset in [Trip.objects.filter(status=Trip.COMPLETED), ArchivedTrip.objects.all()]:
+            rekeyed += self.rekey(queryset, keys, options['batch_size'], options['dry_run'])
+        action = 'Would rekey' if options['dry_run'] else 'Rekeyed'
+        self.stdout.write(f'{action} {rekeyed} trips.')
+
+    def rekey(self, queryset, keys, batch_size, dry_run):
+        # Walk trips in creation order so the new keys sort the same way.
+        queryset = queryset.only('id', 'nk', 'created').order_by('created', 'id')
+        last, rekeyed = None, 0
+        while True:
+            page = queryset if last is None else queryset.filter(created__gte=last.created).exclude(
+                created=last.created, id__lte=last.id
+            )
+            trips = list(page[:batch_size])
+            if not trips:
+                return rekeyed
+            last = trips[-1]
+            stale = [trip for trip in trips if not is_time_ordered(trip)]
+            nks = {trip.id: keys.key(int(trip.created.timestamp() * 1000)) for trip in stale}
+            if stale and not dry_run:
+                with transaction.atomic():
+                    queryset.model.objects.filter(id__in=list(nks)).update(nk=Case(
+                        *[When(id=trip_id, then=Value(nk)) for trip_id, nk in nks.items()],
+                        output_field=CharField()
+                    ))
+                # Nothing will be replayed under the old keys again.
+                cache.delete_many([trip_events.key(trip.nk) for trip in stale])
+            rekeyed += len(stale)
@@ -0,0 +1,26 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from trip.dispatch import BatchDispatcher
+from trip.routers import read_your_writes
+
+
+class Command(BaseCommand):
+    help = 'Offer open trip requests to drivers in batches; pair with DISPATCH_MODE = "batch".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--window', type=float, default=settings.DISPATCH_WINDOW, help='Seconds between ticks.')
+        parser.add_argument('--once', action='store_true', help='Run a single tick and exit.')
+
+    def handle(self, *args, **options):
+        dispatcher = BatchDispatcher()
+        while True:
+            start = time.monotonic()
+            # Pin reads to the primary after a tick's writes, not for good.
+            with read_your_writes(lambda: None):
+                offers = dispatcher.tick()
+            if offers or options['verbosity'] > 1:
+                self.stdout.write(f'Offered {len(offers)} trips in {time.monotonic() - start:.3f}s.')
+            if options['once']:
+                return
+            time.sleep(max(0.0, options['window'] - (time.monotonic() - start)))
@@ -0,0 +1,46 @@
+from channels import channel_layers
+from channels.log import setup_logger
+from channels.management.commands import runworker
+from channels.signals import worker_process_ready
+from channels.staticfiles import StaticFilesConsumer
+from django.apps import apps
+from django.conf import settings
+from django.core.management import CommandError
+from trip.workers import ConcurrentWorker
+
+
+class Command(runworker.Command):
+    help = (
+        'Run a channel worker whose consumers run on a thread pool, keeping each socket\'s messages in order. '
+        'Takes the same options as runworker.'
+    )
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.set_defaults(threads=8)
+        parser.add_argument(
+            '--max-pending', type=int, default=None,
+            help='Messages held at once before the worker stops receiving; four per thread by default.',
+        )
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        self.logger = setup_logger('django.channels', self.verbosity)
+        self.channel_layer = channel_layers[options['layer']]
+        if self.channel_layer.local_only():
+            raise CommandError('The in-memory layer cannot be shared with interface servers; use a cross-process one.')
+        if settings.DEBUG and apps.is_installed('django.contrib.staticfiles'):
+            self.channel_layer.router.check_default(http_consumer=StaticFilesConsumer())
+        else:
+            self.channel_layer.router.check_default()
+        worker = ConcurrentWorker(
+            channel_layer=self.channel_layer,
+            callback=self.consumer_called if self.verbosity > 1 else None,
+            only_channels=options['only_channels'],
+            exclude_channels=options['exclude_channels'],
+            threads=options['threads'],
+            max_pending=options['max_pending'],
+        )
+        worker_process_ready.send(sender=worker)
+        worker.ready()
+        worker.run()
@@ -0,0 +1,376 @@
+import os
+import socket
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+from .subscriptions import layer_backend
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+FANOUT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Metric(ABC):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def get(self, **labels):
+        return self.values.get(self.key(labels))
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.values)
+
+    @abstractmethod
+    def merge(self, snapshots):
+        """Add up `snapshot()` results from several processes."""
+
+    @abstractmethod
+    def samples(self, values):
+        """`(suffix, labels, value)` for each line of merged `values`."""
+
+    def render(self, values):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        for suffix, labels, value in self.samples(values):
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def merge(self, snapshots):
+        merged = {}
+        for values in snapshots:
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def samples(self, values):
+        for key, value in sorted(values.items()):
+            yield '', list(zip(self.labels, key)), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Metric):
+    """Cumulative bucket counts, sum and count of observations per label set."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def snapshot(self):
+        with self.lock:
+            return {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+    def merge(self, snapshots):
+        merged = {}
+        for values in snapshots:
+            for key, (counts, total, count) in values.items():
+                merged_counts, merged_total, merged_count = merged.get(key, ([0] * len(self.buckets), 0, 0))
+                merged[key] = (
+                    [a + b for a, b in zip(merged_counts, counts)], merged_total + total, merged_count + count
+                )
+        return merged
+
+    def samples(self, values):
+        for key, (counts, total, count) in sorted(values.items()):
+            labels = list(zip(self.labels, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield '_bucket', labels + [('le', bound)], bucket_count
+            yield '_bucket', labels + [('le', '+Inf')], count
+            yield '_sum', labels, total
+            yield '_count', labels, count
+
+
+class Registry:
+    """
+    The metrics of this process. Every `publish_interval` seconds a copy is
+    put in the shared cache, and `render` adds up the copies of all live
+    processes, so a scrape answered by any one worker covers the whole fleet.
+    """
+
+    index_key = 'metrics:processes'
+
+    def __init__(self, publish_interval=10, clock=time.monotonic):
+        self.metrics = []
+        self.publish_interval = publish_interval
+        self.clock = clock
+        self.published = None
+        self.key = f'metrics:{socket.gethostname()}:{os.getpid()}'
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def maybe_publish(self):
+        now = self.clock()
+        if self.published is None or now - self.published >= self.publish_interval:
+            self.publish()
+            self.published = now
+
+    def publish(self):
+        timeout = self.publish_interval * 6
+        cache.set(self.key, self.snapshot(), timeout)
+        keys = cache.get(self.index_key, set())
+        if self.key not in keys:
+            cache.set(self.index_key, keys | {self.key}, None)
+
+    def render(self):
+        """All metrics of all live processes in the Prometheus text exposition format."""
+        keys = cache.get(self.index_key, set()) - {self.key}
+        snapshots = cache.get_many(list(keys))
+        if set(snapshots) != keys:
+            # Processes that stopped publishing have expired.
+            cache.set(self.index_key, set(snapshots) | {self.key}, None)
+        snapshots = [self.snapshot()] + list(snapshots.values())
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render(metric.merge(snapshot.get(metric.name, {}) for snapshot in snapshots)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry(publish_interval=settings.METRICS_PUBLISH_INTERVAL)
+handler_seconds = registry.register(Histogram(
+    'taxi_handler_seconds', 'Time spent handling a request or socket message.', ['handler', 'event']
+))
+handler_queries = registry.register(Histogram(
+    'taxi_handler_queries', 'Database queries run while handling a request or socket message.',
+    ['handler', 'event'], buckets=QUERY_BUCKETS
+))
+group_send_fanout = registry.register(Histogram(
+    'taxi_group_send_fanout', 'Sockets reached by one trip broadcast or new trip alert.', ['kind'],
+    buckets=FANOUT_BUCKETS
+))
+connected_sockets = registry.register(Gauge(
+    'taxi_connected_sockets', 'Open sockets per role, as connects minus disconnects seen by this process.',
+    ['role']
+))
+errors = registry.register(Counter(
+    'taxi_errors_total', 'Unhandled exceptions, server error responses and rejected socket messages.',
+    ['handler', 'error']
+))
+
+trip_payload_lookups = registry.register(Counter(
+    'taxi_trip_payload_cache_total', 'Trip payload cache lookups, by whether the current version was cached.',
+    ['result']
+))
+trip_payload_bytes = registry.register(Gauge(
+    'taxi_trip_payload_cache_bytes', 'Rendered trip JSON held by the payload cache.'
+))
+password_rejections = registry.register(Counter(
+    'taxi_password_pool_rejections_total', 'Password hashes and checks refused by the pool, with a 503.', ['reason']
+))
+
+
+def enabled():
+    return settings.METRICS_ENABLED
+
+
+_counts = threading.local()
+
+
+class CountingCursor:
+    """A database cursor that adds each statement it runs to the counts open on its thread."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def execute(self, *args, **kwargs):
+        _count_query()
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _count_query()
+        return self.cursor.executemany(*args, **kwargs)
+
+    def callproc(self, *args, **kwargs):
+        _count_query()
+        return self.cursor.callproc(*args, **kwargs)
+
+
+def _count_query():
+    for counts in getattr(_counts, 'open', ()):
+        counts[0] += 1
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the statements this thread runs on any database alias inside the
+    block, without the SQL formatting of debug cursors. Yields a one-item
+    list holding the count.
+    """
+    for alias in connections:
+        wrapper = connections[alias]
+        # Connections are per thread, so each one is hooked once, the first time its thread counts.
+        if not getattr(wrapper, 'counts_queries', False):
+            wrapper.create_cursor = _counting(wrapper.create_cursor)
+            wrapper.counts_queries = True
+    counts = [0]
+    if not hasattr(_counts, 'open'):
+        _counts.open = []
+    _counts.open.append(counts)
+    try:
+        yield counts
+    finally:
+        _counts.open.remove(counts)
+
+
+def _counting(create_cursor):
+    def wrapper(*args, **kwargs):
+        return CountingCursor(create_cursor(*args, **kwargs))
+    return wrapper
+
+
+@contextmanager
+def track(handler, event):
+    """
+    Time the block and count its database queries, on every database alias,
+    under `handler` and `event`. Yields the labels, so the block can refine
+    them once it knows more, such as which view a URL resolved to.
+    """
+    labels = {'handler': handler, 'event': event}
+    if not enabled():
+        yield labels
+        return
+    with count_queries() as queries:
+        start = time.perf_counter()
+        try:
+            yield labels
+        except Exception as exception:
+            errors.inc(handler=labels['handler'], error=type(exception).__name__)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - start, **labels)
+            handler_queries.observe(queries[0], **labels)
+            registry.maybe_publish()
+
+
+def observe_group_fanout(kind, groups):
+    """Record how many sockets `groups` reach together. Costs one channel layer call per group."""
+    if not enabled():
+        return
+    backend = layer_backend()
+    group_send_fanout.observe(sum(len(backend.group_channels(group)) for group in groups), kind=kind)
+
+
+def observe_fanout(kind, size):
+    if enabled():
+        group_send_fanout.observe(size, kind=kind)
+
+
+def observe_payload_cache(hit, size):
+    if enabled():
+        trip_payload_lookups.inc(result='hit' if hit else 'miss')
+        trip_payload_bytes.set(size)
+
+
+def observe_password_rejection(reason):
+    if enabled():
+        password_rejections.inc(reason=reason)
+
+
+def socket_opened(role):
+    if enabled():
+        connected_sockets.inc(role=role)
+
+
+def socket_closed(role):
+    if enabled():
+        connected_sockets.dec(role=role)
+
+
+def count_error(handler, name):
+    if enabled():
+        errors.inc(handler=handler, error=name)
+
+
+class MetricsMiddleware:
+    """Records latency, query counts and server errors for every HTTP view."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not enabled():
+            return self.get_response(request)
+        with track('http', 'unresolved') as labels:
+            response = self.get_response(request)
+            if request.resolver_match is not None:
+                labels['event'] = request.resolver_match.view_name
+        if response.status_code >= 500:
+            errors.inc(handler='http', error=response.status_code)
+        return response
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = ','.join(f'{name}="{_escape(value)}"' for name, value in labels)
+    return f'{{{pairs}}}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
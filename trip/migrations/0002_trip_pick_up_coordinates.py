@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 20:18
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trip', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='pick_up_latitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='trip',
+            name='pick_up_longitude',
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 20:20
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trip', '0002_trip_pick_up_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DriverLocation',
+            fields=[
+                ('driver', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='location', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('latitude', models.FloatField()),
+                ('longitude', models.FloatField()),
+                ('updated', models.DateTimeField()),
+            ],
+        ),
+    ]
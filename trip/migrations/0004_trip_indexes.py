@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 20:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trip', '0003_driverlocation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['rider', 'created'], name='trip_trip_rider_i_e3d446_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='trip',
+            index=models.Index(fields=['driver', 'status'], name='trip_trip_driver__27a8de_idx'),
+        ),
+        # Django 1.11 cannot declare partial indexes, so the open-request index is created by hand.
+        migrations.RunSQL(
+            ["CREATE INDEX trip_trip_requested_idx ON trip_trip (created, id) WHERE status = 'REQUESTED'"],
+            ['DROP INDEX trip_trip_requested_idx'],
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 20:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trip', '0004_trip_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='trip',
+            name='version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
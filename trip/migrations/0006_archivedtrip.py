@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 20:36
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trip', '0005_trip_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedTrip',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('nk', models.CharField(max_length=32, unique=True)),
+                ('created', models.DateTimeField()),
+                ('updated', models.DateTimeField()),
+                ('pick_up_address', models.CharField(max_length=255)),
+                ('drop_off_address', models.CharField(max_length=255)),
+                ('pick_up_latitude', models.FloatField(blank=True, null=True)),
+                ('pick_up_longitude', models.FloatField(blank=True, null=True)),
+                ('status', models.CharField(choices=[('REQUESTED', 'REQUESTED'), ('STARTED', 'STARTED'), ('IN_PROGRESS', 'IN_PROGRESS'), ('COMPLETED', 'COMPLETED')], default='COMPLETED', max_length=20)),
+                ('version', models.PositiveIntegerField(default=0)),
+                ('driver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_trips_as_driver', to=settings.AUTH_USER_MODEL)),
+                ('rider', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='archived_trips_as_rider', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedtrip',
+            index=models.Index(fields=['rider', 'created'], name='trip_archiv_rider_i_b613ea_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedtrip',
+            index=models.Index(fields=['driver', 'created'], name='trip_archiv_driver__2e954c_idx'),
+        ),
+    ]
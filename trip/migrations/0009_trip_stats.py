@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2026-10-16 22:39
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('trip', '0008_trip_estimates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TripStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('status', models.CharField(choices=[('REQUESTED', 'REQUESTED'), ('STARTED', 'STARTED'), ('IN_PROGRESS', 'IN_PROGRESS'), ('COMPLETED', 'COMPLETED')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('wait_count', models.PositiveIntegerField(default=0)),
+                ('wait_seconds', models.FloatField(default=0)),
+                ('driver', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='trip_stats', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='tripstats',
+            index=models.Index(fields=['driver', 'hour'], name='trip_tripst_driver__7ef4fd_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='tripstats',
+            unique_together=set([('hour', 'status', 'driver')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min, Sum
+
+
+def merge_duplicate_buckets(apps, schema_editor):
+    # Two processes could both insert the first driverless row of an hour.
+    TripStats = apps.get_model('trip', 'TripStats')
+    stats = TripStats.objects.using(schema_editor.connection.alias).filter(driver=None)
+    duplicates = stats.values('hour', 'status').annotate(
+        rows=Count('id'), keep=Min('id'), total=Sum('count'), waits=Sum('wait_count'), waited=Sum('wait_seconds')
+    ).filter(rows__gt=1)
+    for bucket in duplicates:
+        stats.filter(id=bucket['keep']).update(
+            count=bucket['total'], wait_count=bucket['waits'], wait_seconds=bucket['waited']
+        )
+        stats.filter(hour=bucket['hour'], status=bucket['status']).exclude(id=bucket['keep']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('trip', '0009_trip_stats'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_buckets, migrations.RunPython.noop),
+        migrations.RunSQL(
+            ['CREATE UNIQUE INDEX trip_tripstats_hour_status_no_driver '
+             'ON trip_tripstats (hour, status) WHERE driver_id IS NULL'],
+            ['DROP INDEX trip_tripstats_hour_status_no_driver'],
+        ),
+    ]
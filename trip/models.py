@@ -1,8 +1,35 @@
-import datetime
-import hashlib
 from django.conf import settings
 from django.db import models
 from django.shortcuts import reverse
+from django.utils import timezone
+from .keys import generate_nk
+
+
+class TripQuerySet(models.QuerySet):
+    def requested(self):
+        # A literal predicate, unlike a bound parameter, lets the database use
+        # the partial index on open requests.
+        return self.extra(where=[f"{Trip._meta.db_table}.status = '{Trip.REQUESTED}'"])
+
+    def transition(self, nk, status, driver, offered=False):
+        """
+        Move trip `nk` to `status` with a single conditional UPDATE that only
+        matches while the trip is still in the preceding status. A requested
+        trip goes to whichever driver claims it first, or with `offered` only
+        to the driver holding an unexpired dispatch offer for it; later steps
+        are only open to that driver. Returns whether this call made the change.
+        """
+        queryset = self.filter(nk=nk, status=Trip.TRANSITIONS[status])
+        if status != Trip.STARTED:
+            queryset = queryset.filter(driver=driver)
+        elif offered:
+            queryset = queryset.filter(offered_to=driver, offer_expires__gt=timezone.now())
+        return queryset.update(
+            status=status,
+            driver=driver,
+            updated=timezone.now(),
+            version=models.F('version') + 1
+        ) == 1
 
 
 class Trip(models.Model):
@@ -16,26 +43,169 @@ class Trip(models.Model):
         (IN_PROGRESS, IN_PROGRESS),
         (COMPLETED, COMPLETED),
     )
+    # Status a trip must be in to move to each status.
+    TRANSITIONS = {
+        STARTED: REQUESTED,
+        IN_PROGRESS: STARTED,
+        COMPLETED: IN_PROGRESS,
+    }
 
     nk = models.CharField(max_length=32, unique=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     pick_up_address = models.CharField(max_length=255)
     drop_off_address = models.CharField(max_length=255)
+    pick_up_latitude = models.FloatField(null=True, blank=True)
+    pick_up_longitude = models.FloatField(null=True, blank=True)
+    drop_off_latitude = models.FloatField(null=True, blank=True)
+    drop_off_longitude = models.FloatField(null=True, blank=True)
+    # Estimated when the trip is requested: kilometers, seconds and the fare.
+    distance = models.FloatField(null=True, blank=True)
+    duration = models.PositiveIntegerField(null=True, blank=True)
+    fare = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
     status = models.CharField(max_length=20, choices=TRIP_STATUSES, default=REQUESTED)
+    version = models.PositiveIntegerField(default=0)
     driver = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='trips_as_driver')
     rider = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='trips_as_rider')
+    # The driver the batch dispatcher last offered the trip to, and until when.
+    offered_to = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='trip_offers')
+    offer_expires = models.DateTimeField(null=True, blank=True)
+
+    objects = TripQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['rider', 'created']),
+            models.Index(fields=['driver', 'status']),
+        ]
 
     def save(self, **kwargs):
         if not self.nk:
-            now = datetime.datetime.now()
-            secure_hash = hashlib.md5()
-            secure_hash.update(f'{now}:{self.pick_up_address}:{self.drop_off_address}'.encode('utf-8'))
-            self.nk = secure_hash.hexdigest()
-        super().save(**kwargs)
+            self.nk = generate_nk(self)
+        if self._state.adding:
+            self.version += 1
+            super().save(**kwargs)
+            return
+        # Counted in the database, so a stale instance cannot reuse a version
+        # that another save has already handed out.
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'version'}
+        version, self.version = self.version, models.F('version') + 1
+        try:
+            super().save(**kwargs)
+        except Exception:
+            self.version = version
+            raise
+        self.refresh_from_db(using=self._state.db, fields=['version'])
+
+    def get_absolute_url(self):
+        return reverse('trip:trip_detail', kwargs={'trip_nk': self.nk})
+
+    def __str__(self):
+        return self.nk
+
+
+class ArchivedTrip(models.Model):
+    """
+    Completed trips moved out of the `Trip` table by `archive_trips`, so the
+    hot table and its indexes only hold live trips. Rows keep their original
+    id, which makes a trip caught mid-move easy to de-duplicate.
+    """
+
+    id = models.IntegerField(primary_key=True)
+    nk = models.CharField(max_length=32, unique=True)
+    created = models.DateTimeField()
+    updated = models.DateTimeField()
+    pick_up_address = models.CharField(max_length=255)
+    drop_off_address = models.CharField(max_length=255)
+    pick_up_latitude = models.FloatField(null=True, blank=True)
+    pick_up_longitude = models.FloatField(null=True, blank=True)
+    drop_off_latitude = models.FloatField(null=True, blank=True)
+    drop_off_longitude = models.FloatField(null=True, blank=True)
+    distance = models.FloatField(null=True, blank=True)
+    duration = models.PositiveIntegerField(null=True, blank=True)
+    fare = models.DecimalField(max_digits=8, decimal_places=2, null=True, blank=True)
+    status = models.CharField(max_length=20, choices=Trip.TRIP_STATUSES, default=Trip.COMPLETED)
+    version = models.PositiveIntegerField(default=0)
+    driver = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, related_name='archived_trips_as_driver'
+    )
+    rider = models.ForeignKey(
+        settings.AUTH_USER_MODEL, null=True, blank=True, related_name='archived_trips_as_rider'
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['rider', 'created']),
+            models.Index(fields=['driver', 'created']),
+        ]
 
     def get_absolute_url(self):
         return reverse('trip:trip_detail', kwargs={'trip_nk': self.nk})
 
     def __str__(self):
         return self.nk
+
+
+class DriverLocation(models.Model):
+    driver = models.OneToOneField(settings.AUTH_USER_MODEL, primary_key=True, related_name='location')
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+    updated = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.driver_id}: {self.latitude}, {self.longitude}'
+
+
+class Address(models.Model):
+    """Where the geocoding provider placed an address, keyed by its normalized form."""
+
+    normalized = models.CharField(max_length=255, unique=True)
+    latitude = models.FloatField()
+    longitude = models.FloatField()
+
+    def __str__(self):
+        return self.normalized
+
+
+class Route(models.Model):
+    """The provider's driving estimate between two normalized addresses."""
+
+    origin = models.CharField(max_length=255)
+    destination = models.CharField(max_length=255)
+    distance = models.FloatField()
+    duration = models.PositiveIntegerField()
+
+    class Meta:
+        unique_together = ('origin', 'destination')
+
+    def __str__(self):
+        return f'{self.origin} -> {self.destination}'
+
+
+class TripStats(models.Model):
+    """
+    Trips that reached `status` during the hour starting at `hour`, kept up to
+    date by `trip.stats` as trips change status. Rows without a driver count
+    every trip; completions are also counted per driver. Rows for STARTED add
+    up the seconds each of those trips waited since it was requested. There
+    is one row per hour, status and driver, rows without a driver included.
+    """
+
+    hour = models.DateTimeField()
+    status = models.CharField(max_length=20, choices=Trip.TRIP_STATUSES)
+    driver = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, related_name='trip_stats')
+    count = models.PositiveIntegerField(default=0)
+    wait_count = models.PositiveIntegerField(default=0)
+    wait_seconds = models.FloatField(default=0)
+
+    class Meta:
+        # NULLs never clash in a unique constraint, so migration 0010 adds a
+        # partial unique index on (hour, status) for rows without a driver.
+        unique_together = ('hour', 'status', 'driver')
+        indexes = [
+            models.Index(fields=['driver', 'hour']),
+        ]
+
+    def __str__(self):
+        return f'{self.hour:%Y-%m-%d %H:00} {self.status}: {self.count}'
@@ -0,0 +1,96 @@
+import base64
+import binascii
+from collections import OrderedDict
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+def encode_cursor(created, pk):
+    position = f'{created.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        created, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        created, pk = parse_datetime(created), int(pk)
+    except (TypeError, ValueError, UnicodeError, binascii.Error):
+        raise NotFound('Invalid cursor.')
+    if created is None:
+        raise NotFound('Invalid cursor.')
+    return created, pk
+
+
+def after(queryset, created, pk):
+    """Rows strictly after `(created, pk)`, phrased so an index on `created` can serve the range."""
+    return queryset.filter(created__gte=created).filter(Q(created__gt=created) | Q(id__gt=pk))
+
+
+def before(queryset, created, pk):
+    """Rows strictly before `(created, pk)`, the mirror image of `after`."""
+    return queryset.filter(created__lte=created).filter(Q(created__lt=created) | Q(id__lt=pk))
+
+
+class KeysetPagination(BasePagination):
+    """
+    Pages through trips newest first, in descending `(created, id)` order.
+    The cursor is an opaque encoding of the last row seen, so each page is a
+    (backward) index range scan no matter how deep into the history it is.
+
+    A list of querysets may be paginated as one: each is read up to a page
+    past the cursor and the rows are merged, which lets every branch of an
+    OR filter use its own index.
+    """
+
+    ordering = ('-created', '-id')
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 50
+    max_page_size = 200
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        rows = {}
+        for branch in self.page_querysets(queryset, request):
+            for row in branch:
+                rows.setdefault(row.id, row)
+        rows = sorted(rows.values(), key=lambda row: (row.created, row.id), reverse=True)
+        page = rows[:self.page_size]
+        self.next_cursor = encode_cursor(page[-1].created, page[-1].id) if len(rows) > self.page_size else None
+        return page
+
+    def page_querysets(self, queryset, request):
+        """The slice of each of the querysets that the page `request` asks for is merged from."""
+        self.page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        position = decode_cursor(cursor) if cursor else None
+        branches = queryset if isinstance(queryset, (list, tuple)) else [queryset]
+        return [self.page_queryset(branch, position) for branch in branches]
+
+    def page_queryset(self, queryset, position=None):
+        queryset = queryset.order_by(*self.ordering)
+        if position is not None:
+            queryset = before(queryset, *position)
+        return queryset[:self.page_size + 1]
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return max(1, min(page_size, self.max_page_size))
+
+    def get_next_link(self):
+        if self.next_cursor is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(), self.cursor_query_param, self.next_cursor)
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
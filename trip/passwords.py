@@ -0,0 +1,131 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from django.contrib.auth import hashers
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from .metrics import observe_password_rejection
+
+
+class PasswordPoolBusy(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-ins right now, try again shortly.'
+    default_code = 'password_pool_busy'
+    # Sent as Retry-After.
+    wait = 1
+
+
+class PasswordPool:
+    """
+    Hashes and checks passwords in `processes` worker processes, so PBKDF2
+    never holds more than that many cores however many logins arrive. At most
+    `max_pending` calls run or wait at once; the next one raises
+    `PasswordPoolBusy` straight away instead of holding a request thread in
+    the queue, as does one still unanswered after `timeout` seconds. With no
+    processes, calls run on the caller's thread, bounded the same way.
+
+    The processes run `niceness` steps below this one, so on a busy machine
+    hashing waits for request handling rather than the other way round.
+    """
+
+    def __init__(self, processes=2, max_pending=16, timeout=5.0, niceness=10):
+        self.processes = processes
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.niceness = niceness
+        self.pending = 0
+        self.executor = None
+        self.lock = threading.Lock()
+
+    @property
+    def full(self):
+        return self.pending >= self.max_pending
+
+    def check_capacity(self):
+        """Raise `PasswordPoolBusy` if a call now would be refused, so callers can stop before other work."""
+        if self.full:
+            observe_password_rejection('busy')
+            raise PasswordPoolBusy()
+
+    def make_password(self, password):
+        return self.run(hashers.make_password, password)
+
+    def check_password(self, password, encoded):
+        return self.run(hashers.check_password, password, encoded)
+
+    def run(self, function, *args):
+        with self.lock:
+            self.check_capacity()
+            self.pending += 1
+        if not self.processes:
+            try:
+                return function(*args)
+            finally:
+                self.release()
+        try:
+            future = self.get_executor().submit(_in_worker, self.niceness, function, *args)
+        except BrokenProcessPool:
+            self.release()
+            self.reset()
+            raise PasswordPoolBusy()
+        # The slot stays taken until the process is done, even after a timeout.
+        future.add_done_callback(self.release)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            observe_password_rejection('timeout')
+            raise PasswordPoolBusy()
+        except BrokenProcessPool:
+            # A worker process died; the next call starts a fresh pool.
+            observe_password_rejection('broken')
+            self.reset()
+            raise PasswordPoolBusy()
+
+    def release(self, future=None):
+        with self.lock:
+            self.pending -= 1
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor is None:
+                # Forking would copy a process already running request and
+                # channel threads, along with any locks they hold.
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+                self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+            return self.executor
+
+    def reset(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None:
+            # A hung worker must not hold up the request that found it. The
+            # thread keeps the executor alive until its workers have exited.
+            threading.Thread(target=executor.shutdown, daemon=True).start()
+
+
+def _in_worker(niceness, function, *args):
+    global _niced
+    if not _niced:
+        os.nice(niceness)
+        _niced = True
+    return function(*args)
+
+
+_niced = False
+
+
+def password_needs_update(encoded):
+    """Whether `encoded` was hashed with another algorithm or settings than the preferred hasher's."""
+    preferred = hashers.get_hasher('default')
+    try:
+        hasher = hashers.identify_hasher(encoded)
+    except ValueError:
+        return False
+    return hasher.algorithm != preferred.algorithm or hasher.must_update(encoded)
+
+
+password_pool = PasswordPool(**settings.PASSWORD_POOL)
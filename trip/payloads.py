@@ -0,0 +1,59 @@
+import json
+from collections import OrderedDict, namedtuple
+from django.http import QueryDict
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+ENCODINGS = (JSON, MSGPACK) if msgpack is not None else (JSON,)
+
+
+class Format(namedtuple('Format', ['delta', 'encoding'])):
+    """
+    How a socket wants trip updates: whole trips or only changed fields, as
+    JSON text or msgpack binary frames. Every format has its own groups, so
+    a broadcast encodes each payload once per format rather than per socket.
+    """
+
+    @classmethod
+    def from_query_string(cls, query_string):
+        params = QueryDict(query_string)
+        encoding = params.get('encoding', JSON)
+        return cls(
+            delta=params.get('delta') in ('1', 'true'),
+            encoding=encoding if encoding in ENCODINGS else JSON
+        )
+
+    def group(self, name, delta=True):
+        if delta and self.delta:
+            name = f'{name}.delta'
+        if self.encoding != JSON:
+            name = f'{name}.{self.encoding}'
+        return name
+
+
+DEFAULT_FORMAT = Format(delta=False, encoding=JSON)
+FORMATS = [Format(delta, encoding) for encoding in ENCODINGS for delta in (False, True)]
+
+
+def encode(content, encoding=JSON):
+    """Build the channel message carrying `content` as a text or binary frame."""
+    if encoding == MSGPACK:
+        return {'bytes': msgpack.packb(content, use_bin_type=True)}
+    return {'text': json.dumps(content)}
+
+
+def trip_delta(previous, current):
+    """The fields of `current` that differ from `previous`, tagged with the new version."""
+    return OrderedDict([
+        ('type', 'delta'),
+        ('nk', current['nk']),
+        ('version', current['version']),
+        ('changes', OrderedDict(
+            (name, value) for name, value in current.items() if previous.get(name) != value and name != 'version'
+        )),
+    ])
@@ -0,0 +1,288 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from asgi_redis import RedisChannelLayer
+from django.conf import settings
+from .subscriptions import layer_backend
+
+# KEYS: online, available, channels. Drops drivers whose last heartbeat is
+# older than ARGV[1] from all three, a thousand at a time to keep `unpack` safe.
+EXPIRE = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, 1000)
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+    redis.call('ZREM', KEYS[2], unpack(expired))
+    redis.call('HDEL', KEYS[3], unpack(expired))
+end
+return #expired
+"""
+
+# KEYS: online, available, channels. ARGV: driver, now, the expiry cutoff and,
+# when the driver connects, the channel and '1' or '0' for available. A bare
+# heartbeat only refreshes drivers still online, so it cannot revive one that
+# expired, even before EXPIRE got round to dropping them.
+HEARTBEAT = """
+if ARGV[4] then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[4])
+    if ARGV[5] == '1' then
+        redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+    else
+        redis.call('ZREM', KEYS[2], ARGV[1])
+    end
+else
+    local heartbeat = redis.call('ZSCORE', KEYS[1], ARGV[1])
+    if not heartbeat then
+        return 0
+    end
+    if tonumber(heartbeat) <= tonumber(ARGV[3]) then
+        redis.call('ZREM', KEYS[1], ARGV[1])
+        redis.call('ZREM', KEYS[2], ARGV[1])
+        redis.call('HDEL', KEYS[3], ARGV[1])
+        return 0
+    end
+    if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+        redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+    end
+end
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+return 1
+"""
+
+# KEYS: online, available, channels. ARGV: driver, channel. Only forgets the
+# driver while `channel` is still theirs; a newer socket keeps them online.
+DISCONNECT = """
+if redis.call('HGET', KEYS[3], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+return 1
+"""
+
+# KEYS: online, available. ARGV: driver, '1' or '0'.
+SET_AVAILABLE = """
+local heartbeat = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if ARGV[2] == '1' and heartbeat then
+    redis.call('ZADD', KEYS[2], heartbeat, ARGV[1])
+elseif ARGV[2] ~= '1' then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+
+class Presence:
+    """
+    Which drivers are online and free to take a trip, held in this process.
+    Each driver has one current socket `channel` (the latest to connect) and
+    stays online for `ttl` seconds after their last heartbeat. Drivers are
+    kept in heartbeat order, so expiring them only looks at the stale end
+    and counting the available ones is a `len`.
+    """
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.online = OrderedDict()
+        self.available_drivers = OrderedDict()
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.online.clear()
+            self.available_drivers.clear()
+            self.channels.clear()
+
+    def connect(self, driver_id, channel, available):
+        with self.lock:
+            self.channels[driver_id] = channel
+            self._touch(driver_id)
+            if available:
+                self._set(self.available_drivers, driver_id, self.online[driver_id])
+            else:
+                self.available_drivers.pop(driver_id, None)
+
+    def heartbeat(self, driver_id):
+        with self.lock:
+            self._expire()
+            if driver_id in self.online:
+                self._touch(driver_id)
+
+    def disconnect(self, driver_id, channel):
+        with self.lock:
+            if self.channels.get(driver_id) == channel:
+                self._forget(driver_id)
+
+    def set_available(self, driver_id, available):
+        with self.lock:
+            self._expire()
+            if available and driver_id in self.online:
+                self._set(self.available_drivers, driver_id, self.online[driver_id])
+            elif not available:
+                self.available_drivers.pop(driver_id, None)
+
+    def available(self, driver_ids=None):
+        """The drivers among `driver_ids` (or all drivers) that are online and available."""
+        with self.lock:
+            self._expire()
+            if driver_ids is None:
+                return set(self.available_drivers)
+            return {driver_id for driver_id in driver_ids if driver_id in self.available_drivers}
+
+    def available_channels(self):
+        """The current channel of every online, available driver."""
+        with self.lock:
+            self._expire()
+            return [self.channels[driver_id] for driver_id in self.available_drivers]
+
+    def count(self):
+        with self.lock:
+            self._expire()
+            return len(self.available_drivers)
+
+    def _touch(self, driver_id):
+        now = self.clock()
+        self._set(self.online, driver_id, now)
+        if driver_id in self.available_drivers:
+            self._set(self.available_drivers, driver_id, now)
+
+    def _set(self, drivers, driver_id, heartbeat):
+        drivers[driver_id] = heartbeat
+        drivers.move_to_end(driver_id)
+
+    def _expire(self):
+        cutoff = self.clock() - self.ttl
+        while self.online:
+            driver_id, heartbeat = next(iter(self.online.items()))
+            if heartbeat > cutoff:
+                break
+            self._forget(driver_id)
+
+    def _forget(self, driver_id):
+        self.online.pop(driver_id, None)
+        self.available_drivers.pop(driver_id, None)
+        self.channels.pop(driver_id, None)
+
+
+class RedisPresence:
+    """
+    The same registry in the channel layer's Redis, shared by every worker:
+    sorted sets of drivers by last heartbeat, one for online and one for
+    available drivers, and a hash of their current channels.
+    """
+
+    def __init__(self, ttl, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self.scripts = {}
+
+    def connect(self, backend, driver_id, channel, available):
+        now = self.clock()
+        self._run(backend, HEARTBEAT, driver_id, now, now - self.ttl, json.dumps(channel), '1' if available else '0')
+
+    def heartbeat(self, backend, driver_id):
+        now = self.clock()
+        self._run(backend, HEARTBEAT, driver_id, now, now - self.ttl)
+
+    def disconnect(self, backend, driver_id, channel):
+        self._run(backend, DISCONNECT, driver_id, json.dumps(channel))
+
+    def set_available(self, backend, driver_id, available):
+        self._run(backend, SET_AVAILABLE, driver_id, '1' if available else '0')
+
+    def available(self, backend, driver_ids=None):
+        if driver_ids is None:
+            self._run(backend, EXPIRE, self.clock() - self.ttl)
+            return {int(driver_id) for driver_id in self._connection(backend).zrange(self._keys(backend)[1], 0, -1)}
+        driver_ids = list(driver_ids)
+        if not driver_ids:
+            return set()
+        self._run(backend, EXPIRE, self.clock() - self.ttl)
+        pipeline = self._connection(backend).pipeline(transaction=False)
+        for driver_id in driver_ids:
+            pipeline.zscore(self._keys(backend)[1], driver_id)
+        return {driver_id for driver_id, score in zip(driver_ids, pipeline.execute()) if score is not None}
+
+    def available_channels(self, backend):
+        self._run(backend, EXPIRE, self.clock() - self.ttl)
+        online, available, channels = self._keys(backend)
+        drivers = self._connection(backend).zrange(available, 0, -1)
+        if not drivers:
+            return []
+        return [
+            tuple(json.loads(channel.decode('utf-8')))
+            for channel in self._connection(backend).hmget(channels, drivers) if channel is not None
+        ]
+
+    def count(self, backend):
+        self._run(backend, EXPIRE, self.clock() - self.ttl)
+        return self._connection(backend).zcard(self._keys(backend)[1])
+
+    def _keys(self, backend):
+        return [f'{backend.prefix}presence:{name}' for name in ('online', 'available', 'channels')]
+
+    def _connection(self, backend):
+        # All three keys live on one shard so the scripts can touch them together.
+        return backend.connection(backend.consistent_hash(f'{backend.prefix}presence'))
+
+    def _run(self, backend, script, *args):
+        index = backend.consistent_hash(f'{backend.prefix}presence')
+        if (index, script) not in self.scripts:
+            self.scripts[(index, script)] = backend.connection(index).register_script(script)
+        return self.scripts[(index, script)](keys=self._keys(backend), args=list(args))
+
+
+presence = Presence(ttl=settings.PRESENCE_TTL)
+redis_presence = RedisPresence(ttl=settings.PRESENCE_TTL)
+
+
+# When this process last sent each driver's heartbeat on; location pings
+# arrive far more often than the TTL calls for.
+heartbeats_sent = {}
+
+
+def driver_connected(driver_id, channel, available):
+    """Mark the driver online on `channel`, which becomes their current socket."""
+    heartbeats_sent[driver_id] = time.monotonic()
+    _call('connect', driver_id, channel, available)
+
+
+def driver_heartbeat(driver_id):
+    now = time.monotonic()
+    if now - heartbeats_sent.get(driver_id, float('-inf')) < settings.PRESENCE_TTL / 4:
+        return
+    heartbeats_sent[driver_id] = now
+    _call('heartbeat', driver_id)
+
+
+def driver_disconnected(driver_id, channel):
+    heartbeats_sent.pop(driver_id, None)
+    _call('disconnect', driver_id, channel)
+
+
+def set_driver_available(driver_id, available):
+    _call('set_available', driver_id, available)
+
+
+def available_drivers(driver_ids=None):
+    """The online drivers not on a trip, among `driver_ids` if given."""
+    return _call('available', driver_ids)
+
+
+def available_channels():
+    """`(channel, encoding)` of every online driver not on a trip."""
+    return _call('available_channels')
+
+
+def available_count():
+    return _call('count')
+
+
+def _call(name, *args):
+    backend = layer_backend()
+    if isinstance(backend, RedisChannelLayer):
+        return getattr(redis_presence, name)(backend, *args)
+    return getattr(presence, name)(*args)
@@ -0,0 +1,134 @@
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from django.conf import settings
+from rest_framework.renderers import JSONRenderer
+from .cache import LRUCache
+from .metrics import observe_payload_cache
+from .payloads import JSON, encode
+from .serializers import serialize_trip
+
+RenderedTrip = namedtuple('RenderedTrip', ['version', 'data', 'json', 'user_ids'])
+
+_json_renderer = JSONRenderer()
+
+
+class TripPayloadCache:
+    """
+    Trips already serialized, together with the JSON bytes they render to,
+    so REST responses and socket broadcasts of an unchanged trip skip
+    `serialize_trip` and `json.dumps`. An entry is only used for the version
+    it was rendered from; saving a newer version replaces it. `max_bytes`
+    caps the rendered JSON kept, and the parsed copies take roughly as much
+    again. Renames and group changes are only discarded in the process that
+    made them, so entries also expire after `ttl` seconds.
+    """
+
+    def __init__(self, max_size=10000, max_bytes=32 * 1024 * 1024, ttl=300):
+        self.entries = LRUCache(
+            max_size=max_size, ttl=ttl, max_weight=max_bytes, weigh=lambda rendered: len(rendered.json)
+        )
+        # User id -> nks of their cached trips. Evicted trips stay listed until
+        # the index is rebuilt, after `max_size` more trips have been added.
+        self.user_nks = defaultdict(set)
+        self.indexed = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, nk, version):
+        """The rendering of trip `nk` at `version`, or None."""
+        rendered = self.entries.get(nk)
+        hit = rendered is not None and rendered.version == version
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        observe_payload_cache(hit, self.entries.weight)
+        return rendered if hit else None
+
+    def put(self, trip):
+        """Serialize and render `trip`, and cache the result."""
+        data = serialize_trip(trip)
+        rendered = RenderedTrip(trip.version, data, _json_renderer.render(data), (trip.driver_id, trip.rider_id))
+        current = self.entries.peek(trip.nk)
+        # A slow reader may have loaded the trip before someone else saved a newer version.
+        if current is None or current.version < trip.version:
+            self.entries.set(trip.nk, rendered)
+            self._index(trip.nk, rendered.user_ids)
+        return rendered
+
+    def render(self, trip):
+        """`trip` as a `RenderedTrip`, serializing it only when its version is not cached."""
+        return self.get(trip.nk, trip.version) or self.put(trip)
+
+    def json(self, data):
+        """The cached JSON of `data`, if it is the very dict this cache handed out."""
+        rendered = self.entries.peek(data.get('nk')) if isinstance(data, dict) else None
+        return rendered.json if rendered is not None and rendered.data is data else None
+
+    def discard(self, nk):
+        self.entries.delete(nk)
+
+    def discard_users(self, user_ids):
+        """Drop the trips of `user_ids`, whose usernames or groups may have changed without a new trip version."""
+        with self.lock:
+            nks = set().union(*[self.user_nks.pop(user_id, ()) for user_id in user_ids])
+        for nk in nks:
+            self.entries.delete(nk)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.user_nks.clear()
+            self.indexed = 0
+
+    def _index(self, nk, user_ids):
+        with self.lock:
+            self.indexed += 1
+            if self.indexed > self.entries.max_size:
+                self.user_nks.clear()
+                for cached_nk, cached in self.entries.items():
+                    self._add(cached_nk, cached.user_ids)
+                self.indexed = 0
+            self._add(nk, user_ids)
+
+    def _add(self, nk, user_ids):
+        for user_id in user_ids:
+            if user_id is not None:
+                self.user_nks[user_id].add(nk)
+
+
+trip_payloads = TripPayloadCache(**settings.TRIP_PAYLOAD_CACHE)
+
+
+def encode_rendered(rendered, encoding=JSON):
+    """Like `encode(rendered.data, encoding)`, reusing the cached JSON for text frames."""
+    if encoding == JSON:
+        return {'text': rendered.json.decode('utf-8')}
+    return encode(rendered.data, encoding)
+
+
+class TripJSONRenderer(JSONRenderer):
+    """
+    JSON renderer that copies in the cached bytes of trips handed out by
+    `trip_payloads`, whether the response is one trip or a page of them.
+    Anything else, and indented output, is rendered as usual.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if self.get_indent(accepted_media_type, renderer_context or {}) is None:
+            cached = trip_payloads.json(data)
+            if cached is not None:
+                return cached
+            if isinstance(data, dict) and isinstance(data.get('results'), list):
+                trips = [trip_payloads.json(trip) for trip in data['results']]
+                if trips and None not in trips:
+                    envelope = super().render(
+                        OrderedDict(data, results=[]), accepted_media_type, renderer_context
+                    )
+                    head, _, tail = envelope.rpartition(b'"results":[]')
+                    return b''.join([head, b'"results":[', b','.join(trips), b']', tail])
+        return super().render(data, accepted_media_type, renderer_context)
@@ -0,0 +1,101 @@
+import random
+import threading
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+
+_state = threading.local()
+
+
+def pin_key(user_id):
+    return f'primary-reads:{user_id}'
+
+
+def pin_cache():
+    return caches[settings.READ_YOUR_WRITES_CACHE]
+
+
+class ReplicaRouter:
+    """
+    Sends writes to the primary and reads to a random one of
+    `DATABASE_REPLICAS`. Inside `read_your_writes`, reads go to the primary
+    after the block has written anything, or when its user wrote within the
+    last `READ_YOUR_WRITES_WINDOW` seconds, so nobody sees their own changes
+    go missing while the replicas catch up. Writes are remembered in the
+    `READ_YOUR_WRITES_CACHE` cache, which every process must share.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or _reads_pinned():
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        # Channel sessions are saved on most socket messages; they don't count.
+        if model._meta.app_label != 'sessions':
+            _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def read_your_writes(get_user):
+    """
+    Scope for one request or socket message. `get_user` returns the acting
+    user once known; it is called lazily, since authentication itself reads
+    from the database. When the block writes, that user's reads stick to the
+    primary for `READ_YOUR_WRITES_WINDOW` seconds.
+    """
+    _state.get_user, _state.user_pinned, _state.wrote = get_user, None, False
+    try:
+        yield
+    finally:
+        user_id = _user_id() if _state.wrote and settings.DATABASE_REPLICAS else None
+        if user_id is not None:
+            pin_cache().set(pin_key(user_id), True, settings.READ_YOUR_WRITES_WINDOW)
+        _state.get_user, _state.user_pinned, _state.wrote = None, None, False
+
+
+def _reads_pinned():
+    if getattr(_state, 'get_user', None) is None:
+        # Outside of a request or message (commands, the dispatcher, ...) a
+        # write pins the rest of the thread's reads.
+        return getattr(_state, 'wrote', False)
+    if _state.wrote:
+        return True
+    if _state.user_pinned is None:
+        user_id = _user_id()
+        if user_id is None:
+            return False
+        _state.user_pinned = pin_cache().get(pin_key(user_id)) is not None
+    return _state.user_pinned
+
+
+def _user_id():
+    if getattr(_state, 'resolving', False):
+        # Loading the user (the session, the user row) reads from a replica.
+        return None
+    _state.resolving = True
+    try:
+        user = _state.get_user()
+    finally:
+        _state.resolving = False
+    return user.id if user is not None and user.is_authenticated else None
+
+
+class ReadYourWritesMiddleware:
+    """Makes each HTTP request a `read_your_writes` block for its user."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # REST framework sets `request.user` once it has authenticated the request.
+        with read_your_writes(lambda: getattr(request, 'user', None)):
+            return self.get_response(request)
@@ -1,6 +1,13 @@
+import datetime
+from collections import OrderedDict
 from django.contrib.auth import get_user_model
-from rest_framework import serializers
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
+from .geocoding import geocoder
 from .models import Trip
+from .stats import MAX_HOURS, record_status
 
 
 class PublicUserSerializer(serializers.ModelSerializer):
@@ -17,26 +24,136 @@ class PrivateUserSerializer(PublicUserSerializer):
         fields = list(PublicUserSerializer.Meta.fields) + ['auth_token']
 
 
+class LocationSerializer(serializers.Serializer):
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
+
+
+class OfferSerializer(serializers.Serializer):
+    nk = serializers.CharField(max_length=32)
+
+
+class ResumeSerializer(serializers.Serializer):
+    trips = serializers.DictField(child=serializers.IntegerField(min_value=0))
+
+
+class TripExportSerializer(serializers.Serializer):
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+
+class TripStatsSerializer(serializers.Serializer):
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        # The last day by default, and never more than MAX_HOURS.
+        data.setdefault('end', timezone.now())
+        data.setdefault('start', data['end'] - datetime.timedelta(days=1))
+        if data['start'] > data['end']:
+            raise serializers.ValidationError('start must not be after end.')
+        if data['end'] - data['start'] > datetime.timedelta(hours=MAX_HOURS):
+            raise serializers.ValidationError(f'Stats cover at most {MAX_HOURS} hours at once.')
+        return data
+
+
+class TripStatusSerializer(serializers.Serializer):
+    nk = serializers.CharField(max_length=32)
+    status = serializers.ChoiceField(choices=list(Trip.TRANSITIONS))
+
+
 class TripSerializer(serializers.ModelSerializer):
     driver = PublicUserSerializer(allow_null=True, required=False)
     rider = PublicUserSerializer(allow_null=True, required=False)
 
     def create(self, validated_data):
         data = validated_data.pop('rider', None)
-        trip = super().create(validated_data)
-        if data:
-            trip.rider = get_user_model().objects.get(**data)
-        trip.save()
+        if isinstance(data, get_user_model()):
+            validated_data['rider'] = data
+        elif data:
+            validated_data['rider'] = get_user_model().objects.get(**data)
+        validated_data.update(geocoder.trip_fields(**validated_data))
+        with transaction.atomic():
+            trip = super().create(validated_data)
+            record_status(trip)
         return trip
 
     def update(self, instance, validated_data):
         data = validated_data.pop('driver', None)
         if data:
             instance.driver = get_user_model().objects.get(**data)
-        instance = super().update(instance, validated_data)
+        status = instance.status
+        with transaction.atomic():
+            instance = super().update(instance, validated_data)
+            if instance.status != status:
+                record_status(instance)
         return instance
 
     class Meta:
         model = Trip
-        fields = '__all__'
-        read_only_fields = ('id', 'nk', 'created', 'updated',)
+        exclude = ('offered_to', 'offer_expires',)
+        read_only_fields = ('id', 'nk', 'created', 'updated', 'version', 'distance', 'duration', 'fare',)
+
+
+# Fields whose representation of a non-null value is the attribute itself.
+PASSTHROUGH_FIELDS = (
+    serializers.BooleanField,
+    serializers.CharField,
+    serializers.ChoiceField,
+    serializers.FloatField,
+    serializers.IntegerField,
+)
+
+_trip_fields = None
+
+
+def serialize_user(user):
+    """Same output as `PublicUserSerializer(user).data`, built directly from the instance."""
+    return OrderedDict([
+        ('id', user.id),
+        ('username', user.username),
+        ('groups', [group.name for group in user.groups.all()]),
+    ])
+
+
+def serialize_trip(trip):
+    """
+    Same output as `TripSerializer(trip).data` for the read hot path. The
+    serializer's fields are inspected once; after that each trip is turned
+    into a dict with plain attribute reads.
+    """
+    global _trip_fields
+    if _trip_fields is None:
+        _trip_fields = _compile_fields(TripSerializer())
+    data = OrderedDict()
+    for name, source, to_representation in _trip_fields:
+        value = getattr(trip, source)
+        data[name] = value if value is None or to_representation is None else to_representation(value)
+    return data
+
+
+def _compile_fields(serializer):
+    fields = []
+    for name, field in serializer.fields.items():
+        if isinstance(field, PublicUserSerializer):
+            to_representation = serialize_user
+        elif isinstance(field, serializers.DateTimeField) and _is_iso_8601(field):
+            to_representation = _iso_8601
+        elif type(field) in PASSTHROUGH_FIELDS:
+            to_representation = None
+        else:
+            to_representation = field.to_representation
+        fields.append((name, field.source, to_representation))
+    return fields
+
+
+def _is_iso_8601(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    return output_format is not None and output_format.lower() == ISO_8601
+
+
+def _iso_8601(value):
+    value = value.isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .authentication import invalidate_users, token_cache
+from .models import Trip
+from .renderers import trip_payloads
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=get_user_model())
+def invalidate_saved_user(sender, instance, created, update_fields=None, **kwargs):
+    if not created and update_fields != frozenset(['last_login']):
+        invalidate_users([instance.pk])
+        trip_payloads.discard_users([instance.pk])
+
+
+@receiver(m2m_changed, sender=get_user_model().groups.through)
+def invalidate_user_roles(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        invalidate_users([instance.pk])
+        trip_payloads.discard_users([instance.pk])
+    elif pk_set is not None:
+        invalidate_users(pk_set)
+        trip_payloads.discard_users(pk_set)
+    else:
+        token_cache.clear()
+        trip_payloads.clear()
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_all_roles(sender, **kwargs):
+    token_cache.clear()
+    trip_payloads.clear()
+
+
+@receiver(post_save, sender=Trip)
+@receiver(post_delete, sender=Trip)
+def discard_saved_trip(sender, instance, **kwargs):
+    trip_payloads.discard(instance.nk)
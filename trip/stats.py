@@ -0,0 +1,168 @@
+import sqlite3
+from collections import defaultdict
+from django.db import IntegrityError, connections, router, transaction
+from django.db.models import F, Sum
+from .models import ArchivedTrip, Trip, TripStats
+
+# The widest range the stats endpoint answers for, so a request reads at most
+# this many hours of rows however much trip history there is.
+MAX_HOURS = 31 * 24
+# The statuses past REQUESTED that a trip in each status has reached.
+REACHED = {
+    Trip.REQUESTED: [],
+    Trip.STARTED: [Trip.STARTED],
+    Trip.IN_PROGRESS: [Trip.STARTED, Trip.IN_PROGRESS],
+    Trip.COMPLETED: [Trip.STARTED, Trip.IN_PROGRESS, Trip.COMPLETED],
+}
+
+
+def hour_of(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def record_status(trip):
+    """
+    Count `trip` reaching its current status, in the hour it was last updated.
+    Starts also add the wait since the trip was requested, and completions
+    count for the trip's driver too. Costs one upsert per row on PostgreSQL
+    and SQLite 3.24+; elsewhere an UPDATE, plus an INSERT for the first trip
+    of an hour.
+    """
+    waits, waited = (1, (trip.updated - trip.created).total_seconds()) if trip.status == Trip.STARTED else (0, 0)
+    hour = hour_of(trip.updated)
+    _increment(hour, trip.status, None, 1, waits, waited)
+    if trip.status == Trip.COMPLETED and trip.driver_id is not None:
+        _increment(hour, trip.status, trip.driver_id, 1, 0, 0)
+
+
+def count_trips(trips):
+    """
+    Add `(created, updated, status, driver_id)` trips that never went through
+    `record_status`, such as imported ones, to the buckets, counted the way
+    `rebuild_stats` counts them. Costs one upsert per bucket touched.
+    """
+    buckets = defaultdict(lambda: [0, 0, 0.0])
+    _count(buckets, trips)
+    for (hour, status, driver_id), (count, waits, waited) in buckets.items():
+        _increment(hour, status, driver_id, count, waits, waited)
+
+
+def _increment(hour, status, driver_id, count, waits, waited):
+    connection = connections[router.db_for_write(TripStats)]
+    if _supports_upsert(connection):
+        _upsert(connection, hour, status, driver_id, count, waits, waited)
+        return
+    changes = {'count': F('count') + count}
+    if waits:
+        changes.update(wait_count=F('wait_count') + waits, wait_seconds=F('wait_seconds') + waited)
+    bucket = TripStats.objects.filter(hour=hour, status=status, driver_id=driver_id)
+    if bucket.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            TripStats.objects.create(
+                hour=hour, status=status, driver_id=driver_id, count=count, wait_count=waits, wait_seconds=waited
+            )
+    except IntegrityError:
+        # Another process created the bucket first.
+        bucket.update(**changes)
+
+
+def _supports_upsert(connection):
+    return connection.vendor == 'postgresql' or (
+        connection.vendor == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24)
+    )
+
+
+def _upsert(connection, hour, status, driver_id, count, waits, waited):
+    quote = connection.ops.quote_name
+    table = quote(TripStats._meta.db_table)
+    count_column, wait_count, wait_seconds = map(quote, ['count', 'wait_count', 'wait_seconds'])
+    # The conflict target names the unique index each kind of row falls under.
+    target = '(hour, status, driver_id)' if driver_id is not None else '(hour, status) WHERE driver_id IS NULL'
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} (hour, status, driver_id, {count_column}, {wait_count}, {wait_seconds}) '
+            f'VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT {target} DO UPDATE SET '
+            f'{count_column} = {table}.{count_column} + excluded.{count_column}, '
+            f'{wait_count} = {table}.{wait_count} + excluded.{wait_count}, '
+            f'{wait_seconds} = {table}.{wait_seconds} + excluded.{wait_seconds}',
+            [connection.ops.adapt_datetimefield_value(hour), status, driver_id, count, waits, waited]
+        )
+
+
+def hourly_stats(start, end):
+    """
+    `(hour, status) -> (count, wait_count, wait_seconds)` for every trip
+    between the hours of `start` and `end`, read from the buckets alone.
+    """
+    rows = TripStats.objects.filter(driver=None, hour__gte=hour_of(start), hour__lte=end).values(
+        'hour', 'status'
+    ).annotate(
+        total=Sum('count'), waits=Sum('wait_count'), waited=Sum('wait_seconds')
+    ).order_by()
+    return {(row['hour'], row['status']): (row['total'], row['waits'], row['waited']) for row in rows}
+
+
+def driver_completed(driver, start, end):
+    """How many trips `driver` completed between the hours of `start` and `end`."""
+    return TripStats.objects.filter(
+        driver=driver, status=Trip.COMPLETED, hour__gte=hour_of(start), hour__lte=end
+    ).aggregate(total=Sum('count'))['total'] or 0
+
+
+def rebuild_stats(batch_size=5000):
+    """
+    Replace every bucket with counts from a scan of the trip and archive
+    tables, `batch_size` rows at a time. Trips only record when they were
+    requested and last updated, so a trip is counted as requested in the hour
+    it was created and as reaching every later status in the hour it was last
+    updated; waits are only known for trips still STARTED. Changes made while
+    this runs may be lost, so run it while trips are quiet. Returns the number
+    of trips counted.
+    """
+    buckets = defaultdict(lambda: [0, 0, 0.0])
+    counted = 0
+    for model in (ArchivedTrip, Trip):
+        for trips in _batches(model, batch_size):
+            if model is Trip:
+                # A trip caught mid-archive is already counted from the archive.
+                archived = set(ArchivedTrip.objects.filter(id__in=[trip[0] for trip in trips]).values_list(
+                    'id', flat=True
+                ))
+                trips = [trip for trip in trips if trip[0] not in archived]
+            _count(buckets, [trip[1:] for trip in trips])
+            counted += len(trips)
+    with transaction.atomic():
+        TripStats.objects.all().delete()
+        TripStats.objects.bulk_create([
+            TripStats(hour=hour, status=status, driver_id=driver_id, count=count, wait_count=waits, wait_seconds=waited)
+            for (hour, status, driver_id), (count, waits, waited) in buckets.items()
+        ], batch_size=batch_size)
+    return counted
+
+
+def _count(buckets, trips):
+    """Add `(created, updated, status, driver_id)` trips to `buckets` of `[count, waits, waited]`."""
+    for created, updated, status, driver_id in trips:
+        buckets[(hour_of(created), Trip.REQUESTED, None)][0] += 1
+        for reached in REACHED[status]:
+            buckets[(hour_of(updated), reached, None)][0] += 1
+        if status == Trip.STARTED:
+            bucket = buckets[(hour_of(updated), Trip.STARTED, None)]
+            bucket[1] += 1
+            bucket[2] += (updated - created).total_seconds()
+        if status == Trip.COMPLETED and driver_id is not None:
+            buckets[(hour_of(updated), Trip.COMPLETED, driver_id)][0] += 1
+
+
+def _batches(model, batch_size):
+    last = 0
+    while True:
+        trips = list(model.objects.filter(id__gt=last).order_by('id').values_list(
+            'id', 'created', 'updated', 'status', 'driver_id'
+        )[:batch_size])
+        if not trips:
+            return
+        last = trips[-1][0]
+        yield trips
@@ -0,0 +1,96 @@
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from asgi_redis import RedisChannelLayer
+from channels import DEFAULT_CHANNEL_LAYER, channel_layers
+from .payloads import DEFAULT_FORMAT, FORMATS, Format
+
+# How many sockets are open in each update format other than the default,
+# when the channel layer is not Redis. A socket whose disconnect never
+# arrives only leaves its format counted, which costs a wasted group send.
+format_counts = Counter()
+format_lock = threading.Lock()
+
+
+def group_add_many(names, channel, channel_layer=None):
+    """Add `channel` to every group in `names`, in one round trip per Redis shard."""
+    backend = layer_backend(channel_layer)
+    if not isinstance(backend, RedisChannelLayer):
+        for name in names:
+            backend.group_add(name, channel)
+        return
+    now = time.time()
+    for pipeline, keys in _pipelines(backend, names):
+        for key in keys:
+            pipeline.zadd(key, **{channel: now})
+            pipeline.expire(key, backend.group_expiry)
+        pipeline.execute()
+
+
+def group_discard_many(names, channel, channel_layer=None):
+    """Remove `channel` from every group in `names`, in one round trip per Redis shard."""
+    backend = layer_backend(channel_layer)
+    if not isinstance(backend, RedisChannelLayer):
+        for name in names:
+            backend.group_discard(name, channel)
+        return
+    for pipeline, keys in _pipelines(backend, names):
+        for key in keys:
+            pipeline.zrem(key, channel)
+        pipeline.execute()
+
+
+def format_opened(format, channel_layer=None):
+    """Count a socket open in `format`, so broadcasts send to its groups."""
+    _count_format(format, 1, channel_layer)
+
+
+def format_closed(format, channel_layer=None):
+    _count_format(format, -1, channel_layer)
+
+
+def formats_in_use(channel_layer=None):
+    """The default format, plus every other format some socket has open."""
+    backend = layer_backend(channel_layer)
+    if isinstance(backend, RedisChannelLayer):
+        key = _formats_key(backend)
+        counts = backend.connection(backend.consistent_hash(key)).hgetall(key)
+        counts = {Format(*json.loads(field.decode('utf-8'))): int(count) for field, count in counts.items()}
+    else:
+        with format_lock:
+            counts = dict(format_counts)
+    return [format for format in FORMATS if format == DEFAULT_FORMAT or counts.get(format, 0) > 0]
+
+
+def _count_format(format, change, channel_layer=None):
+    if format == DEFAULT_FORMAT:
+        return
+    backend = layer_backend(channel_layer)
+    if isinstance(backend, RedisChannelLayer):
+        key = _formats_key(backend)
+        backend.connection(backend.consistent_hash(key)).hincrby(key, json.dumps(list(format)), change)
+        return
+    with format_lock:
+        format_counts[format] += change
+        if format_counts[format] <= 0:
+            del format_counts[format]
+
+
+def _formats_key(backend):
+    return f'{backend.prefix}formats'
+
+
+def layer_backend(channel_layer=None):
+    channel_layer = channel_layer or channel_layers[DEFAULT_CHANNEL_LAYER]
+    # Unwrap Django's ChannelLayerWrapper to get at the ASGI layer.
+    return getattr(channel_layer, 'channel_layer', channel_layer)
+
+
+def _pipelines(backend, names):
+    shards = defaultdict(list)
+    for name in names:
+        assert backend.valid_group_name(name), 'Group name not valid'
+        shards[backend.consistent_hash(name)].append(backend._group_key(name))
+    for index, keys in shards.items():
+        yield backend.connection(index).pipeline(transaction=False), keys
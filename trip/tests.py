@@ -1,17 +1,82 @@
+import datetime
+import json
+import tempfile
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+from io import StringIO
+from unittest import mock, skipIf
+import redis
+from asgi_redis import RedisChannelLayer
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import Group as AuthGroup
+from django.contrib.sessions.models import Session
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from channels import Group
 from channels.test import ChannelTestCase, HttpClient
 from rest_framework.authtoken.models import Token
 from rest_framework.reverse import reverse
-from rest_framework.status import HTTP_200_OK, HTTP_201_CREATED, HTTP_204_NO_CONTENT
+from rest_framework.status import (
+    HTTP_200_OK, HTTP_201_CREATED, HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST, HTTP_429_TOO_MANY_REQUESTS,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
 from rest_framework.test import APIClient, APITestCase
-from .models import Trip
-from .serializers import PublicUserSerializer, PrivateUserSerializer, TripSerializer
+from .archive import archive_trips
+from .authentication import CachedTokenAuthentication, TokenCache, get_roles, token_cache
+from .cache import LRUCache
+from .checks import check_auth_token_cache, check_read_your_writes_cache
+from .consumers import driver_index
+from .dispatch import BatchDispatcher, match
+from .events import TripEventLog, trip_events
+from .exports import export_trips, import_trips
+from .geo import DriverIndex, haversine
+from .geocoding import Geocoder, LocalProvider, Location, normalize_address
+from .keys import TimeOrderedKeys
+from .locations import LocationBuffer, write_locations
+from .management.commands.bench_dispatch_flow import QUERY_BUDGETS
+from .metrics import (
+    Counter, Histogram, Registry, connected_sockets, errors, group_send_fanout, handler_queries, handler_seconds,
+    registry, track, trip_payload_bytes, trip_payload_lookups
+)
+from .models import Address, ArchivedTrip, DriverLocation, Route, Trip, TripStats
+from .pagination import KeysetPagination
+from .passwords import PasswordPool, password_pool
+from .payloads import DEFAULT_FORMAT, Format, msgpack
+from .presence import Presence, RedisPresence, heartbeats_sent, presence
+from .renderers import TripPayloadCache, trip_payloads
+from .routers import ReplicaRouter, pin_key, read_your_writes
+from .serializers import PublicUserSerializer, PrivateUserSerializer, TripSerializer, serialize_trip
+from .stats import hour_of, rebuild_stats
+from .subscriptions import (
+    format_closed, format_counts, format_opened, formats_in_use, group_add_many, group_discard_many
+)
+from .throttling import AddressRateThrottle, RateLimiter, RedisRateLimiter, UsernameRateThrottle, rate_limiter
+from .workers import ConcurrentWorker
 
 PASSWORD = 'pAssw0rd!'
 
 
+def redis_backend():
+    """A channel layer on REDIS_URL with keys of its own, or None if Redis is not reachable."""
+    backend = RedisChannelLayer(hosts=[settings.REDIS_URL], prefix='asgi-test:')
+    try:
+        backend.connection(0).ping()
+    except redis.RedisError:
+        return None
+    return backend
+
+
+REDIS_BACKEND = redis_backend()
+
+
 def create_user(username='user@example.com', password=PASSWORD, group='rider'):
     auth_group, _ = AuthGroup.objects.get_or_create(name=group)
     user = get_user_model().objects.create_user(username=username, password=password)
@@ -23,6 +88,7 @@ def create_user(username='user@example.com', password=PASSWORD, group='rider'):
 class AuthenticationTest(APITestCase):
     def setUp(self):
         self.client = APIClient()
+        cache.clear()
 
     def test_user_can_sign_up(self):
         response = self.client.post(reverse('sign_up'), data={
@@ -44,6 +110,77 @@ class AuthenticationTest(APITestCase):
         self.assertEqual(PrivateUserSerializer(user).data, response.data)
         self.assertIsNotNone(Token.objects.get(user=user))
 
+    def test_log_in_reads_token_with_user(self):
+        user = create_user()
+        token = Token.objects.create(user=user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(reverse('log_in'), data={'username': user.username, 'password': PASSWORD})
+        self.assertEqual(token.key, response.data['auth_token'])
+        token_queries = [query['sql'] for query in queries if 'authtoken_token' in query['sql']]
+        self.assertEqual(1, len(token_queries))
+        self.assertIn('FROM "auth_user"', token_queries[0])
+
+    def test_log_in_upgrades_old_password_hashes(self):
+        user = create_user()
+        user.password = make_password(PASSWORD, hasher='pbkdf2_sha1')
+        user.save()
+        response = self.client.post(reverse('log_in'), data={'username': user.username, 'password': PASSWORD})
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        user.refresh_from_db()
+        self.assertTrue(user.password.startswith('pbkdf2_sha256$'))
+
+    def test_log_in_fails_fast_when_password_pool_is_full(self):
+        user = create_user()
+        with mock.patch.object(password_pool, 'max_pending', 0), self.assertNumQueries(0):
+            response = self.client.post(reverse('log_in'), data={'username': user.username, 'password': PASSWORD})
+        self.assertEqual(HTTP_503_SERVICE_UNAVAILABLE, response.status_code)
+        self.assertEqual('1', response['Retry-After'])
+
+    def test_log_in_is_throttled_per_username_and_address(self):
+        user = create_user()
+        with mock.patch.object(UsernameRateThrottle, 'THROTTLE_RATES', {'log_in': '2/min'}):
+            for status_code in [HTTP_400_BAD_REQUEST, HTTP_400_BAD_REQUEST, HTTP_429_TOO_MANY_REQUESTS]:
+                response = self.client.post(reverse('log_in'), data={'username': user.username, 'password': 'x'})
+                self.assertEqual(status_code, response.status_code)
+            response = self.client.post(reverse('log_in'), data={'username': 'other@example.com', 'password': 'x'})
+            self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+            # Nobody can lock the account's owner out from another address.
+            response = self.client.post(
+                reverse('log_in'), data={'username': user.username, 'password': PASSWORD}, REMOTE_ADDR='10.0.0.2'
+            )
+            self.assertEqual(HTTP_200_OK, response.status_code)
+
+    def test_log_in_is_throttled_per_address_across_usernames(self):
+        with mock.patch.object(AddressRateThrottle, 'THROTTLE_RATES', {'log_in_address': '2/min'}):
+            status_codes = [HTTP_400_BAD_REQUEST, HTTP_400_BAD_REQUEST, HTTP_429_TOO_MANY_REQUESTS]
+            for index, status_code in enumerate(status_codes):
+                data = {'username': f'{index}@example.com', 'password': 'x'}
+                self.assertEqual(status_code, self.client.post(reverse('log_in'), data=data).status_code)
+            response = self.client.post(
+                reverse('log_in'), data={'username': 'other@example.com', 'password': 'x'}, REMOTE_ADDR='10.0.0.2'
+            )
+            self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_sign_up_is_throttled_per_address(self):
+        with mock.patch.object(AddressRateThrottle, 'THROTTLE_RATES', {'sign_up': '2/min'}):
+            for index, status_code in enumerate([HTTP_201_CREATED, HTTP_201_CREATED, HTTP_429_TOO_MANY_REQUESTS]):
+                response = self.client.post(reverse('sign_up'), data={
+                    'username': f'{index}@example.com',
+                    'password1': PASSWORD,
+                    'password2': PASSWORD
+                })
+                self.assertEqual(status_code, response.status_code)
+
+    def test_password_pool_hashes_in_processes(self):
+        pool = PasswordPool(processes=1, max_pending=1)
+        try:
+            encoded = pool.make_password(PASSWORD)
+            self.assertTrue(pool.check_password(PASSWORD, encoded))
+            self.assertFalse(pool.check_password('wrong', encoded))
+            self.assertEqual(0, pool.pending)
+        finally:
+            pool.reset()
+
     def test_user_can_log_out(self):
         user = create_user()
         token = Token.objects.create(user=user)
@@ -54,6 +191,89 @@ class AuthenticationTest(APITestCase):
         self.assertFalse(Token.objects.filter(user=user).exists())
 
 
+class CachedTokenAuthenticationTest(APITestCase):
+    def setUp(self):
+        self.user = create_user()
+        self.token = Token.objects.create(user=self.user)
+        self.authentication = CachedTokenAuthentication()
+
+    def tearDown(self):
+        token_cache.clear()
+
+    def test_cache_hit_runs_no_queries(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        with self.assertNumQueries(0):
+            user, token = self.authentication.authenticate_credentials(self.token.key)
+            self.assertEqual(frozenset(['rider']), get_roles(user))
+        self.assertEqual(self.user, user)
+        self.assertEqual(self.token, token)
+
+    def test_token_deletion_invalidates_cache(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token}')
+        self.client.login(username=self.user.username, password=PASSWORD)
+        self.client.post(reverse('log_out'))
+        self.client.logout()
+        response = self.client.get(reverse('trip:trip_list'))
+        self.assertEqual(401, response.status_code)
+
+    def test_group_change_invalidates_cache(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        self.user.groups.add(AuthGroup.objects.create(name='driver'))
+        user, _ = self.authentication.authenticate_credentials(self.token.key)
+        self.assertEqual(frozenset(['rider', 'driver']), get_roles(user))
+
+    def test_reverse_group_change_invalidates_cache(self):
+        self.authentication.authenticate_credentials(self.token.key)
+        AuthGroup.objects.get(name='rider').user_set.remove(self.user)
+        user, _ = self.authentication.authenticate_credentials(self.token.key)
+        self.assertEqual(frozenset(), get_roles(user))
+
+    def test_shared_cache_invalidates_other_processes(self):
+        first, second = TokenCache(shared_cache='default'), TokenCache(shared_cache='default')
+        first.set(self.token.key, self.token)
+        self.assertEqual(self.token, second.get(self.token.key))
+        first.invalidate(self.token.key)
+        self.assertIsNone(second.get(self.token.key))
+
+    def test_token_cache_must_be_shared(self):
+        self.assertEqual(['trip.W001'], [warning.id for warning in check_auth_token_cache(None)])
+        with override_settings(AUTH_TOKEN_CACHE={'shared_cache': None}):
+            self.assertEqual(['trip.W001'], [warning.id for warning in check_auth_token_cache(None)])
+        with override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache', 'LOCATION': 'localhost'}
+        }):
+            self.assertEqual([], check_auth_token_cache(None))
+
+
+class LRUCacheTest(TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(['a', 'c'], list(cache.entries))
+
+    def test_expires_entries(self):
+        now = [0]
+        cache = LRUCache(ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        self.assertEqual(1, cache.get('a'))
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+
+    def test_evicts_over_max_weight(self):
+        cache = LRUCache(max_weight=5, weigh=len)
+        cache.set('a', 'xx')
+        cache.set('b', 'xx')
+        cache.set('a', 'x')
+        cache.set('c', 'xxx')
+        self.assertEqual(['a', 'c'], list(cache.entries))
+        self.assertEqual(4, cache.weight)
+
+
 class HttpTripTest(APITestCase):
     def setUp(self):
         self.user = create_user()
@@ -69,7 +289,203 @@ class HttpTripTest(APITestCase):
         ]
         response = self.client.get(reverse('trip:trip_list'))
         self.assertEqual(HTTP_200_OK, response.status_code)
-        self.assertEqual(TripSerializer(trips[0:2], many=True).data, response.data)
+        self.assertEqual(TripSerializer(trips[1::-1], many=True).data, response.data['results'])
+        self.assertIsNone(response.data['next'])
+
+    def test_user_can_page_through_personal_trips(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user)
+            for index in range(5)
+        ]
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 2})
+        self.assertEqual(TripSerializer(trips[4:2:-1], many=True).data, response.data['results'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(TripSerializer(trips[2:0:-1], many=True).data, response.data['results'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(TripSerializer(trips[0:1], many=True).data, response.data['results'])
+        self.assertIsNone(response.data['next'])
+
+    def test_driver_can_list_requested_and_personal_trips(self):
+        driver = create_user(username='driver@example.com', group='driver')
+        token = Token.objects.create(user=driver)
+        trips = [
+            Trip.objects.create(pick_up_address='A', drop_off_address='B'),
+            Trip.objects.create(pick_up_address='B', drop_off_address='C', driver=driver, status=Trip.STARTED),
+            Trip.objects.create(pick_up_address='C', drop_off_address='D', status=Trip.STARTED),
+            Trip.objects.create(pick_up_address='D', drop_off_address='E', driver=driver),
+        ]
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 2})
+        self.assertEqual(TripSerializer([trips[3], trips[1]], many=True).data, response.data['results'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(TripSerializer(trips[0:1], many=True).data, response.data['results'])
+
+    def test_listing_trips_runs_a_fixed_number_of_queries(self):
+        driver = create_user(username='driver@example.com', group='driver')
+        for index in range(10):
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user, driver=driver)
+        # Token, user groups, the ETag aggregate, live and archived trips,
+        # then rider groups and driver groups.
+        with self.assertNumQueries(7):
+            response = self.client.get(reverse('trip:trip_list'))
+        self.assertEqual(10, len(response.data['results']))
+
+    def test_archived_trips_are_listed_with_live_trips(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user, status=status)
+            for index, status in enumerate([Trip.COMPLETED, Trip.REQUESTED, Trip.COMPLETED])
+        ]
+        self.assertEqual(2, archive_trips())
+        self.assertEqual([trips[1].nk], list(Trip.objects.values_list('nk', flat=True)))
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 2})
+        self.assertEqual([trip.nk for trip in trips[:0:-1]], [trip['nk'] for trip in response.data['results']])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([trips[0].nk], [trip['nk'] for trip in response.data['results']])
+
+    def test_user_can_retrieve_archived_trip_by_nk(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user, status=Trip.COMPLETED)
+        archive_trips()
+        response = self.client.get(trip.get_absolute_url())
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(TripSerializer(trip).data, response.data)
+
+    def test_archiving_skips_trips_already_copied(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user, status=Trip.COMPLETED)
+        trip_payloads.put(trip)
+        # As left by another archiver that copied the row but has not deleted it yet.
+        ArchivedTrip.objects.create(
+            id=trip.id, nk=trip.nk, created=trip.created, updated=trip.updated, pick_up_address='A',
+            drop_off_address='B', rider=self.user,
+        )
+        self.assertEqual(1, archive_trips())
+        self.assertFalse(Trip.objects.exists())
+        self.assertEqual(1, ArchivedTrip.objects.count())
+        self.assertIsNone(trip_payloads.get(trip.nk, trip.version))
+
+    def test_user_can_export_trip_history_as_ndjson(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user, status=status)
+            for index, status in enumerate([Trip.COMPLETED, Trip.REQUESTED])
+        ]
+        archive_trips()
+        Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        response = self.client.get(reverse('trip:trip_export'))
+        self.assertEqual('application/x-ndjson', response['Content-Type'])
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual(TripSerializer(trips, many=True).data, [json.loads(line) for line in lines])
+
+    def test_driver_export_leaves_out_open_requests(self):
+        driver = create_user(username='driver@example.com', group='driver')
+        driven = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user, driver=driver)
+        Trip.objects.create(pick_up_address='B', drop_off_address='C', rider=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=driver)}')
+        response = self.client.get(reverse('trip:trip_export'))
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([driven.nk], [json.loads(line)['nk'] for line in lines])
+
+    def test_export_can_be_limited_to_a_date_range(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user) for index in range(3)
+        ]
+        response = self.client.get(reverse('trip:trip_export'), data={
+            'start': trips[1].created.isoformat(), 'end': trips[2].created.isoformat()
+        })
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEqual([trips[1].nk], [json.loads(line)['nk'] for line in lines])
+        response = self.client.get(reverse('trip:trip_export'), data={'start': 'yesterday'})
+        self.assertEqual(400, response.status_code)
+
+    def test_unchanged_trip_detail_is_not_modified(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user)
+        response = self.client.get(trip.get_absolute_url())
+        etag = response['ETag']
+        # The token and the user's roles are cached by now, leaving the version lookup.
+        with self.assertNumQueries(1), mock.patch('trip.renderers.serialize_trip') as serialize:
+            response = self.client.get(trip.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(etag, response['ETag'])
+        serialize.assert_not_called()
+        Trip.objects.transition(trip.nk, Trip.STARTED, driver=create_user(username='driver@example.com'))
+        response = self.client.get(trip.get_absolute_url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_unchanged_trip_list_is_not_modified(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user) for index in range(3)
+        ]
+        response = self.client.get(reverse('trip:trip_list'))
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        with self.assertNumQueries(1), mock.patch('trip.renderers.serialize_trip') as serialize:
+            response = self.client.get(reverse('trip:trip_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        serialize.assert_not_called()
+        response = self.client.get(reverse('trip:trip_list'), HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(304, response.status_code)
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        trips[0].delete()
+        response = self.client.get(reverse('trip:trip_list'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(2, len(response.data['results']))
+
+    def test_list_etag_only_covers_the_page_asked_for(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user) for index in range(3)
+        ]
+        etag = self.client.get(reverse('trip:trip_list'), data={'page_size': 1})['ETag']
+        # The page and the row after it, which decides whether there is a next page.
+        Trip.objects.transition(trips[0].nk, Trip.STARTED, driver=create_user(username='driver@example.com'))
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(304, response.status_code)
+        trips[1].delete()
+        response = self.client.get(reverse('trip:trip_list'), data={'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(HTTP_200_OK, response.status_code)
+
+    def test_cached_trip_is_served_without_loading_it(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user)
+        self.client.get(trip.get_absolute_url())
+        with self.assertNumQueries(1), mock.patch('trip.renderers.serialize_trip') as serialize:
+            response = self.client.get(trip.get_absolute_url())
+        serialize.assert_not_called()
+        self.assertEqual(TripSerializer(trip).data, response.data)
+        self.assertEqual(TripSerializer(trip).data, json.loads(response.content.decode('utf-8')))
+        Trip.objects.transition(trip.nk, Trip.STARTED, driver=create_user(username='driver@example.com'))
+        response = self.client.get(trip.get_absolute_url())
+        self.assertEqual(Trip.STARTED, response.data['status'])
+
+    def test_cached_trips_are_spliced_into_list_pages(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.user) for index in range(3)
+        ]
+        self.client.get(reverse('trip:trip_list'))
+        # The ETag aggregate, then live and archived trips; no user groups.
+        with self.assertNumQueries(3), mock.patch('trip.renderers.serialize_trip') as serialize:
+            response = self.client.get(reverse('trip:trip_list'), data={'page_size': 2})
+        serialize.assert_not_called()
+        content = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(TripSerializer(trips[:0:-1], many=True).data, content['results'])
+        self.assertEqual(response.data['next'], content['next'])
+
+    def test_user_changes_refresh_cached_trips(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user)
+        self.client.get(trip.get_absolute_url())
+        self.user.groups.add(AuthGroup.objects.create(name='vip'))
+        response = self.client.get(trip.get_absolute_url())
+        self.assertEqual(['rider', 'vip'], sorted(response.data['rider']['groups']))
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_payload_cache_lookups_are_counted(self):
+        registry.clear()
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user)
+        for _ in range(3):
+            self.client.get(trip.get_absolute_url())
+        self.assertEqual((2, 1), (trip_payload_lookups.get(result='hit'), trip_payload_lookups.get(result='miss')))
+        self.assertEqual(len(trip_payloads.render(trip).json), trip_payload_bytes.get())
+
+    def test_invalid_cursor_is_not_found(self):
+        response = self.client.get(reverse('trip:trip_list'), data={'cursor': 'nonsense'})
+        self.assertEqual(404, response.status_code)
 
     def test_user_can_retrieve_personal_trip_by_nk(self):
         trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.user)
@@ -78,34 +494,948 @@ class HttpTripTest(APITestCase):
         self.assertEqual(TripSerializer(trip).data, response.data)
 
 
+class DriverIndexTest(TestCase):
+    def setUp(self):
+        self.index = DriverIndex(cell_size=0.05)
+
+    def test_nearby_returns_closest_drivers_within_radius(self):
+        self.index.update(1, 40.7000, -74.0000, 'a')
+        self.index.update(2, 40.7100, -74.0000, 'b')
+        self.index.update(3, 41.5000, -74.0000, 'c')
+        nearby = self.index.nearby(40.7010, -74.0000, radius=5)
+        self.assertEqual([1, 2], [driver_id for _, driver_id, _ in nearby])
+        self.assertEqual([1], [driver_id for _, driver_id, _ in self.index.nearby(40.7010, -74.0000, 5, limit=1)])
+
+    def test_moving_driver_changes_cell(self):
+        self.index.update(1, 40.7000, -74.0000, 'a')
+        self.index.update(1, 41.5000, -74.0000, 'a')
+        self.assertEqual([], self.index.nearby(40.7000, -74.0000, radius=5))
+        self.assertEqual(1, len(self.index))
+        self.assertEqual(1, len(self.index.cells))
+
+    def test_remove_ignores_stale_channel(self):
+        self.index.update(1, 40.7000, -74.0000, 'b')
+        self.index.remove(1, channel='a')
+        self.assertIn(1, self.index)
+        self.index.remove(1, channel='b')
+        self.assertNotIn(1, self.index)
+        self.assertEqual(0, len(self.index.cells))
+
+    def test_haversine(self):
+        self.assertAlmostEqual(111.19, haversine(0, 0, 1, 0), places=2)
+
+
+class MatchTest(TestCase):
+    def setUp(self):
+        self.index = DriverIndex(cell_size=0.01)
+
+    def test_nearest_pick_ups_are_matched_first(self):
+        self.index.update(1, 40.7000, -74.0000, None)
+        self.index.update(2, 40.7200, -74.0000, None)
+        # Trip 10 is closest to both drivers; trip 20 takes the one left over.
+        trips = [(20, 40.7150, -74.0000), (10, 40.7010, -74.0000)]
+        assignments = match(trips, self.index, 5)
+        self.assertEqual([(10, 1), (20, 2)], [(trip_id, driver_id) for trip_id, driver_id, _ in assignments])
+
+    def test_each_driver_gets_at_most_one_trip(self):
+        self.index.update(1, 40.7000, -74.0000, None)
+        trips = [(10, 40.7010, -74.0000), (20, 40.7020, -74.0000)]
+        self.assertEqual([(10, 1)], [(trip_id, driver_id) for trip_id, driver_id, _ in match(trips, self.index, 5)])
+
+    def test_excluded_drivers_are_skipped(self):
+        self.index.update(1, 40.7000, -74.0000, None)
+        self.index.update(2, 40.7200, -74.0000, None)
+        assignments = match([(10, 40.7010, -74.0000)], self.index, 5, candidates=1, excluded={10: {1}})
+        self.assertEqual([(10, 2)], [(trip_id, driver_id) for trip_id, driver_id, _ in assignments])
+
+    def test_drivers_beyond_radius_are_not_matched(self):
+        self.index.update(1, 41.5000, -74.0000, None)
+        self.assertEqual([], match([(10, 40.7010, -74.0000)], self.index, 5))
+
+
+class GeocoderTest(TestCase):
+    def setUp(self):
+        self.geocoder = Geocoder(LocalProvider())
+
+    def test_repeated_addresses_hit_the_provider_once(self):
+        fields = self.geocoder.trip_fields('JFK Airport', 'Penn Station')
+        # Two addresses and one route.
+        self.assertEqual(3, self.geocoder.provider_calls)
+        with self.assertNumQueries(0):
+            self.assertEqual(fields, self.geocoder.trip_fields('jfk  airport.', 'Penn Station'))
+        self.assertEqual(3, self.geocoder.provider_calls)
+        self.assertEqual(['jfk airport', 'penn station'], sorted(Address.objects.values_list('normalized', flat=True)))
+
+    def test_other_processes_read_answers_from_the_database(self):
+        fields = self.geocoder.trip_fields('JFK Airport', 'Penn Station')
+        geocoder = Geocoder(LocalProvider())
+        with self.assertNumQueries(2):
+            self.assertEqual(fields, geocoder.trip_fields('JFK Airport', 'Penn Station'))
+        self.assertEqual(0, geocoder.provider_calls)
+        self.assertEqual(1, Route.objects.count())
+
+    def test_unplaced_addresses_are_asked_about_again_later(self):
+        provider = mock.Mock(wraps=LocalProvider())
+        provider.geocode.side_effect = lambda address: None if address == 'nowhere' else Location(40.7, -74.0)
+        geocoder = Geocoder(provider)
+        geocoder.trip_fields('Nowhere', 'B')
+        geocoder.trip_fields('Nowhere', 'B')
+        self.assertEqual(1, [call[0][0] for call in provider.geocode.call_args_list].count('nowhere'))
+        geocoder.misses.clock = lambda: time.monotonic() + 301
+        self.assertIn('drop_off_latitude', geocoder.trip_fields('Nowhere', 'B'))
+        self.assertEqual(2, [call[0][0] for call in provider.geocode.call_args_list].count('nowhere'))
+
+    def test_given_coordinates_are_kept(self):
+        fields = self.geocoder.trip_fields('A', 'B', pick_up_latitude=40.7, pick_up_longitude=-74.0)
+        self.assertNotIn('pick_up_latitude', fields)
+        self.assertEqual(
+            LocalProvider().geocode(normalize_address('B')), (fields['drop_off_latitude'], fields['drop_off_longitude'])
+        )
+
+    def test_nothing_is_looked_up_without_a_provider(self):
+        with self.assertNumQueries(0):
+            self.assertEqual({}, Geocoder().trip_fields('A', 'B'))
+
+    @override_settings(TRIP_FARE={'base': '2.50', 'per_km': '1.00', 'per_minute': '0.50'})
+    def test_new_trips_are_given_estimates(self):
+        with mock.patch('trip.serializers.geocoder', self.geocoder):
+            serializer = TripSerializer(data={'pick_up_address': 'A', 'drop_off_address': 'B'})
+            serializer.is_valid(raise_exception=True)
+            trip = serializer.save()
+        self.assertIsNotNone(trip.pick_up_latitude)
+        self.assertGreater(trip.distance, 0)
+        expected = Decimal('2.50') + Decimal(str(trip.distance)) + Decimal(trip.duration) / 120
+        self.assertAlmostEqual(expected, trip.fare, delta=Decimal('0.01'))
+        self.assertEqual(TripSerializer(trip).data, serialize_trip(trip))
+
+
+class SerializeTripTest(TestCase):
+    def test_output_matches_trip_serializer(self):
+        rider = create_user()
+        driver = create_user(username='driver@example.com', group='driver')
+        driver.groups.add(AuthGroup.objects.create(name='staff'))
+        trips = [
+            Trip.objects.create(pick_up_address='A', drop_off_address='B'),
+            Trip.objects.create(
+                pick_up_address='A', drop_off_address='B', pick_up_latitude=40.7, pick_up_longitude=-74.0,
+                status=Trip.STARTED, rider=rider, driver=driver
+            ),
+        ]
+        for trip in trips:
+            trip = Trip.objects.get(pk=trip.pk)
+            self.assertEqual(list(TripSerializer(trip).data.items()), list(serialize_trip(trip).items()))
+
+
+class TripPayloadCacheTest(TestCase):
+    def setUp(self):
+        self.payloads = TripPayloadCache(max_size=2, ttl=60)
+        self.rider = create_user()
+
+    def test_discarding_users_drops_only_their_trips(self):
+        other = create_user(username='other@example.com')
+        mine = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.rider)
+        theirs = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=other)
+        for trip in [mine, theirs]:
+            self.payloads.put(trip)
+        self.payloads.discard_users([self.rider.id])
+        self.assertIsNone(self.payloads.get(mine.nk, mine.version))
+        self.assertIsNotNone(self.payloads.get(theirs.nk, theirs.version))
+
+    def test_index_forgets_evicted_trips(self):
+        for index in range(5):
+            self.payloads.put(Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=self.rider))
+        self.assertLessEqual(len(self.payloads.user_nks[self.rider.id]), 4)
+
+    def test_entries_expire(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        self.payloads.put(trip)
+        self.payloads.entries.clock = lambda: time.monotonic() + 61
+        self.assertIsNone(self.payloads.get(trip.nk, trip.version))
+
+
+class TripQueryPlanTest(TestCase):
+    def assertUsesIndex(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = [row[-1] for row in cursor.fetchall()]
+        for step in plan:
+            self.assertNotRegex(step, r'^SCAN (TABLE )?trip_trip$', plan)
+
+    def test_list_queries_do_not_scan_trip_table(self):
+        user = create_user()
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=user)
+        pagination = KeysetPagination()
+        position = (trip.created, trip.id)
+        for queryset in [Trip.objects.filter(rider=user), Trip.objects.filter(driver=user), Trip.objects.requested()]:
+            self.assertUsesIndex(pagination.page_queryset(queryset))
+            self.assertUsesIndex(pagination.page_queryset(queryset, position))
+
+    def test_active_trip_queries_do_not_scan_trip_table(self):
+        user = create_user()
+        self.assertUsesIndex(user.trips_as_driver.exclude(status=Trip.COMPLETED))
+        self.assertUsesIndex(user.trips_as_rider.exclude(status=Trip.COMPLETED))
+
+
+class TripStatsTest(APITestCase):
+    def setUp(self):
+        self.driver = create_user(username='driver@example.com', group='driver')
+        self.rider = create_user(username='rider@example.com', group='rider')
+        self.client = APIClient()
+        self.client.force_authenticate(self.driver)
+
+    def request_trip(self):
+        serializer = TripSerializer(data={
+            'pick_up_address': 'A', 'drop_off_address': 'B', 'rider': PublicUserSerializer(self.rider).data,
+        })
+        serializer.is_valid(raise_exception=True)
+        return serializer.save()
+
+    def move_trip(self, trip, status):
+        serializer = TripSerializer(trip, data={'status': status}, partial=True)
+        serializer.is_valid(raise_exception=True)
+        serializer.instance.driver = self.driver
+        return serializer.save()
+
+    def test_status_changes_are_counted_as_they_happen(self):
+        trip = self.request_trip()
+        for status in [Trip.STARTED, Trip.IN_PROGRESS, Trip.COMPLETED]:
+            trip = self.move_trip(trip, status)
+        self.request_trip()
+        counts = TripStats.objects.filter(driver=None).values_list('status', 'count')
+        self.assertEqual(
+            {Trip.REQUESTED: 2, Trip.STARTED: 1, Trip.IN_PROGRESS: 1, Trip.COMPLETED: 1}, dict(counts)
+        )
+        self.assertEqual(1, TripStats.objects.get(status=Trip.STARTED).wait_count)
+        self.assertEqual(1, TripStats.objects.get(driver=self.driver).count)
+
+    def test_stats_are_read_from_buckets_alone(self):
+        trip = self.request_trip()
+        self.move_trip(trip, Trip.STARTED)
+        # The roles lookup, the hourly buckets and the driver's completions.
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('trip:trip_stats'))
+        self.assertEqual(HTTP_200_OK, response.status_code)
+        self.assertEqual(
+            {Trip.REQUESTED: 1, Trip.STARTED: 1, Trip.IN_PROGRESS: 0, Trip.COMPLETED: 0}, response.data['counts']
+        )
+        self.assertEqual(1, response.data['wait']['count'])
+        self.assertEqual(1, len(response.data['hours']))
+        self.assertEqual({'completed': 0}, response.data['driver'])
+
+    def test_one_row_per_hour_and_status_without_a_driver(self):
+        hour = hour_of(timezone.now())
+        self.request_trip()
+        self.request_trip()
+        self.assertEqual([2], list(TripStats.objects.filter(status=Trip.REQUESTED).values_list('count', flat=True)))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            TripStats.objects.create(hour=hour, status=Trip.REQUESTED)
+
+    def test_stats_range_is_limited(self):
+        response = self.client.get(reverse('trip:trip_stats'), data={
+            'start': '2026-01-01T00:00:00Z', 'end': '2026-03-01T00:00:00Z',
+        })
+        self.assertEqual(HTTP_400_BAD_REQUEST, response.status_code)
+
+    def test_rebuild_recounts_trips(self):
+        trip = self.request_trip()
+        for status in [Trip.STARTED, Trip.IN_PROGRESS, Trip.COMPLETED]:
+            trip = self.move_trip(trip, status)
+        self.move_trip(self.request_trip(), Trip.STARTED)
+        archive_trips()
+        recorded = set(TripStats.objects.values_list('status', 'driver', 'count'))
+        call_command('rebuild_trip_stats', batch_size=1, stdout=StringIO())
+        self.assertEqual(recorded, set(TripStats.objects.values_list('status', 'driver', 'count')))
+        # Only the trip still waiting at STARTED shows how long it waited.
+        self.assertEqual(1, TripStats.objects.get(status=Trip.STARTED).wait_count)
+
+
+class TripKeyTest(TestCase):
+    def test_keys_are_time_ordered(self):
+        clock = mock.Mock(side_effect=[1.0, 1.0, 1.0, 2.5])
+        keys = TimeOrderedKeys(clock=clock)
+        nks = [keys() for _ in range(4)]
+        self.assertEqual(sorted(nks), nks)
+        self.assertEqual(len(set(nks)), 4)
+        self.assertEqual([32] * 4, [len(nk) for nk in nks])
+        self.assertEqual(f'{2500:012x}', nks[-1][:12])
+
+    def test_keys_stay_ordered_when_the_clock_goes_back(self):
+        keys = TimeOrderedKeys(clock=mock.Mock(side_effect=[2.0, 1.0]))
+        first, second = keys(), keys()
+        self.assertLess(first, second)
+
+    def test_trip_keys_match_detail_url(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        self.assertEqual(f'/api/trip/{trip.nk}/', trip.get_absolute_url())
+
+    @override_settings(TRIP_NK_GENERATOR='trip.keys.md5_nk')
+    def test_key_generator_is_configurable(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        self.assertNotEqual(f'{int(trip.created.timestamp() * 1000):012x}', trip.nk[:12])
+
+    def test_rekey_orders_existing_trips_by_creation(self):
+        with override_settings(TRIP_NK_GENERATOR='trip.keys.md5_nk'):
+            trips = [
+                Trip.objects.create(pick_up_address='A', drop_off_address='B', status=Trip.COMPLETED)
+                for _ in range(5)
+            ]
+        call_command('rekey_trips', batch_size=2, stdout=StringIO())
+        nks = list(Trip.objects.order_by('created', 'id').values_list('nk', flat=True))
+        self.assertEqual(sorted(nks), nks)
+        self.assertFalse(set(nks) & {trip.nk for trip in trips})
+        self.assertEqual(
+            [f'{int(trip.created.timestamp() * 1000):012x}' for trip in trips],
+            [nk[:12] for nk in nks]
+        )
+
+    def test_rekey_leaves_live_trips_alone(self):
+        with override_settings(TRIP_NK_GENERATOR='trip.keys.md5_nk'):
+            live = Trip.objects.create(pick_up_address='A', drop_off_address='B', status=Trip.STARTED)
+            archived = Trip.objects.create(pick_up_address='A', drop_off_address='B', status=Trip.COMPLETED)
+        archive_trips()
+        trip_events.append(archived.nk, archived.version, {'nk': archived.nk})
+        call_command('rekey_trips', stdout=StringIO())
+        self.assertEqual(live.nk, Trip.objects.get(pk=live.pk).nk)
+        self.assertNotEqual(archived.nk, ArchivedTrip.objects.get(pk=archived.pk).nk)
+        self.assertIsNone(trip_events.get(archived.nk, archived.version))
+
+
+class TripExportTest(TestCase):
+    def test_export_reads_trips_in_chunks(self):
+        trips = [Trip.objects.create(pick_up_address=str(index), drop_off_address='B') for index in range(5)]
+        with self.assertNumQueries(3):
+            exported = list(export_trips([Trip.objects.all()], chunk_size=2))
+        self.assertEqual(trips, exported)
+
+    def test_export_merges_live_and_archived_trips(self):
+        trips = [
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', status=status)
+            for index, status in enumerate([Trip.COMPLETED, Trip.REQUESTED, Trip.COMPLETED, Trip.STARTED])
+        ]
+        archive_trips()
+        exported = export_trips([Trip.objects.all(), ArchivedTrip.objects.all()], chunk_size=1)
+        self.assertEqual([trip.nk for trip in trips], [trip.nk for trip in exported])
+
+    def test_exported_trips_can_be_imported(self):
+        driver = create_user(username='driver@example.com', group='driver')
+        rider = create_user(username='rider@example.com', group='rider')
+        for index in range(5):
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', rider=rider, driver=driver)
+        output = StringIO()
+        call_command('export_trips', stdout=output)
+        exported = [json.loads(line) for line in output.getvalue().splitlines()]
+        Trip.objects.all().delete()
+        get_user_model().objects.all().delete()
+        self.assertEqual((5, 0), import_trips(output.getvalue().splitlines(), batch_size=2))
+        self.assertEqual((0, 5), import_trips(output.getvalue().splitlines()))
+        Trip.objects.all().delete()
+        self.assertEqual((5, 1), import_trips(output.getvalue().splitlines()[:1] + output.getvalue().splitlines()))
+        trips = Trip.objects.select_related('driver', 'rider').order_by('created', 'id')
+        for data in exported:
+            del data['id'], data['driver']['id'], data['rider']['id']
+        imported = [serialize_trip(trip) for trip in trips]
+        for data in imported:
+            del data['id'], data['driver']['id'], data['rider']['id']
+        self.assertEqual(exported, imported)
+
+    def test_imported_trips_are_counted_in_stats(self):
+        driver = create_user(username='driver@example.com', group='driver')
+        for index, status in enumerate([Trip.REQUESTED, Trip.STARTED, Trip.COMPLETED, Trip.COMPLETED]):
+            Trip.objects.create(pick_up_address=str(index), drop_off_address='B', driver=driver, status=status)
+        output = StringIO()
+        call_command('export_trips', stdout=output)
+        rebuild_stats()
+        columns = ('hour', 'status', 'driver', 'count', 'wait_count', 'wait_seconds')
+        expected = sorted(TripStats.objects.values_list(*columns), key=str)
+        for upsert in [True, False]:
+            Trip.objects.all().delete()
+            TripStats.objects.all().delete()
+            with mock.patch('trip.stats._supports_upsert', return_value=upsert):
+                import_trips(output.getvalue().splitlines(), batch_size=3)
+            self.assertEqual(expected, sorted(TripStats.objects.values_list(*columns), key=str))
+
+
+class MetricsTest(TestCase):
+    def setUp(self):
+        registry.clear()
+        cache.clear()
+
+    def test_histograms_render_cumulative_buckets(self):
+        histogram = Histogram('latency_seconds', 'Latency.', ['handler'], buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value, handler='a"b')
+        self.assertEqual([
+            '# HELP latency_seconds Latency.',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{handler="a\\"b",le="0.1"} 1',
+            'latency_seconds_bucket{handler="a\\"b",le="1.0"} 2',
+            'latency_seconds_bucket{handler="a\\"b",le="+Inf"} 3',
+            'latency_seconds_sum{handler="a\\"b"} 5.55',
+            'latency_seconds_count{handler="a\\"b"} 3',
+        ], histogram.render(histogram.snapshot()))
+
+    def test_render_adds_up_published_processes(self):
+        other = Registry()
+        other.key = 'metrics:other:1'
+        other.register(Counter(errors.name, errors.help, errors.labels)).inc(2, handler='http', error='500')
+        other.publish()
+        errors.inc(handler='http', error='500')
+        self.assertIn('taxi_errors_total{handler="http",error="500"} 3', registry.render())
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_requests_are_timed_and_counted(self):
+        token = Token.objects.create(user=create_user())
+        self.client.get(reverse('trip:trip_list'), HTTP_AUTHORIZATION=f'Token {token}')
+        _, _, count = handler_seconds.get(handler='http', event='trip:trip_list')
+        self.assertEqual(1, count)
+        _, queries, _ = handler_queries.get(handler='http', event='trip:trip_list')
+        self.assertGreater(queries, 0)
+        with override_settings(METRICS_TOKEN='secret'):
+            response = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual('text/plain; version=0.0.4; charset=utf-8', response['Content-Type'])
+        self.assertIn('taxi_handler_seconds_count{handler="http",event="trip:trip_list"} 1', response.content.decode())
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_queries_are_counted_without_debug_cursors(self):
+        with track('test', 'event'):
+            self.assertFalse(connection.queries_logged)
+            list(Trip.objects.all())
+            list(ArchivedTrip.objects.all())
+        _, queries, _ = handler_queries.get(handler='test', event='event')
+        self.assertEqual(2, queries)
+
+    @override_settings(METRICS_ENABLED=True, METRICS_TOKEN='secret')
+    def test_metrics_need_staff_or_the_token(self):
+        self.assertEqual(403, self.client.get(reverse('metrics')).status_code)
+        self.assertEqual(403, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer wrong').status_code)
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(403, self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code)
+        staff = create_user(username='staff@example.com')
+        staff.is_staff = True
+        staff.save()
+        self.client.force_login(staff)
+        self.assertEqual(200, self.client.get(reverse('metrics')).status_code)
+
+    def test_metrics_are_hidden_when_disabled(self):
+        self.assertEqual(404, self.client.get(reverse('metrics')).status_code)
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=0.0)
+        self.limiter = RateLimiter(clock=self.clock)
+
+    def test_bucket_allows_a_burst_then_refills(self):
+        results = [self.limiter.take('message', ['user:1'], rate=2.0, burst=3) for _ in range(4)]
+        self.assertEqual([None, None, None, 0.5], results)
+        self.clock.return_value = 0.5
+        self.assertIsNone(self.limiter.take('message', ['user:1'], rate=2.0, burst=3))
+
+    def test_token_is_taken_from_every_bucket_or_none(self):
+        self.assertIsNone(self.limiter.take('message', ['user:1', 'channel:a'], rate=1.0, burst=1))
+        self.assertIsNotNone(self.limiter.take('message', ['user:1', 'channel:b'], rate=1.0, burst=1))
+        self.assertIsNone(self.limiter.take('message', ['user:2', 'channel:b'], rate=1.0, burst=1))
+
+    def test_least_recently_used_buckets_are_dropped(self):
+        limiter = RateLimiter(max_keys=2, clock=self.clock)
+        for key in ['a', 'b', 'c']:
+            limiter.take('message', [key], rate=1.0, burst=1)
+        self.assertEqual([('message', 'b'), ('message', 'c')], list(limiter.buckets))
+
+    def test_redis_buckets_live_on_the_first_key_shard(self):
+        backend = mock.Mock(prefix='asgi:')
+        backend.connection.return_value.register_script.return_value.return_value = None
+        RedisRateLimiter(clock=self.clock).take(backend, 'message', ['user:1', 'channel:a'], rate=1.0, burst=1)
+        backend.consistent_hash.assert_called_once_with('asgi:throttle:message:user:1')
+
+
+class PresenceTest(TestCase):
+    def setUp(self):
+        self.clock = mock.Mock(return_value=0.0)
+        self.presence = Presence(ttl=60, clock=self.clock)
+
+    def test_drivers_expire_without_heartbeats(self):
+        self.presence.connect(1, 'a', available=True)
+        self.presence.connect(2, 'b', available=True)
+        self.clock.return_value = 50.0
+        self.presence.heartbeat(2)
+        self.clock.return_value = 100.0
+        self.assertEqual({2}, self.presence.available([1, 2]))
+        self.assertEqual(['b'], self.presence.available_channels())
+        self.presence.heartbeat(1)
+        self.assertEqual(1, self.presence.count())
+
+    def test_drivers_on_a_trip_are_not_available(self):
+        self.presence.connect(1, 'a', available=False)
+        self.assertEqual(0, self.presence.count())
+        self.presence.set_available(1, True)
+        self.assertEqual({1}, self.presence.available([1]))
+        self.presence.set_available(1, False)
+        self.assertEqual(set(), self.presence.available([1]))
+
+    def test_disconnect_ignores_stale_channel(self):
+        self.presence.connect(1, 'a', available=True)
+        self.presence.connect(1, 'b', available=True)
+        self.presence.disconnect(1, 'a')
+        self.assertEqual(['b'], self.presence.available_channels())
+        self.presence.disconnect(1, 'b')
+        self.assertEqual(0, self.presence.count())
+
+
+@skipIf(REDIS_BACKEND is None, 'Redis is not reachable at REDIS_URL')
+class RedisScriptTest(TestCase):
+    def setUp(self):
+        self.backend = REDIS_BACKEND
+        self.clock = mock.Mock(return_value=1000.0)
+        self.presence = RedisPresence(ttl=60, clock=self.clock)
+
+    def tearDown(self):
+        connection = self.backend.connection(0)
+        for key in connection.scan_iter(f'{self.backend.prefix}*'):
+            connection.delete(key)
+
+    def test_drivers_expire_without_heartbeats(self):
+        self.presence.connect(self.backend, 1, ('a', 'json'), available=True)
+        self.presence.connect(self.backend, 2, ('b', 'json'), available=True)
+        self.clock.return_value = 1050.0
+        self.presence.heartbeat(self.backend, 2)
+        self.clock.return_value = 1100.0
+        self.assertEqual({2}, self.presence.available(self.backend, [1, 2]))
+        self.assertEqual([('b', 'json')], self.presence.available_channels(self.backend))
+        self.assertEqual({2}, self.presence.available(self.backend))
+
+    def test_formats_are_counted_until_their_sockets_close(self):
+        delta = Format(delta=True, encoding='json')
+        for count_format in [format_opened, format_opened, format_closed]:
+            count_format(delta, self.backend)
+        self.assertEqual([DEFAULT_FORMAT, delta], formats_in_use(self.backend))
+        format_closed(delta, self.backend)
+        self.assertEqual([DEFAULT_FORMAT], formats_in_use(self.backend))
+
+    def test_heartbeat_does_not_revive_an_expired_driver(self):
+        self.presence.connect(self.backend, 1, ('a', 'json'), available=True)
+        self.clock.return_value = 1100.0
+        # Nothing has purged the driver yet; the heartbeat itself must notice.
+        self.presence.heartbeat(self.backend, 1)
+        online, available, channels = self.presence._keys(self.backend)
+        connection = self.presence._connection(self.backend)
+        self.assertEqual((None, None, None), (
+            connection.zscore(online, 1), connection.zscore(available, 1), connection.hget(channels, 1)
+        ))
+
+    def test_availability_and_stale_disconnects(self):
+        self.presence.connect(self.backend, 1, ('a', 'json'), available=False)
+        self.assertEqual(0, self.presence.count(self.backend))
+        self.presence.set_available(self.backend, 1, True)
+        self.presence.connect(self.backend, 1, ('b', 'json'), available=True)
+        self.presence.disconnect(self.backend, 1, ('a', 'json'))
+        self.assertEqual([('b', 'json')], self.presence.available_channels(self.backend))
+        self.presence.disconnect(self.backend, 1, ('b', 'json'))
+        self.assertEqual(0, self.presence.count(self.backend))
+
+    def test_rate_limit_buckets(self):
+        limiter = RedisRateLimiter(clock=self.clock)
+        results = [limiter.take(self.backend, 'message', ['user:1', 'channel:a'], rate=2.0, burst=3) for _ in range(4)]
+        self.assertEqual([None, None, None, 0.5], results)
+        self.assertIsNotNone(limiter.take(self.backend, 'message', ['user:1', 'channel:b'], rate=2.0, burst=3))
+        self.clock.return_value = 1000.5
+        self.assertIsNone(limiter.take(self.backend, 'message', ['user:1', 'channel:b'], rate=2.0, burst=3))
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTest(TestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.rider = create_user()
+        self.other = create_user(username='other@example.com')
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_reads_go_to_replicas_and_writes_to_primary(self):
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('replica', self.router.db_for_read(Trip))
+            self.assertEqual('default', self.router.db_for_write(Trip))
+
+    def test_reads_after_a_write_go_to_primary(self):
+        with read_your_writes(lambda: self.rider):
+            self.router.db_for_write(Trip)
+            self.assertEqual('default', self.router.db_for_read(Trip))
+
+    def test_writer_sticks_to_primary_for_the_window(self):
+        with read_your_writes(lambda: self.rider):
+            self.router.db_for_write(Trip)
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('default', self.router.db_for_read(Trip))
+        with read_your_writes(lambda: self.other):
+            self.assertEqual('replica', self.router.db_for_read(Trip))
+        # The window has passed once the pin expires from the cache.
+        cache.clear()
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('replica', self.router.db_for_read(Trip))
+
+    def test_user_known_by_the_end_of_the_block_is_pinned(self):
+        users = [None, self.rider]
+        with read_your_writes(lambda: users[0]):
+            self.router.db_for_write(Trip)
+            users[0] = self.rider
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('default', self.router.db_for_read(Trip))
+
+    def test_session_writes_do_not_pin(self):
+        with read_your_writes(lambda: self.rider):
+            self.router.db_for_write(Session)
+            self.assertEqual('replica', self.router.db_for_read(Trip))
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('replica', self.router.db_for_read(Trip))
+
+    def test_pin_is_seen_by_another_process(self):
+        # A file cache stands in for memcached; the other thread gets its own
+        # cache instance and router, as another worker process would.
+        with tempfile.TemporaryDirectory() as location, override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'pins': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location},
+        }, READ_YOUR_WRITES_CACHE='pins'):
+            with read_your_writes(lambda: self.rider):
+                self.router.db_for_write(Trip)
+            self.assertIsNone(cache.get(pin_key(self.rider.id)))
+            aliases = []
+
+            def other_worker():
+                with read_your_writes(lambda: self.rider):
+                    aliases.append(ReplicaRouter().db_for_read(Trip))
+
+            thread = threading.Thread(target=other_worker)
+            thread.start()
+            thread.join(10)
+            self.assertEqual(['default'], aliases)
+
+    def test_pin_cache_must_be_shared(self):
+        self.assertEqual(['trip.E001'], [error.id for error in check_read_your_writes_cache(None)])
+        with override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache', 'LOCATION': 'localhost'}
+        }):
+            self.assertEqual([], check_read_your_writes_cache(None))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_everything_goes_to_primary_without_replicas(self):
+        with read_your_writes(lambda: self.rider):
+            self.assertEqual('default', self.router.db_for_read(Trip))
+
+
+class TripTransitionTest(TestCase):
+    def setUp(self):
+        self.driver = create_user(username='driver@example.com', group='driver')
+        self.trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+
+    def test_driver_moves_trip_through_statuses(self):
+        for status in [Trip.STARTED, Trip.IN_PROGRESS, Trip.COMPLETED]:
+            with self.assertNumQueries(1):
+                self.assertTrue(Trip.objects.transition(self.trip.nk, status, driver=self.driver))
+        trip = Trip.objects.get(pk=self.trip.pk)
+        self.assertEqual((Trip.COMPLETED, self.driver), (trip.status, trip.driver))
+
+    def test_transition_increments_version(self):
+        version = self.trip.version
+        Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=self.driver)
+        self.assertEqual(version + 1, Trip.objects.get(pk=self.trip.pk).version)
+
+    def test_stale_instances_save_new_versions(self):
+        first, second = Trip.objects.get(pk=self.trip.pk), Trip.objects.get(pk=self.trip.pk)
+        first.save()
+        second.save()
+        self.assertEqual((self.trip.version + 1, self.trip.version + 2), (first.version, second.version))
+        self.assertEqual(second.version, Trip.objects.get(pk=self.trip.pk).version)
+
+    def test_trip_cannot_skip_a_status(self):
+        self.assertFalse(Trip.objects.transition(self.trip.nk, Trip.COMPLETED, driver=self.driver))
+        self.assertEqual(Trip.REQUESTED, Trip.objects.get(pk=self.trip.pk).status)
+
+    def test_only_assigned_driver_can_advance_trip(self):
+        other = create_user(username='other@example.com', group='driver')
+        Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=self.driver)
+        self.assertFalse(Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=other))
+        self.assertFalse(Trip.objects.transition(self.trip.nk, Trip.IN_PROGRESS, driver=other))
+        self.assertEqual(self.driver, Trip.objects.get(pk=self.trip.pk).driver)
+
+    def test_offered_trip_can_only_be_claimed_by_offered_driver(self):
+        other = create_user(username='other@example.com', group='driver')
+        Trip.objects.filter(pk=self.trip.pk).update(
+            offered_to=self.driver, offer_expires=timezone.now() + datetime.timedelta(seconds=15)
+        )
+        self.assertFalse(Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=other, offered=True))
+        self.assertTrue(Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=self.driver, offered=True))
+
+    def test_expired_offer_cannot_be_claimed(self):
+        Trip.objects.filter(pk=self.trip.pk).update(offered_to=self.driver, offer_expires=timezone.now())
+        self.assertFalse(Trip.objects.transition(self.trip.nk, Trip.STARTED, driver=self.driver, offered=True))
+
+
+class ConcurrentClaimTest(TransactionTestCase):
+    def test_exactly_one_driver_claims_a_requested_trip(self):
+        drivers = [create_user(username=f'driver{index}@example.com', group='driver') for index in range(16)]
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        barrier = threading.Barrier(len(drivers))
+        winners, gave_up = [], []
+
+        def claim(driver):
+            barrier.wait()
+            try:
+                for _ in range(1000):
+                    try:
+                        claimed = Trip.objects.transition(trip.nk, Trip.STARTED, driver=driver)
+                        break
+                    except OperationalError:
+                        # The shared in-memory test database reports lock conflicts instead of waiting.
+                        time.sleep(0.001)
+                else:
+                    gave_up.append(driver)
+                    return
+                if claimed:
+                    winners.append(driver)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=claim, args=(driver,)) for driver in drivers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], gave_up)
+        self.assertEqual(1, len(winners))
+        self.assertEqual(winners[0], Trip.objects.get(pk=trip.pk).driver)
+
+
+class TripEventLogTest(TestCase):
+    def setUp(self):
+        self.log = TripEventLog(size=3)
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_since_returns_missed_events(self):
+        for version in range(1, 4):
+            self.log.append('nk', version, {'version': version})
+        self.assertEqual([{'version': 2}, {'version': 3}], self.log.since('nk', 1))
+        self.assertEqual([], self.log.since('nk', 3))
+
+    def test_since_detects_gaps(self):
+        for version in range(1, 5):
+            self.log.append('nk', version, {'version': version})
+        self.assertIsNone(self.log.since('nk', 0))
+        self.assertIsNone(self.log.since('other', 0))
+
+
+class RecordingPipeline:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append(name)
+
+
+class GroupBatchTest(TestCase):
+    def setUp(self):
+        self.calls = []
+        self.layer = RedisChannelLayer(hosts=['redis://localhost:6379'])
+        self.layer.connection = lambda index: mock.Mock(pipeline=lambda transaction: RecordingPipeline(self.calls))
+
+    def test_group_add_many_pipelines_commands(self):
+        group_add_many(['a', 'b', 'c'], 'websocket.send!abc', channel_layer=self.layer)
+        self.assertEqual(['zadd', 'expire'] * 3 + ['execute'], self.calls)
+
+    def test_group_discard_many_pipelines_commands(self):
+        group_discard_many(['a', 'b'], 'websocket.send!abc', channel_layer=self.layer)
+        self.assertEqual(['zrem', 'zrem', 'execute'], self.calls)
+
+
+class LocationBufferTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.buffer = LocationBuffer(flush_interval=2.0, flush_size=3, background=False, clock=lambda: self.now)
+        self.drivers = [create_user(username=f'driver{index}@example.com', group='driver') for index in range(3)]
+
+    def test_pings_are_coalesced_per_driver(self):
+        self.buffer.add(self.drivers[0].id, 40.0, -74.0)
+        self.buffer.add(self.drivers[0].id, 40.1, -74.1)
+        self.assertEqual(1, len(self.buffer))
+        self.assertFalse(DriverLocation.objects.exists())
+        self.assertEqual(1, self.buffer.flush())
+        location = DriverLocation.objects.get(driver=self.drivers[0])
+        self.assertEqual((40.1, -74.1), (location.latitude, location.longitude))
+
+    def test_buffer_flushes_when_full(self):
+        for driver in self.drivers:
+            self.buffer.add(driver.id, 40.0, -74.0)
+        self.assertEqual(0, len(self.buffer))
+        self.assertEqual(3, DriverLocation.objects.count())
+
+    def test_buffer_flushes_after_interval(self):
+        self.buffer.add(self.drivers[0].id, 40.0, -74.0)
+        self.now = 2.0
+        self.buffer.add(self.drivers[1].id, 40.0, -74.0)
+        self.assertEqual(2, DriverLocation.objects.count())
+
+    def test_flush_updates_existing_locations_in_bulk(self):
+        for driver in self.drivers[:2]:
+            self.buffer.add(driver.id, 40.0, -74.0)
+        self.buffer.flush()
+        for driver in self.drivers[:2]:
+            self.buffer.add(driver.id, 41.0, -75.0)
+        # One SELECT and one UPDATE, wrapped in a savepoint.
+        with self.assertNumQueries(4):
+            self.buffer.flush()
+        self.assertEqual(2, DriverLocation.objects.filter(latitude=41.0, longitude=-75.0).count())
+
+    def test_failed_flush_keeps_positions(self):
+        self.buffer.add(self.drivers[0].id, 40.0, -74.0)
+        self.buffer.add(self.drivers[1].id, 40.0, -74.0)
+        with mock.patch('trip.locations.write_locations', side_effect=OperationalError('database is locked')), \
+                self.assertLogs('trip.locations', 'ERROR'):
+            self.assertEqual(0, self.buffer.flush())
+        self.assertEqual(2, len(self.buffer))
+        self.buffer.add(self.drivers[0].id, 41.0, -75.0)
+        self.assertEqual(2, self.buffer.flush())
+        location = DriverLocation.objects.get(driver=self.drivers[0])
+        self.assertEqual((41.0, -75.0), (location.latitude, location.longitude))
+        self.assertTrue(DriverLocation.objects.filter(driver=self.drivers[1]).exists())
+
+    def test_older_positions_do_not_overwrite_newer_ones(self):
+        now = timezone.now()
+        write_locations({self.drivers[0].id: (41.0, -75.0, now)})
+        write_locations({self.drivers[0].id: (40.0, -74.0, now - datetime.timedelta(seconds=1))})
+        location = DriverLocation.objects.get(driver=self.drivers[0])
+        self.assertEqual((41.0, -75.0), (location.latitude, location.longitude))
+
+    def test_pings_leave_flushing_to_a_flush_under_way(self):
+        self.buffer.flush_lock.acquire()
+        try:
+            for driver in self.drivers:
+                self.buffer.add(driver.id, 40.0, -74.0)
+        finally:
+            self.buffer.flush_lock.release()
+        self.assertEqual(3, len(self.buffer))
+        self.assertEqual(3, self.buffer.flush())
+
+
+class ConcurrentWorkerTest(TestCase):
+    def setUp(self):
+        self.layer = mock.Mock(router=mock.Mock(channels=['websocket.receive']))
+        self.handled = []
+
+    def run_worker(self, worker, messages):
+        # Feed `messages` through the receive loop, then stop once the pool holds nothing.
+        messages = deque(messages)
+
+        def receive_many(channels, block):
+            if messages:
+                return 'websocket.receive', messages.popleft()
+            if not worker.pending:
+                worker.termed = True
+            return None, None
+
+        self.layer.receive_many.side_effect = receive_many
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+    def test_keeps_each_sockets_messages_in_order(self):
+        worker = ConcurrentWorker(self.layer, signal_handlers=False, threads=4)
+        running, overlapped = set(), []
+
+        def handle(channel, content):
+            if content['reply_channel'] in running:
+                overlapped.append(content['reply_channel'])
+            running.add(content['reply_channel'])
+            time.sleep(0.001)
+            self.handled.append((content['reply_channel'], content['index']))
+            running.discard(content['reply_channel'])
+
+        worker.handle = handle
+        self.run_worker(worker, [
+            {'reply_channel': f'socket{socket}', 'index': index} for index in range(10) for socket in range(3)
+        ])
+        self.assertEqual([], overlapped)
+        self.assertEqual(30, len(self.handled))
+        for socket in range(3):
+            self.assertEqual(
+                list(range(10)), [index for reply_channel, index in self.handled if reply_channel == f'socket{socket}']
+            )
+
+    def test_runs_different_sockets_concurrently(self):
+        worker = ConcurrentWorker(self.layer, signal_handlers=False, threads=2)
+        # Each handler waits for the other, so this only finishes if both run at once.
+        barrier = threading.Barrier(2, timeout=5)
+
+        def handle(channel, content):
+            barrier.wait()
+            self.handled.append(content['reply_channel'])
+
+        worker.handle = handle
+        self.run_worker(worker, [{'reply_channel': 'a'}, {'reply_channel': 'b'}])
+        self.assertEqual({'a', 'b'}, set(self.handled))
+
+    def test_stops_receiving_at_max_pending(self):
+        worker = ConcurrentWorker(self.layer, signal_handlers=False, threads=2, max_pending=3)
+        release = threading.Event()
+        worker.handle = lambda channel, content: release.wait(5)
+        thread = threading.Thread(target=self.run_worker, args=(worker, [{'reply_channel': 'a'}] * 10))
+        thread.start()
+        time.sleep(0.1)
+        self.assertEqual(3, worker.pending)
+        self.assertEqual(3, self.layer.receive_many.call_count)
+        release.set()
+        thread.join(10)
+        self.assertEqual(0, worker.pending)
+
+
 class WebSocketTripTest(ChannelTestCase):
     def setUp(self):
         self.driver = create_user(username='driver@example.com', group='driver')
         self.rider = create_user(username='rider@example.com', group='rider')
+        patcher = mock.patch('trip.consumers.location_buffer', LocationBuffer(background=False))
+        self.location_buffer = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        driver_index.clear()
+        presence.clear()
+        heartbeats_sent.clear()
+        format_counts.clear()
+        rate_limiter.clear()
+        cache.clear()
 
-    def connect_as_driver(self, driver):
+    def connect_as_driver(self, driver, query_string=''):
         client = HttpClient()
         client.login(username=driver.username, password=PASSWORD)
-        client.send_and_consume('websocket.connect', path='/driver/')
+        client.send_and_consume('websocket.connect', path='/driver/', content={'query_string': query_string})
         return client
 
-    def connect_as_rider(self, rider):
+    def connect_as_rider(self, rider, query_string=''):
         client = HttpClient()
         client.login(username=rider.username, password=PASSWORD)
-        client.send_and_consume('websocket.connect', path='/rider/')
+        client.send_and_consume('websocket.connect', path='/rider/', content={'query_string': query_string})
         return client
 
-    def create_trip(self, rider, pick_up_address='A', drop_off_address='B'):
+    def create_trip(self, rider, pick_up_address='A', drop_off_address='B', **kwargs):
         client = self.connect_as_rider(rider)
         client.send_and_consume('websocket.receive', path='/rider/', content={
             'text': {
                 'pick_up_address': pick_up_address,
                 'drop_off_address': drop_off_address,
-                'rider': PublicUserSerializer(rider).data
+                'rider': PublicUserSerializer(rider).data,
+                **kwargs
             }
         })
         return client
 
+    def send_location(self, client, latitude, longitude):
+        client.send_and_consume('websocket.receive', path='/driver/', content={
+            'text': {'type': 'location', 'latitude': latitude, 'longitude': longitude}
+        })
+
     def update_trip(self, driver, trip, status):
         client = self.connect_as_driver(driver)
         client.send_and_consume('websocket.receive', path='/driver/', content={
@@ -119,6 +1449,13 @@ class WebSocketTripTest(ChannelTestCase):
         })
         return client
 
+    def test_transition_is_undone_when_stats_fail(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        with mock.patch('trip.consumers.record_status', side_effect=OperationalError), \
+                self.assertRaises(OperationalError):
+            self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        self.assertEqual((Trip.REQUESTED, None), Trip.objects.values_list('status', 'driver').get(pk=trip.pk))
+
     def test_driver_can_connect_via_websockets(self):
         client = HttpClient()
         client.login(username=self.driver.username, password='pAssw0rd!')
@@ -138,6 +1475,10 @@ class WebSocketTripTest(ChannelTestCase):
         trip = Trip.objects.last()
         self.assertEqual(TripSerializer(trip).data, client.receive())
 
+    def test_trip_is_created_for_connected_rider(self):
+        self.create_trip(self.rider)
+        self.assertEqual(self.rider, Trip.objects.last().rider)
+
     def test_rider_is_subscribed_to_trip_channel(self):
         client = self.create_trip(self.rider)
         client.receive()
@@ -175,6 +1516,16 @@ class WebSocketTripTest(ChannelTestCase):
         Group(trip.nk).send(message)
         self.assertEqual(message, client.receive())
 
+    def test_losing_driver_is_told_trip_is_taken(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        other = create_user(username='other@example.com', group='driver')
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        client = self.update_trip(other, trip=trip, status=Trip.STARTED)
+        self.assertEqual({
+            'type': 'error', 'nk': trip.nk, 'detail': 'Trip cannot be moved to STARTED.'
+        }, client.receive())
+        self.assertEqual(self.driver, Trip.objects.get(nk=trip.nk).driver)
+
     def test_rider_is_alerted_on_trip_update(self):
         client = self.create_trip(self.rider)
         client.receive()
@@ -182,3 +1533,368 @@ class WebSocketTripTest(ChannelTestCase):
         self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
         trip = Trip.objects.get(nk=trip.nk)
         self.assertEqual(TripSerializer(trip).data, client.receive())
+
+    def test_driver_can_report_location(self):
+        client = self.connect_as_driver(self.driver)
+        self.send_location(client, 40.7000, -74.0000)
+        self.assertEqual((40.7000, -74.0000), driver_index.position(self.driver.id))
+        self.location_buffer.flush()
+        self.assertTrue(DriverLocation.objects.filter(driver=self.driver).exists())
+        client.send_and_consume('websocket.disconnect', path='/driver/')
+        self.assertNotIn(self.driver.id, driver_index)
+
+    def test_only_nearby_drivers_are_alerted_on_trip_creation(self):
+        far_driver = create_user(username='far.driver@example.com', group='driver')
+        client = self.connect_as_driver(self.driver)
+        far_client = self.connect_as_driver(far_driver)
+        self.send_location(client, 40.7000, -74.0000)
+        self.send_location(far_client, 41.5000, -74.0000)
+        self.create_trip(self.rider, pick_up_latitude=40.7010, pick_up_longitude=-74.0000)
+        trip = Trip.objects.last()
+        self.assertEqual(TripSerializer(trip).data, client.receive())
+        self.assertIsNone(far_client.receive())
+
+    def test_all_available_drivers_are_alerted_when_none_is_nearby(self):
+        far_driver = create_user(username='far.driver@example.com', group='driver')
+        far_client = self.connect_as_driver(far_driver)
+        unplaced_client = self.connect_as_driver(self.driver)
+        self.send_location(far_client, 41.5000, -74.0000)
+        self.create_trip(self.rider, pick_up_latitude=40.7010, pick_up_longitude=-74.0000)
+        trip = Trip.objects.last()
+        self.assertEqual(TripSerializer(trip).data, far_client.receive())
+        self.assertEqual(TripSerializer(trip).data, unplaced_client.receive())
+
+    def test_drivers_on_a_trip_are_not_alerted_on_trip_creation(self):
+        busy_driver = create_user(username='busy.driver@example.com', group='driver')
+        client = self.connect_as_driver(self.driver)
+        busy_client = self.update_trip(
+            busy_driver, trip=Trip.objects.create(pick_up_address='A', drop_off_address='B'), status=Trip.STARTED
+        )
+        busy_client.receive()
+        self.send_location(client, 40.7000, -74.0000)
+        self.send_location(busy_client, 40.7000, -74.0000)
+        self.create_trip(self.rider, pick_up_latitude=40.7010, pick_up_longitude=-74.0000)
+        self.create_trip(self.rider)
+        self.assertEqual(2, len([client.receive(), client.receive()]))
+        self.assertIsNone(busy_client.receive())
+
+    def test_driver_is_available_again_after_completing_trip(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        for status in [Trip.STARTED, Trip.IN_PROGRESS]:
+            self.update_trip(self.driver, trip=trip, status=status)
+        self.assertEqual(0, presence.count())
+        self.update_trip(self.driver, trip=trip, status=Trip.COMPLETED)
+        self.assertEqual(1, presence.count())
+
+    def test_driver_who_expired_during_a_trip_is_available_after_completing_it(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        client = self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        presence.clear()
+        for status in [Trip.IN_PROGRESS, Trip.COMPLETED]:
+            client.send_and_consume('websocket.receive', path='/driver/', content={
+                'text': {'nk': trip.nk, 'pick_up_address': 'A', 'drop_off_address': 'B', 'status': status}
+            })
+        self.assertEqual(1, presence.count())
+
+    def test_trip_updates_count_as_heartbeats(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        with mock.patch('trip.consumers.driver_heartbeat') as driver_heartbeat:
+            self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        driver_heartbeat.assert_called_once_with(self.driver.id)
+
+    def test_disconnected_drivers_are_not_alerted_on_trip_creation(self):
+        client = self.connect_as_driver(self.driver)
+        client.send_and_consume('websocket.disconnect', path='/driver/')
+        self.create_trip(self.rider)
+        self.assertIsNone(client.receive())
+
+    def test_available_driver_count(self):
+        self.connect_as_driver(self.driver)
+        self.connect_as_driver(create_user(username='other@example.com', group='driver'))
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.rider)}')
+        response = client.get(reverse('available_drivers'))
+        self.assertEqual({'available': 2}, response.data)
+
+    def test_rider_is_subscribed_to_active_trips_on_connect(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.rider)
+        client = self.connect_as_rider(self.rider)
+        message = {'message': 'test'}
+        Group(trip.nk).send(message)
+        self.assertEqual(message, client.receive())
+
+    def test_reconnect_subscribes_to_trips_created_since(self):
+        Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.rider)
+        self.connect_as_rider(self.rider)
+        # Created where no signal reaches this process, as by another worker.
+        Trip.objects.bulk_create([Trip(nk='f' * 32, pick_up_address='B', drop_off_address='C', rider=self.rider)])
+        client = self.connect_as_rider(self.rider)
+        message = {'message': 'test'}
+        Group('f' * 32).send(message)
+        self.assertEqual(message, client.receive())
+
+    def test_driver_reconnect_subscribes_to_claimed_trips(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        self.connect_as_driver(self.driver)
+        Trip.objects.filter(pk=trip.pk).update(status=Trip.STARTED, driver=self.driver)
+        client = self.connect_as_driver(self.driver)
+        message = {'message': 'test'}
+        Group(trip.nk).send(message)
+        self.assertEqual(message, client.receive())
+
+    def assertWithinBudget(self, step, function, *args, **kwargs):
+        with CaptureQueriesContext(connection) as queries:
+            function(*args, **kwargs)
+        # Inside the test transaction each BEGIN becomes a SAVEPOINT and a RELEASE.
+        count = len([query for query in queries if not query['sql'].startswith('RELEASE SAVEPOINT')])
+        self.assertLessEqual(count, QUERY_BUDGETS[step], step)
+
+    def test_dispatch_flow_stays_within_query_budgets(self):
+        driver_client, rider_client = HttpClient(), HttpClient()
+        driver_client.login(username=self.driver.username, password=PASSWORD)
+        rider_client.login(username=self.rider.username, password=PASSWORD)
+        self.assertWithinBudget('driver connect', driver_client.send_and_consume, 'websocket.connect', path='/driver/')
+        self.assertWithinBudget('rider connect', rider_client.send_and_consume, 'websocket.connect', path='/rider/')
+        request = {'pick_up_address': 'A', 'drop_off_address': 'B', 'rider': PublicUserSerializer(self.rider).data}
+        self.assertWithinBudget(
+            'trip request', rider_client.send_and_consume, 'websocket.receive', path='/rider/',
+            content={'text': request}
+        )
+        nk = driver_client.receive()['nk']
+        self.assertWithinBudget(
+            'trip accept', driver_client.send_and_consume, 'websocket.receive', path='/driver/',
+            content={'text': {'nk': nk, 'status': Trip.STARTED}}
+        )
+        self.assertEqual(Trip.STARTED, Trip.objects.get(nk=nk).status)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.rider)}')
+        self.assertWithinBudget('trip list', client.get, reverse('trip:trip_list'))
+        self.assertWithinBudget('trip retrieve', client.get, reverse('trip:trip_detail', kwargs={'trip_nk': nk}))
+
+    def resume(self, client, path, trips):
+        client.send_and_consume('websocket.receive', path=path, content={'text': {'type': 'resume', 'trips': trips}})
+
+    def test_rider_can_resume_missed_updates(self):
+        client = self.create_trip(self.rider)
+        last_seen = client.receive()['version']
+        client.send_and_consume('websocket.disconnect', path='/rider/')
+        trip = Trip.objects.last()
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        self.update_trip(self.driver, trip=trip, status=Trip.IN_PROGRESS)
+        client = self.connect_as_rider(self.rider)
+        self.resume(client, '/rider/', {trip.nk: last_seen})
+        self.assertEqual(Trip.STARTED, client.receive()['status'])
+        self.assertEqual(serialize_trip(Trip.objects.get(nk=trip.nk)), client.receive())
+        self.assertIsNone(client.receive())
+
+    def test_rider_gets_current_trip_when_updates_are_gone(self):
+        client = self.create_trip(self.rider)
+        last_seen = client.receive()['version']
+        trip = Trip.objects.last()
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        client.receive()
+        cache.delete(trip_events.key(trip.nk))
+        self.resume(client, '/rider/', {trip.nk: last_seen})
+        self.assertEqual(serialize_trip(Trip.objects.get(nk=trip.nk)), client.receive())
+        self.assertIsNone(client.receive())
+
+    def test_resume_ignores_trips_the_socket_does_not_follow(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        client = self.connect_as_rider(self.rider)
+        self.resume(client, '/rider/', {trip.nk: 0})
+        self.assertIsNone(client.receive())
+
+    def test_delta_subscriber_gets_changed_fields_only(self):
+        self.create_trip(self.rider)
+        trip = Trip.objects.last()
+        client = self.connect_as_rider(self.rider, query_string='delta=1')
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        message = client.receive()
+        self.assertEqual(('delta', trip.nk, trip.version + 1), (message['type'], message['nk'], message['version']))
+        self.assertEqual(Trip.STARTED, message['changes']['status'])
+        self.assertEqual(self.driver.username, message['changes']['driver']['username'])
+        self.assertNotIn('pick_up_address', message['changes'])
+
+    def test_delta_subscriber_gets_whole_trip_when_previous_version_is_gone(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.rider)
+        client = self.connect_as_rider(self.rider, query_string='delta=1')
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        self.assertEqual(serialize_trip(Trip.objects.get(nk=trip.nk)), client.receive())
+
+    def test_updates_are_sent_only_in_formats_some_socket_has_open(self):
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B', rider=self.rider)
+        client = self.connect_as_rider(self.rider, query_string='delta=1')
+        with mock.patch('trip.consumers.Group') as group:
+            self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        self.assertEqual([trip.nk, f'{trip.nk}.delta'], [args[0] for args, _ in group.call_args_list])
+        client.send_and_consume('websocket.disconnect', path='/rider/')
+        self.assertEqual([DEFAULT_FORMAT], formats_in_use())
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_subscriber_gets_binary_frames(self):
+        self.create_trip(self.rider)
+        trip = Trip.objects.last()
+        client = self.connect_as_rider(self.rider, query_string='encoding=msgpack')
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        message = client.receive()
+        self.assertNotIn('text', message)
+        self.assertEqual(serialize_trip(Trip.objects.get(nk=trip.nk)), msgpack.unpackb(message['bytes'], raw=False))
+
+    @skipIf(msgpack is None, 'msgpack is not installed')
+    def test_msgpack_driver_is_alerted_on_trip_creation(self):
+        client = self.connect_as_driver(self.driver, query_string='encoding=msgpack&delta=1')
+        self.create_trip(self.rider)
+        message = msgpack.unpackb(client.receive()['bytes'], raw=False)
+        self.assertEqual(serialize_trip(Trip.objects.last()), message)
+
+    @override_settings(TRIP_ARCHIVE_ON_COMPLETE=True)
+    def test_completed_trips_can_be_archived_on_completion(self):
+        trip = Trip.objects.create(
+            pick_up_address='A', drop_off_address='B', driver=self.driver, status=Trip.IN_PROGRESS
+        )
+        self.update_trip(self.driver, trip=trip, status=Trip.COMPLETED)
+        self.assertFalse(Trip.objects.filter(nk=trip.nk).exists())
+        self.assertEqual(Trip.COMPLETED, ArchivedTrip.objects.get(nk=trip.nk).status)
+
+    @override_settings(METRICS_ENABLED=True)
+    def test_socket_metrics_are_recorded(self):
+        registry.clear()
+        trip = Trip.objects.create(pick_up_address='A', drop_off_address='B')
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        other = create_user(username='other@example.com', group='driver')
+        self.update_trip(other, trip=trip, status=Trip.STARTED)
+        self.assertEqual(2, connected_sockets.get(role='driver'))
+        _, _, count = handler_seconds.get(handler='DriverConsumer', event='receive')
+        self.assertEqual(2, count)
+        self.assertEqual(1, errors.get(handler='DriverConsumer', error='TransitionRejected'))
+        _, sockets, _ = group_send_fanout.get(kind='trip')
+        self.assertEqual(1, sockets)
+
+    @override_settings(SOCKET_RATE_LIMITS={
+        'location': {'rate': 0.001, 'burst': 2}, 'message': {'rate': 0.001, 'burst': 3}
+    })
+    def test_trip_request_bursts_are_rate_limited(self):
+        client = self.connect_as_rider(self.rider)
+        for index in range(5):
+            client.send_and_consume('websocket.receive', path='/rider/', content={
+                'text': {'pick_up_address': str(index), 'drop_off_address': 'B'}
+            })
+        self.assertEqual(3, Trip.objects.count())
+        messages = [client.receive() for _ in range(5)]
+        self.assertEqual([None, None, None], [message.get('type') for message in messages[:3]])
+        self.assertEqual(['error', 'error'], [message['type'] for message in messages[3:]])
+        self.assertEqual('Too many messages.', messages[3]['detail'])
+        self.assertGreater(messages[3]['retry_after'], 0)
+        self.assertIsNone(client.receive())
+
+    @override_settings(SOCKET_RATE_LIMITS={
+        'location': {'rate': 0.001, 'burst': 2}, 'message': {'rate': 0.001, 'burst': 3}
+    })
+    def test_location_floods_are_dropped_quietly(self):
+        client = self.connect_as_driver(self.driver)
+        for index in range(5):
+            self.send_location(client, 40.7000 + index / 1000, -74.0000)
+        self.assertEqual((40.7010, -74.0000), driver_index.position(self.driver.id))
+        self.assertIsNone(client.receive())
+
+    @override_settings(SOCKET_RATE_LIMITS={
+        'location': {'rate': 0.001, 'burst': 2}, 'heartbeat': {'rate': 0.001, 'burst': 2},
+        'message': {'rate': 0.001, 'burst': 1}
+    })
+    def test_heartbeats_have_their_own_quiet_bucket(self):
+        client = self.connect_as_driver(self.driver)
+        for _ in range(5):
+            client.send_and_consume('websocket.receive', path='/driver/', content={'text': {'type': 'heartbeat'}})
+        self.assertIsNone(client.receive())
+        self.assertIsNotNone(rate_limiter.take('heartbeat', [f'user:{self.driver.id}'], rate=0.001, burst=2))
+        self.assertIsNone(rate_limiter.take('message', [f'user:{self.driver.id}'], rate=0.001, burst=1))
+
+    @override_settings(SOCKET_RATE_LIMITS={
+        'location': {'rate': 0.001, 'burst': 2}, 'message': {'rate': 0.001, 'burst': 1}
+    })
+    def test_rate_limit_follows_the_user_across_sockets(self):
+        self.create_trip(self.rider)
+        client = self.create_trip(self.rider)
+        self.assertEqual('error', client.receive()['type'])
+        self.assertEqual(1, Trip.objects.count())
+
+    def place_driver(self, driver, latitude, longitude):
+        DriverLocation.objects.update_or_create(
+            driver=driver, defaults={'latitude': latitude, 'longitude': longitude, 'updated': timezone.now()}
+        )
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_batch_dispatcher_offers_trip_to_nearest_driver_only(self):
+        far_driver = create_user(username='far.driver@example.com', group='driver')
+        client = self.connect_as_driver(self.driver)
+        far_client = self.connect_as_driver(far_driver)
+        self.place_driver(self.driver, 40.7000, -74.0000)
+        self.place_driver(far_driver, 40.7300, -74.0000)
+        self.create_trip(self.rider, pick_up_latitude=40.7010, pick_up_longitude=-74.0000)
+        self.assertIsNone(client.receive())
+        trip = Trip.objects.last()
+        self.assertEqual([(trip.id, self.driver.id)], [
+            (trip_id, driver_id) for trip_id, driver_id, _ in BatchDispatcher().tick()
+        ])
+        message = client.receive()
+        self.assertEqual(('offer', trip.nk), (message['type'], message['trip']['nk']))
+        self.assertIsNone(far_client.receive())
+        # A driver with a live offer is not offered anything else.
+        self.assertEqual([], BatchDispatcher().tick())
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_only_offered_driver_can_claim_trip(self):
+        other = create_user(username='other@example.com', group='driver')
+        self.connect_as_driver(self.driver)
+        self.place_driver(self.driver, 40.7000, -74.0000)
+        trip = Trip.objects.create(
+            pick_up_address='A', drop_off_address='B', pick_up_latitude=40.7010, pick_up_longitude=-74.0000
+        )
+        BatchDispatcher().tick()
+        client = self.update_trip(other, trip=trip, status=Trip.STARTED)
+        self.assertEqual('error', client.receive()['type'])
+        self.update_trip(self.driver, trip=trip, status=Trip.STARTED)
+        trip = Trip.objects.get(pk=trip.pk)
+        self.assertEqual((Trip.STARTED, self.driver), (trip.status, trip.driver))
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_declined_offer_goes_to_next_driver(self):
+        other = create_user(username='other@example.com', group='driver')
+        self.place_driver(self.driver, 40.7000, -74.0000)
+        self.place_driver(other, 40.7100, -74.0000)
+        trip = Trip.objects.create(
+            pick_up_address='A', drop_off_address='B', pick_up_latitude=40.7010, pick_up_longitude=-74.0000
+        )
+        client = self.connect_as_driver(self.driver)
+        other_client = self.connect_as_driver(other)
+        dispatcher = BatchDispatcher()
+        self.assertEqual([(trip.id, self.driver.id)], [
+            (trip_id, driver_id) for trip_id, driver_id, _ in dispatcher.tick()
+        ])
+        client.send_and_consume('websocket.receive', path='/driver/', content={
+            'text': {'type': 'decline', 'nk': trip.nk}
+        })
+        assignments = dispatcher.tick()
+        self.assertEqual([(trip.id, other.id)], [(trip_id, driver_id) for trip_id, driver_id, _ in assignments])
+        self.assertEqual(trip.nk, other_client.receive()['trip']['nk'])
+        self.assertEqual(other, Trip.objects.get(pk=trip.pk).offered_to)
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_batch_dispatcher_skips_offline_drivers(self):
+        offline = create_user(username='offline@example.com', group='driver')
+        self.place_driver(offline, 40.7000, -74.0000)
+        Trip.objects.create(
+            pick_up_address='A', drop_off_address='B', pick_up_latitude=40.7010, pick_up_longitude=-74.0000
+        )
+        self.assertEqual([], BatchDispatcher().tick())
+
+    @override_settings(DISPATCH_MODE='batch')
+    def test_batch_dispatcher_falls_back_to_any_free_driver(self):
+        client = self.connect_as_driver(self.driver)
+        self.place_driver(self.driver, 41.7000, -74.0000)
+        far = Trip.objects.create(
+            pick_up_address='A', drop_off_address='B', pick_up_latitude=40.7010, pick_up_longitude=-74.0000
+        )
+        Trip.objects.create(pick_up_address='C', drop_off_address='D')
+        self.assertEqual([(far.id, self.driver.id, None)], BatchDispatcher().tick())
+        self.assertEqual(far.nk, client.receive()['trip']['nk'])
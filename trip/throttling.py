@@ -0,0 +1,131 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from asgi_redis import RedisChannelLayer
+from django.conf import settings
+from rest_framework.throttling import ScopedRateThrottle
+from .subscriptions import layer_backend
+
+# Takes a token from every bucket in KEYS, or from none of them. Returns how
+# long to wait for a token, as a string so Lua doesn't truncate it, or nil.
+TAKE_TOKEN = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local tokens, wait = {}, 0
+for index, key in ipairs(KEYS) do
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local available = tonumber(state[1]) or burst
+    local updated = tonumber(state[2]) or now
+    available = math.min(burst, available + math.max(0, now - updated) * rate)
+    tokens[index] = available
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for index, key in ipairs(KEYS) do
+    redis.call('HMSET', key, 'tokens', tokens[index] - 1, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return nil
+"""
+
+
+class RateLimiter:
+    """
+    Token buckets held in this process, one per `(kind, key)`. A bucket holds
+    up to `burst` tokens and refills at `rate` tokens a second; the least
+    recently used buckets are dropped beyond `max_keys`.
+    """
+
+    def __init__(self, max_keys=100000, clock=time.monotonic):
+        self.max_keys = max_keys
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+
+    def take(self, kind, keys, rate, burst):
+        """Take a token from every bucket in `keys`, or none; returns the seconds to wait, or None."""
+        now = self.clock()
+        with self.lock:
+            tokens = []
+            for key in keys:
+                available, updated = self.buckets.get((kind, key), (burst, now))
+                tokens.append(min(burst, available + (now - updated) * rate))
+            if min(tokens) < 1:
+                return max((1 - available) / rate for available in tokens if available < 1)
+            for key, available in zip(keys, tokens):
+                self.buckets[(kind, key)] = (available - 1, now)
+                self.buckets.move_to_end((kind, key))
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return None
+
+
+class RedisRateLimiter:
+    """The same buckets in the channel layer's Redis, shared by every worker."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.scripts = {}
+
+    def take(self, backend, kind, keys, rate, burst):
+        """
+        As `RateLimiter.take`. All of `keys` live on the shard of the first,
+        so callers list the widest bucket (the user's) first; every socket of
+        a user then shares one shard.
+        """
+        keys = [f'{backend.prefix}throttle:{kind}:{key}' for key in keys]
+        index = backend.consistent_hash(keys[0])
+        if index not in self.scripts:
+            self.scripts[index] = backend.connection(index).register_script(TAKE_TOKEN)
+        wait = self.scripts[index](keys=keys, args=[rate, burst, self.clock()])
+        return float(wait) if wait is not None else None
+
+
+rate_limiter = RateLimiter()
+redis_rate_limiter = RedisRateLimiter()
+
+
+def take_token(kind, keys):
+    """
+    Spend one of the `SOCKET_RATE_LIMITS[kind]` tokens of every bucket in
+    `keys`. Returns None if allowed, or how many seconds until it would be.
+    """
+    limit = settings.SOCKET_RATE_LIMITS[kind]
+    backend = layer_backend()
+    if isinstance(backend, RedisChannelLayer):
+        return redis_rate_limiter.take(backend, kind, keys, limit['rate'], limit['burst'])
+    return rate_limiter.take(kind, keys, limit['rate'], limit['burst'])
+
+
+class AddressRateThrottle(ScopedRateThrottle):
+    """
+    The view's `address_throttle_scope` rate from DEFAULT_THROTTLE_RATES,
+    counted per client address whatever username is submitted.
+    """
+
+    scope_attr = 'address_throttle_scope'
+
+
+class UsernameRateThrottle(ScopedRateThrottle):
+    """
+    The view's `throttle_scope` rate from DEFAULT_THROTTLE_RATES, counted per
+    submitted username and client address (per address without a username),
+    so repeated tries at one account are refused before any password is
+    hashed, without letting others lock its owner out from elsewhere.
+    """
+
+    def get_cache_key(self, request, view):
+        username = request.data.get('username') if hasattr(request.data, 'get') else None
+        ident = self.get_ident(request)
+        if username:
+            # Hashed, so any username makes a valid cache key.
+            ident = hashlib.sha1(f'{str(username).lower()}\n{ident}'.encode('utf-8')).hexdigest()
+        return self.cache_format % {'scope': self.scope, 'ident': ident}
@@ -1,7 +1,9 @@
 from django.conf.urls import url
-from .apis import TripView
+from .apis import TripStatsView, TripView
 
 urlpatterns = [
     url(r'^$', TripView.as_view({'get': 'list'}), name='trip_list'),
+    url(r'^export/$', TripView.as_view({'get': 'export'}), name='trip_export'),
+    url(r'^stats/$', TripStatsView.as_view(), name='trip_stats'),
     url(r'^(?P<trip_nk>\w{32})/$', TripView.as_view({'get': 'retrieve'}), name='trip_detail'),
 ]
@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from collections import deque
+from channels.exceptions import ChannelSocketException, ConsumeLater, DenyConnection
+from channels.message import Message
+from channels.signals import consumer_finished, consumer_started
+from channels.utils import name_that_thing
+from channels.worker import Worker
+from django.db import connections
+
+logger = logging.getLogger('django.channels')
+
+
+class ConcurrentWorker(Worker):
+    """
+    Channels worker that receives messages on one thread and runs their
+    consumers on a pool of `threads`, so a process keeps working while
+    handlers wait on the database.
+
+    Messages from one socket (one reply channel) run one at a time and in
+    the order they arrived; messages without a reply channel run
+    independently. At most `max_pending` messages are held at once, after
+    which the worker stops taking more from the channel layer. Each thread
+    has its own database connections, closed after every message as in the
+    stock worker and for good when the thread exits.
+    """
+
+    def __init__(self, *args, threads=8, max_pending=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threads = threads
+        self.max_pending = max_pending or threads * 4
+        self.condition = threading.Condition()
+        # Messages waiting per reply channel, including the one being run.
+        self.queues = {}
+        # Reply channels with messages waiting and no thread running them.
+        self.ready = deque()
+        self.pending = 0
+        self.stopping = False
+
+    def sigterm_handler(self, signo, stack_frame):
+        # Held messages are finished before `run` returns.
+        logger.info('Shutdown signal received, finishing %s pending messages', self.pending)
+        self.termed = True
+
+    def run(self):
+        if self.signal_handlers:
+            self.install_signal_handler()
+        channels = self.apply_channel_filters(self.channel_layer.router.channels)
+        logger.info('Listening on channels %s with %s threads', ', '.join(sorted(channels)), self.threads)
+        pool = [threading.Thread(target=self.work, name=f'consumer-{index}') for index in range(self.threads)]
+        for thread in pool:
+            thread.start()
+        try:
+            while not self.termed:
+                with self.condition:
+                    while self.pending >= self.max_pending and not self.termed:
+                        self.condition.wait(0.1)
+                if self.termed:
+                    break
+                channel, content = self.channel_layer.receive_many(channels, block=True)
+                if channel is None:
+                    time.sleep(0.01)
+                    continue
+                self.submit(channel, content)
+        finally:
+            with self.condition:
+                self.stopping = True
+                self.condition.notify_all()
+            for thread in pool:
+                thread.join()
+
+    def submit(self, channel, content):
+        # Messages without a reply channel get a key of their own.
+        key = content.get('reply_channel') or object()
+        with self.condition:
+            self.pending += 1
+            if key in self.queues:
+                self.queues[key].append((channel, content))
+            else:
+                self.queues[key] = deque([(channel, content)])
+                self.ready.append(key)
+                self.condition.notify_all()
+
+    def work(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.ready and not self.stopping:
+                        self.condition.wait()
+                    if not self.ready:
+                        return
+                    key = self.ready.popleft()
+                    channel, content = self.queues[key][0]
+                self.handle(channel, content)
+                with self.condition:
+                    queue = self.queues[key]
+                    queue.popleft()
+                    self.pending -= 1
+                    # The key stays out of `ready` while its message runs, so no
+                    # other thread can start that socket's next message early.
+                    if queue:
+                        self.ready.append(key)
+                    else:
+                        del self.queues[key]
+                    self.condition.notify_all()
+        finally:
+            connections.close_all()
+
+    def handle(self, channel, content):
+        """Run the consumer for one message, as the stock worker's loop does."""
+        message = Message(content=content, channel_name=channel, channel_layer=self.channel_layer)
+        if content.get('__retries__', 0) == self.message_retries:
+            message.__doomed__ = True
+        match = self.channel_layer.router.match(message)
+        if match is None:
+            logger.error('Could not find match for message on %s! Check your routing.', channel)
+            return
+        consumer, kwargs = match
+        if self.callback:
+            self.callback(channel, message)
+        try:
+            consumer_started.send(sender=self.__class__, environ={})
+            consumer(message, **kwargs)
+        except DenyConnection:
+            # Raising here, as the stock worker does, would take a pool thread down with it.
+            if message.channel.name != 'websocket.connect':
+                logger.error('Consumer %s denied a connection outside websocket.connect.', name_that_thing(consumer))
+            else:
+                message.reply_channel.send({'close': True})
+        except ChannelSocketException as exception:
+            exception.run(message)
+        except ConsumeLater:
+            self.requeue(channel, content)
+        except Exception:
+            logger.exception('Error processing message with consumer %s:', name_that_thing(consumer))
+        finally:
+            consumer_finished.send(sender=self.__class__)
+
+    def requeue(self, channel, content):
+        content['__retries__'] = content.get('__retries__', 0) + 1
+        if content['__retries__'] > self.message_retries:
+            logger.warning('Exceeded number of retries for message on channel %s: %s', channel, repr(content)[:100])
+            return
+        for _ in range(10):
+            try:
+                self.channel_layer.send(channel, content)
+            except self.channel_layer.ChannelFull:
+                time.sleep(0.05)
+            else:
+                return
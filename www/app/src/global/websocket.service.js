@@ -2,8 +2,12 @@
 
   'use strict';
 
-  function websocketService($websocket, AccountModel, Trip, TripStatus, growl) {
+  // Drivers stay online on the server for a minute after their last message.
+  var HEARTBEAT_INTERVAL = 20000;
+
+  function websocketService($interval, $websocket, AccountModel, Trip, TripStatus, growl) {
     var websocket = {};
+    var heartbeat = null;
 
     this.connect = function connect() {
       var url = AccountModel.isRider() ? 'ws://localhost:8000/rider/' : 'ws://localhost:8000/driver/';
@@ -23,10 +27,19 @@
 
     function onConnect(message) {
       console.log('Connected.');
+      if (!AccountModel.isRider()) {
+        heartbeat = $interval(function () {
+          websocket.send({type: 'heartbeat'});
+        }, HEARTBEAT_INTERVAL);
+      }
     }
 
     function onReceive(message) {
       var data = JSON.parse(message.data);
+      if (data.type === 'error') {
+        growl.error(data.detail);
+        return;
+      }
       if (AccountModel.isRider()) {
         var status = data.status;
         switch (status) {
@@ -51,10 +64,12 @@
 
     function onDisconnect(message) {
       console.log('Disconnected.');
+      $interval.cancel(heartbeat);
+      heartbeat = null;
     }
   }
 
   angular.module('taxi')
-    .service('websocketService', ['$websocket', 'AccountModel', 'Trip', 'TripStatus', 'growl', websocketService]);
+    .service('websocketService', ['$interval', '$websocket', 'AccountModel', 'Trip', 'TripStatus', 'growl', websocketService]);
 
 })(window, window.angular);
\ No newline at end of file
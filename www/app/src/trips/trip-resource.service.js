@@ -12,7 +12,7 @@
           Authorization: 'Token ' + user.auth_token
         }
       }).then(function (response) {
-        Trip.updateList(response.data);
+        Trip.updateList(response.data.results);
         deferred.resolve(Trip);
       }, function (response) {
         console.error('Failed to get trips.');